@@ -0,0 +1,55 @@
+# File: benchmarks/bench_image_jobs.py
+"""
+Compare sequential and scheduled image generation against a local fake Replicate server
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_image_jobs --images 20 --latency 1.0 --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.fakes import FakeReplicateServer
+
+async def run_batch(scheduler, prompts):
+    start = time.perf_counter()
+    urls = await asyncio.gather(*[scheduler.generate(prompt) for prompt in prompts])
+    return time.perf_counter() - start, urls
+
+async def run(images, latency, jitter, failure_rate, concurrency, rate):
+    server = await FakeReplicateServer(latency=latency, jitter=jitter, failure_rate=failure_rate).start()
+    os.environ["REPLICATE_BASE_URL"] = server.base_url
+    os.environ.setdefault("REPLICATE_API_TOKEN", "fake-token")
+
+    # Imported after the environment points at the fake server
+    from image_jobs import ImageJobScheduler
+
+    prompts = [f"A detailed atmospheric scene number {i}" for i in range(images)]
+    try:
+        sequential = ImageJobScheduler(concurrency=1, rate_per_second=0, max_retries=3, backoff=0.1)
+        seq_time, seq_urls = await run_batch(sequential, prompts)
+
+        server.max_active = 0
+        scheduled = ImageJobScheduler(concurrency=concurrency, rate_per_second=rate, burst=concurrency,
+                                      max_retries=3, backoff=0.1)
+        par_time, par_urls = await run_batch(scheduled, prompts)
+    finally:
+        await server.stop()
+
+    print(f"{images} images, fake latency {latency}s +/- {jitter}s, failure rate {failure_rate:.0%}")
+    print(f"sequential:  {seq_time:6.2f}s  ok={sum(1 for u in seq_urls if u)}  {sequential.stats}")
+    print(f"scheduled:   {par_time:6.2f}s  ok={sum(1 for u in par_urls if u)}  {scheduled.stats}  "
+          f"peak concurrent={server.max_active}")
+    print(f"speedup:     x{seq_time / par_time:.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=10.0, help="Requests per second (0 = unlimited)")
+    args = parser.parse_args()
+    asyncio.run(run(args.images, args.latency, args.jitter, args.failure_rate, args.concurrency, args.rate))
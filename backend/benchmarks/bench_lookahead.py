@@ -0,0 +1,135 @@
+# File: benchmarks/bench_lookahead.py
+"""
+Benchmark of lookahead scene writing (backend/lookahead.py), fully offline.
+A player walks a branching story: every scene offers two choices, and the
+player always takes the second, leaving the first branch unplayed. Scene
+writing is replaced by a stub that takes a fixed time, and the player
+reads each scene for a while before choosing. It reports:
+
+  - hits: scenes already written ahead when the player reached them
+  - misses: scenes written while the player waited
+  - scenes written ahead, and how many fell out of the player's reach
+
+It fails if no hits come after the first LOOKAHEAD_BUDGET moves, which is
+what happens when scenes left behind on other branches keep counting
+against the budget.
+
+From the backend directory:
+    python -m benchmarks.bench_lookahead
+    python -m benchmarks.bench_lookahead --moves 100 --depth 3 --budget 8 --write-seconds 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
+
+
+# A scratch database, so the real data/ directory is untouched
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="plottwist-bench-"), "plottwist.db")
+
+import lookahead
+from lookahead import LookaheadEngine, add_scene_to_script
+from storage import store
+from story_session import story_sessions
+from vn_generator import update_scene_graph
+
+BOOK_ID = "bench_lookahead"
+SCRIPT_ID = "bench_lookahead_script"
+START = "scene_1"
+
+def stub_scene(scene_id: str) -> dict:
+    """A scene whose two choices lead to two new scenes"""
+    return {
+        "id": scene_id,
+        "dialogue": [
+            {"character": "Narrator", "text": f"The story reaches {scene_id}."},
+            {"character": "Narrator", "text": "Which way?", "choices": [
+                {"text": "Left", "nextScene": f"{scene_id}_left"},
+                {"text": "Right", "nextScene": f"{scene_id}_right"}
+            ]}
+        ]
+    }
+
+def install_stubs(write_seconds: float):
+    async def generate_next_scene(session, scene_id, client, on_line=None):
+        await asyncio.sleep(write_seconds)
+        scene = stub_scene(scene_id)
+        session.generated_scenes[scene_id] = scene
+        return scene
+
+    async def enhance_visual_novel(script, characters, book_id):
+        return script
+
+    lookahead.generate_next_scene = generate_next_scene
+    lookahead.enhance_visual_novel = enhance_visual_novel
+    return generate_next_scene
+
+def create_book():
+    store.create_book({"id": BOOK_ID, "title": "Two Roads", "status": "ready", "progress": 100,
+                       "script_id": SCRIPT_ID})
+    store.save_script({"id": SCRIPT_ID, "book_id": BOOK_ID, "title": "Two Roads", "scenes": [stub_scene(START)]})
+    store.save_analysis(BOOK_ID, {"characters": [], "metadata": {"title": "Two Roads"}})
+
+async def run(args) -> dict:
+    generate_next_scene = install_stubs(args.write_seconds)
+    create_book()
+    engine = LookaheadEngine(depth=args.depth, budget=args.budget, concurrency=args.concurrency)
+    story_sessions.on_evict.append(engine.forget)
+
+    moves = []
+    scene_id = START
+    try:
+        for move in range(args.moves):
+            session = await lookahead.load_session(BOOK_ID, store.get_script(SCRIPT_ID))
+            hit = scene_id in session.generated_scenes
+            if not hit:
+                # What a scene request does when nothing was written ahead
+                scene = await generate_next_scene(session, scene_id, None)
+                update_scene_graph(session, await add_scene_to_script(SCRIPT_ID, scene_id, scene))
+            await engine.visit(BOOK_ID, scene_id, "reader")
+            moves.append(hit)
+            # The player reads the scene, then takes the second choice
+            await asyncio.sleep(args.read_seconds)
+            scene_id = session.generated_scenes[scene_id]["dialogue"][-1]["choices"][1]["nextScene"]
+    finally:
+        await engine.stop()
+
+    # The first scene is in the initial script, not written ahead
+    moves = moves[1:]
+    late = moves[args.budget:]
+    return {
+        "moves": len(moves),
+        "hits": sum(moves),
+        "misses": len(moves) - sum(moves),
+        "hits_after_budget": sum(late),
+        "moves_after_budget": len(late),
+        "stats": engine.stats
+    }
+
+def main(args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")) if not args.verbose else contextlib.nullcontext():
+        result = asyncio.run(run(args))
+    elapsed = time.perf_counter() - start
+
+    stats = result["stats"]
+    print(f"depth {args.depth}, budget {args.budget}: {result['hits']}/{result['moves']} moves hit "
+          f"({result['hits_after_budget']}/{result['moves_after_budget']} after the first {args.budget}) "
+          f"in {elapsed:.2f}s")
+    print(f"written ahead {stats['written']}, abandoned {stats['abandoned']}, stale {stats['stale']}, "
+          f"over budget {stats['over_budget']}, failed {stats['failed']}")
+    if result["moves_after_budget"] and not result["hits_after_budget"]:
+        raise SystemExit("No lookahead hits after the first budget's worth of moves")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--moves", type=int, default=40, help="choices the player makes")
+    parser.add_argument("--depth", type=int, default=2, help="choices ahead to write (LOOKAHEAD_DEPTH)")
+    parser.add_argument("--budget", type=int, default=12, help="unplayed scenes per book (LOOKAHEAD_BUDGET)")
+    parser.add_argument("--concurrency", type=int, default=2, help="scenes written at once")
+    parser.add_argument("--write-seconds", type=float, default=0.02, help="seconds to write a scene")
+    parser.add_argument("--read-seconds", type=float, default=0.2, help="seconds the player spends on a scene")
+    parser.add_argument("--verbose", action="store_true", help="show the backend's own log output")
+    main(parser.parse_args())
@@ -0,0 +1,120 @@
+# File: benchmarks/bench_model_routing.py
+"""
+Benchmark of model routing (backend/model_router.py), fully offline. Books
+are written against the fake OpenAI client (outline, initial script and a
+few continuation scenes, as a player reaching them would ask for them)
+under each routing setting:
+
+  - premium: every call site on the premium tier, as before routing
+  - routed: the default routes (continuation scenes start on the draft tier)
+  - draft: every call site starts on the draft tier
+
+The fake's draft and standard models answer faster and leave the choices
+out of a share of their scenes, which fails the scene check and escalates
+the call. For each setting it reports, per call site: calls, the tiers
+outputs were accepted at, escalations, mean seconds and estimated spend
+at list price (llm_client.MODEL_PRICES).
+
+From the backend directory:
+    python -m benchmarks.bench_model_routing
+    python -m benchmarks.bench_model_routing --books 5 --draft-flaws 0.5 --json routing.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+
+
+# Cached completions would hide the requests being measured
+os.environ["LLM_CACHE_MODE"] = "off"
+
+from benchmarks.fakes import Latency, FakeAsyncOpenAI
+from benchmarks.bench_scene_batching import book_analysis
+import vn_generator
+from model_router import router, MODEL_TIERS, DEFAULT_TIERS
+from story_session import story_sessions
+
+# Starting tier per call site, per setting (None keeps the default route)
+SETTINGS = {
+    "premium": "premium",
+    "routed": None,
+    "draft": "draft",
+}
+
+def apply_setting(setting: str):
+    for call_site in DEFAULT_TIERS:
+        name = f"LLM_{call_site.upper()}_TIER"
+        if SETTINGS[setting] is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = SETTINGS[setting]
+    router.routes.clear()
+    router._stats.clear()
+
+async def run_book(analysis: dict, book_id: str, continuations: int):
+    client = FakeAsyncOpenAI()
+    session = story_sessions.create(book_id, analysis)
+    script = await vn_generator.generate_initial_script(analysis, client, session)
+    vn_generator.update_scene_graph(session, script)
+    # Scenes the initial script leads to but didn't write, in the order a player might reach them
+    pending = [scene_id for scene_id in session.scene_graph if scene_id not in session.generated_scenes]
+    for scene_id in pending[:continuations]:
+        await vn_generator.generate_next_scene(session, scene_id, client)
+
+async def run_setting(setting: str, args) -> dict:
+    apply_setting(setting)
+    rng = random.Random(args.seed)
+    for index in range(args.books):
+        await run_book(book_analysis(index, rng), f"bench_{setting}_{index}", args.continuations)
+    routes = router.stats()
+    return {
+        "setting": setting,
+        "books": args.books,
+        "cost_usd_per_book": round(sum(route["cost_usd"] for route in routes.values()) / args.books, 4),
+        "routes": routes
+    }
+
+def print_result(result: dict):
+    print(f"{result['setting']:<8}| ${result['cost_usd_per_book']:.4f} per book")
+    for call_site, route in result["routes"].items():
+        accepted = ", ".join(f"{tier} {count}" for tier, count in route["accepted"].items())
+        print(f"        | {call_site:<13} {route['calls']:>3} calls (from {route['tier']}; accepted {accepted or '-'}), "
+              f"{route['escalated']:>2} escalated, {route['rejected']:>2} invalid | "
+              f"{route['mean_seconds']:>5.2f}s, ${route['mean_cost_usd']:.4f} per call")
+
+async def main(args):
+    FakeAsyncOpenAI.latency = Latency(args.llm_latency, args.llm_jitter, args.llm_token_seconds, seed=args.seed)
+    FakeAsyncOpenAI.speed = {MODEL_TIERS["draft"]: args.draft_speed, MODEL_TIERS["standard"]: args.standard_speed}
+    FakeAsyncOpenAI.flaw_rates = {MODEL_TIERS["draft"]: args.draft_flaws, MODEL_TIERS["standard"]: args.standard_flaws}
+    results = []
+    for setting in args.settings:
+        FakeAsyncOpenAI._rng = random.Random(args.seed)
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            result = await run_setting(setting, args)
+        results.append(result)
+        print_result(result)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"results": results, "settings": vars(args)}, file, indent=2)
+        print(f"Wrote {args.json}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--settings", nargs="+", choices=list(SETTINGS), default=list(SETTINGS), help="routing settings to compare")
+    parser.add_argument("--books", type=int, default=3, help="books written per setting")
+    parser.add_argument("--continuations", type=int, default=4, help="continuation scenes written per book")
+    parser.add_argument("--draft-flaws", type=float, default=0.2, help="share of draft-tier scenes written without choices")
+    parser.add_argument("--standard-flaws", type=float, default=0.05, help="share of standard-tier scenes written without choices")
+    parser.add_argument("--draft-speed", type=float, default=0.4, help="draft-tier latency, relative to premium")
+    parser.add_argument("--standard-speed", type=float, default=0.7, help="standard-tier latency, relative to premium")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="+/- seconds of LLM latency jitter")
+    parser.add_argument("--llm-token-seconds", type=float, default=0.005, help="extra seconds per completion token")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the generator's own log output")
+    asyncio.run(main(parser.parse_args()))
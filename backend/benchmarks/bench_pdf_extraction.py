@@ -0,0 +1,43 @@
+# File: benchmarks/bench_pdf_extraction.py
+"""
+Measure PDF text extraction throughput for different worker counts
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_pdf_extraction --pages 600 --workers 1 2 4 8
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from pdf_processor import process_pdf
+from benchmarks.synthetic_pdf import write_synthetic_pdf
+
+async def run(pages, worker_counts, repeats):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_synthetic_pdf(os.path.join(tmp, "book.pdf"), pages)
+        print(f"Synthetic PDF: {pages} pages, {os.path.getsize(path) / 1e6:.1f} MB, {os.cpu_count()} CPUs")
+
+        baseline = None
+        for workers in worker_counts:
+            # Warm-up run so process start-up isn't counted
+            await process_pdf(path, workers=workers)
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                result = await process_pdf(path, workers=workers)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            assert len(result["content"]) == pages
+            assert [p["page"] for p in result["content"]] == list(range(1, pages + 1))
+            baseline = baseline or best
+            print(f"workers={workers:<3} {best:7.2f}s  {pages / best:8.1f} pages/s  speedup x{baseline / best:.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=600)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args.pages, args.workers, args.repeats))
@@ -0,0 +1,255 @@
+# File: benchmarks/bench_pipeline.py
+"""
+End-to-end pipeline benchmark, fully offline. Synthetic PDFs are queued
+and run as worker jobs (enqueue_book, then run_job) with OpenAI, Gemini
+and Replicate replaced by the fakes in fakes.py, and for each book size
+and concurrency level it reports:
+
+  - wall time per pipeline stage (extract, analyze, generate) and the
+    critical path of script and image generation
+  - peak RSS of the process while the books ran
+  - event-loop lag (how late a 50 ms timer fires)
+  - books per minute
+
+From the backend directory:
+    python -m benchmarks.bench_pipeline --pages 10 200 2000 --concurrency 1 4
+    python -m benchmarks.bench_pipeline --pages 500 --llm-latency 2 --llm-jitter 0.5 --json results.json
+
+Everything runs in a scratch directory, so the real data/ and cache/
+directories are untouched. Backend settings read from the environment
+(ANALYSIS_MODE, STREAM_PDF_PAGES, IMAGE_RATE_PER_SECOND, ...) apply as usual.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+
+# Pipeline phases, named after the book status that starts each one
+PHASES = (("processing", "extract"), ("analyzing", "analyze"), ("generating", "generate"))
+
+class RSSSampler:
+    """Peak resident set size while running, sampled from /proc in a thread"""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        # No /proc: fall back to the lifetime peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+class LoopLagMonitor:
+    """How late a periodic timer fires; lag means something blocked the event loop"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    def summary(self) -> dict:
+        if not self.lags:
+            return {"max_ms": 0.0, "p95_ms": 0.0, "mean_ms": 0.0}
+        ordered = sorted(self.lags)
+        return {
+            "max_ms": round(ordered[-1] * 1000, 1),
+            "p95_ms": round(ordered[int(len(ordered) * 0.95) - 1 if len(ordered) > 1 else 0] * 1000, 1),
+            "mean_ms": round(statistics.mean(ordered) * 1000, 1)
+        }
+
+def record_status_changes(pipeline):
+    """Wrap pipeline.update_book to timestamp each book's status changes"""
+    changes = {}   # Book ID -> [(status, time)]
+    update_book = pipeline.update_book
+
+    def recording_update_book(book_id, **fields):
+        status = fields.get("status")
+        history = changes.setdefault(book_id, [])
+        if status and (not history or history[-1][0] != status):
+            history.append((status, time.perf_counter()))
+        return update_book(book_id, **fields)
+
+    pipeline.update_book = recording_update_book
+    return changes
+
+def phase_seconds(history: list) -> dict:
+    """Seconds spent in each pipeline phase, from one book's status changes"""
+    times = {}
+    for (status, start), (_, end) in zip(history, history[1:]):
+        times[status] = times.get(status, 0.0) + end - start
+    return {phase: round(times.get(status, 0.0), 3) for status, phase in PHASES}
+
+async def run_scenario(pages: int, concurrency: int, books: int, seed: int, verbose: bool) -> dict:
+    import pipeline
+    from job_queue import job_queue
+    from storage import store
+    from worker import enqueue_book, run_job
+    from benchmarks.synthetic_pdf import write_synthetic_pdf
+
+    os.makedirs("uploads", exist_ok=True)
+    book_ids = []
+    for i in range(books):
+        book_id = str(uuid.uuid4())
+        file_path = write_synthetic_pdf(f"uploads/{book_id}.pdf", pages, seed=seed + i)
+        store.create_book({"id": book_id, "title": f"Synthetic Novel {seed + i}", "author": "A. Benchmark",
+                           "file_path": file_path, "status": "queued", "progress": 0})
+        book_ids.append(book_id)
+        enqueue_book(book_id)
+
+    update_book = pipeline.update_book
+    changes = record_status_changes(pipeline)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run():
+        async with slots:
+            # Jobs are claimed oldest first, so the books start in upload order
+            job = await asyncio.to_thread(job_queue.claim, "bench")
+            await run_job(job)
+
+    monitor = LoopLagMonitor()
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            rss = stack.enter_context(RSSSampler())
+            baseline = RSSSampler.current()
+            monitor.start()
+            start = time.perf_counter()
+            await asyncio.gather(*[run() for _ in book_ids])
+            elapsed = time.perf_counter() - start
+            await monitor.stop()
+    finally:
+        pipeline.update_book = update_book
+
+    finished = [store.get_book(book_id) for book_id in book_ids]
+    phases = [phase_seconds(changes.get(book_id, [])) for book_id in book_ids]
+    slowest = max(finished, key=lambda book: (book.get("stage_timings") or {}).get("elapsed_seconds", 0))
+    return {
+        "pages": pages,
+        "concurrency": concurrency,
+        "books": books,
+        "ready": sum(book["status"] == "ready" for book in finished),
+        "elapsed_seconds": round(elapsed, 3),
+        "books_per_minute": round(books / elapsed * 60, 2),
+        "phase_seconds": {phase: round(statistics.mean(p[phase] for p in phases), 3) for _, phase in PHASES},
+        "critical_path": (slowest.get("stage_timings") or {}).get("critical_path", []),
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+        "rss_growth_mb": round((rss.peak - baseline) / 2 ** 20, 1),
+        "loop_lag": monitor.summary()
+    }
+
+def print_result(result: dict):
+    phases = "  ".join(f"{name} {seconds:.2f}s" for name, seconds in result["phase_seconds"].items())
+    lag = result["loop_lag"]
+    print(f"{result['pages']:>5} pages x{result['concurrency']:<2} | {result['ready']}/{result['books']} ready "
+          f"in {result['elapsed_seconds']:.2f}s ({result['books_per_minute']:.1f} books/min) | {phases} | "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB (+{result['rss_growth_mb']:.0f}) | "
+          f"loop lag max {lag['max_ms']:.0f} ms, p95 {lag['p95_ms']:.0f} ms")
+    if result["critical_path"]:
+        chain = " -> ".join(f"{step['stage']} {step['seconds']:.2f}s" for step in result["critical_path"])
+        print(f"{'':>15} critical path: {chain}")
+
+async def main(args):
+    from benchmarks.fakes import Latency, ImageServer, install_fakes, FakeAsyncOpenAI, FakeGenAI
+    from http_client import close_session
+    from llm_client import llm_stats
+
+    server = ImageServer(args.image_size)
+    await server.start()
+    replicate = install_fakes(
+        llm=Latency(args.llm_latency, args.llm_jitter, args.llm_token_seconds, seed=args.seed),
+        images=Latency(args.image_latency, args.image_jitter, seed=args.seed),
+        image_base_url=server.base_url,
+        gemini=args.gemini
+    )
+
+    results = []
+    try:
+        for pages in args.pages:
+            for concurrency in args.concurrency:
+                books = args.books or concurrency
+                # Every book gets its own seed, so no run is served from another's cache
+                seed = args.seed + len(results) * 1000
+                result = await run_scenario(pages, concurrency, books, seed, args.verbose)
+                results.append(result)
+                print_result(result)
+    finally:
+        await server.stop()
+        await close_session()
+
+    calls = {"openai": FakeAsyncOpenAI.calls, "gemini": FakeGenAI.calls, "replicate": replicate.calls}
+    print(f"Fake service calls: {calls}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"results": results, "calls": calls, "llm": llm_stats(), "settings": vars(args)}, file, indent=2)
+        print(f"Wrote {args.json}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 200, 2000], help="book sizes to run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="books processed at once")
+    parser.add_argument("--books", type=int, default=0, help="books per run (default: the concurrency)")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="+/- seconds of LLM latency jitter")
+    parser.add_argument("--llm-token-seconds", type=float, default=0.0, help="extra seconds per completion token")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="seconds per generated image")
+    parser.add_argument("--image-jitter", type=float, default=0.3, help="+/- seconds of image latency jitter")
+    parser.add_argument("--image-size", type=int, default=1024, help="width and height of served images")
+    parser.add_argument("--gemini", action="store_true", help="analyze with the (blocking) Gemini SDK path")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own log output")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    # Scratch working directory for the database, caches, uploads and images
+    os.chdir(tempfile.mkdtemp(prefix="plottwist-bench-"))
+    # Cached completions would hide the latency being measured
+    os.environ.setdefault("LLM_CACHE_MODE", "off")
+    asyncio.run(main(args))
@@ -0,0 +1,115 @@
+# File: benchmarks/bench_scene_batching.py
+"""
+Benchmark of batched scene writing, fully offline. The initial script of
+several books (outline plus five scenes, as generate_initial_script
+writes it) is generated against the fake OpenAI client at each
+SCENE_BATCH setting, and for each it reports per script:
+
+  - scene requests, and their prompt and completion tokens
+  - wall time to the whole script, and to the entry scene (when the
+    book becomes playable)
+
+The fake's latency is a fixed cost per request plus a cost per completion
+token, so batching saves the repeated prompt and per-request overhead
+but writes each batch's scenes one after another instead of in parallel.
+
+From the backend directory:
+    python -m benchmarks.bench_scene_batching
+    python -m benchmarks.bench_scene_batching --batch 1 3 auto --books 5 --llm-token-seconds 0.02
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import time
+
+
+# Cached completions would hide the requests being measured
+os.environ["LLM_CACHE_MODE"] = "off"
+
+from benchmarks.fakes import Latency, FakeAsyncOpenAI, fake_analysis
+from benchmarks.synthetic_pdf import CAST, PLACES
+import llm_client
+import vn_generator
+from stage_graph import StageGraph
+from story_session import story_sessions
+
+# Call sites that write scenes
+SCENE_CALL_SITES = ("scene", "scene_batch")
+
+def book_analysis(index: int, rng: random.Random) -> dict:
+    cast = rng.sample(CAST, rng.randint(3, len(CAST)))
+    analysis = fake_analysis(f"Title: Book {index}\n{' '.join(cast)} {' '.join(PLACES)}")
+    analysis["metadata"] = {"title": f"Book {index}"}
+    return analysis
+
+async def run_script(analysis: dict, book_id: str) -> dict:
+    session = story_sessions.create(book_id, analysis)
+    graph = StageGraph(book_id)
+    start = time.perf_counter()
+    script = await vn_generator.generate_initial_script(analysis, FakeAsyncOpenAI(), session, graph=graph)
+    elapsed = time.perf_counter() - start
+    entry = script["scenes"][0]["id"] if script["scenes"] else None
+    return {
+        "scenes": len(script["scenes"]),
+        "seconds": elapsed,
+        "entry_seconds": graph.timings.get(f"scene:{entry}", (0, elapsed))[1]
+    }
+
+async def run_setting(batch: str, books: int, seed: int) -> dict:
+    vn_generator.SCENE_BATCH = batch
+    llm_client.LLM_STATS.clear()
+    rng = random.Random(seed)
+    runs = []
+    for index in range(books):
+        runs.append(await run_script(book_analysis(index, rng), f"bench_{batch}_{index}"))
+
+    stats = [llm_client.LLM_STATS.get(call_site, {}) for call_site in SCENE_CALL_SITES]
+    requests = sum(s.get("calls", 0) for s in stats)
+    return {
+        "batch": batch,
+        "books": books,
+        "scenes_per_script": statistics.mean(run["scenes"] for run in runs),
+        "requests_per_script": round(requests / books, 2),
+        "prompt_tokens_per_script": round(sum(s.get("prompt_tokens", 0) for s in stats) / books),
+        "completion_tokens_per_script": round(sum(s.get("completion_tokens", 0) for s in stats) / books),
+        "seconds_per_script": round(statistics.mean(run["seconds"] for run in runs), 3),
+        "entry_scene_seconds": round(statistics.mean(run["entry_seconds"] for run in runs), 3)
+    }
+
+def print_result(result: dict, baseline: dict):
+    saved = 1 - result["prompt_tokens_per_script"] / max(baseline["prompt_tokens_per_script"], 1)
+    print(f"SCENE_BATCH={result['batch']:<5}| {result['requests_per_script']:>4.1f} requests, "
+          f"{result['prompt_tokens_per_script']:>6} prompt tokens ({saved:>+6.1%} saved), "
+          f"{result['completion_tokens_per_script']:>5} completion tokens | "
+          f"{result['seconds_per_script']:>6.2f}s per script, entry scene {result['entry_scene_seconds']:.2f}s")
+
+async def main(args):
+    FakeAsyncOpenAI.latency = Latency(args.llm_latency, args.llm_jitter, args.llm_token_seconds, seed=args.seed)
+    results = []
+    for batch in args.batch:
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            result = await run_setting(batch, args.books, args.seed)
+        results.append(result)
+        print_result(result, results[0])
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"results": results, "settings": vars(args)}, file, indent=2)
+        print(f"Wrote {args.json}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", nargs="+", default=["1", "2", "auto"], help="SCENE_BATCH settings to compare")
+    parser.add_argument("--books", type=int, default=3, help="scripts written per setting")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="+/- seconds of LLM latency jitter")
+    parser.add_argument("--llm-token-seconds", type=float, default=0.005, help="extra seconds per completion token")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the generator's own log output")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,129 @@
+# File: benchmarks/bench_scene_requests.py
+"""
+Benchmark of concurrent requests for a scene that isn't written yet, fully
+offline. Several players of a book reach the same new scene at once, and
+each asks GET /api/scenes/{scene_id} for it (through the app, with OpenAI
+replaced by the fake client). Two cases are run:
+
+  - concurrent: every request arrives while the scene is unwritten
+  - cancelled writer: the first generation of the scene is cancelled
+    partway (its player left), while the requests wait on it
+
+For each it reports the LLM calls made, how many requests got the scene,
+and their latency. It fails unless the requests share one generation (one
+more call when the first writer was cancelled) and all of them succeed.
+
+From the backend directory:
+    python -m benchmarks.bench_scene_requests
+    python -m benchmarks.bench_scene_requests --requests 50 --llm-latency 1.0
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import statistics
+import tempfile
+import time
+
+
+# Scratch working directory for the database, uploads and static files
+os.chdir(tempfile.mkdtemp(prefix="plottwist-bench-"))
+# Cached completions would hide the requests being counted
+os.environ["LLM_CACHE_MODE"] = "off"
+os.environ["RUN_WORKER_IN_PROCESS"] = "false"
+
+import httpx
+
+from benchmarks.fakes import Latency, FakeAsyncOpenAI, fake_analysis
+from benchmarks.synthetic_pdf import CAST, PLACES
+import main as server
+from lookahead import load_session
+from storage import store
+from vn_generator import generate_next_scene
+
+BOOK_ID = "bench_scene_requests"
+SCRIPT_ID = "bench_scene_requests_script"
+
+def create_book(scene_ids: list):
+    """A playable book whose first scene leads to each of scene_ids, none of them written"""
+    analysis = fake_analysis(f"Title: Crossroads\n{' '.join(CAST)} {' '.join(PLACES)}")
+    first = {
+        "id": "scene_1",
+        "background": "",
+        "characters": [],
+        "dialogue": [
+            {"character": "Narrator", "text": "The paths divide."},
+            {"character": "Narrator", "text": "Which way?", "choices": [
+                {"text": f"Toward {scene_id}", "nextScene": scene_id} for scene_id in scene_ids
+            ]}
+        ]
+    }
+    store.create_book({"id": BOOK_ID, "title": "Crossroads", "author": "A. Benchmark", "status": "ready",
+                       "progress": 100, "script_id": SCRIPT_ID})
+    store.save_script({"id": SCRIPT_ID, "book_id": BOOK_ID, "title": "Crossroads", "scenes": [first]})
+    store.save_analysis(BOOK_ID, analysis)
+
+async def request_scenes(http: httpx.AsyncClient, scene_id: str, requests: int) -> list:
+    async def request():
+        start = time.perf_counter()
+        response = await http.get(f"/api/scenes/{scene_id}", params={"book_id": BOOK_ID})
+        ok = response.status_code == 200 and response.json().get("id") == scene_id
+        return ok, time.perf_counter() - start
+
+    return await asyncio.gather(*[request() for _ in range(requests)])
+
+def summary(case: str, calls: int, expected_calls: int, results: list) -> dict:
+    seconds = sorted(elapsed for _, elapsed in results)
+    return {
+        "case": case,
+        "llm_calls": calls,
+        "expected_calls": expected_calls,
+        "requests": len(results),
+        "succeeded": sum(ok for ok, _ in results),
+        "mean_seconds": round(statistics.mean(seconds), 3),
+        "max_seconds": round(seconds[-1], 3)
+    }
+
+async def run(args) -> list:
+    create_book(["scene_2", "scene_3"])
+    results = []
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        calls = FakeAsyncOpenAI.calls
+        responses = await request_scenes(http, "scene_2", args.requests)
+        results.append(summary("concurrent", FakeAsyncOpenAI.calls - calls, 1, responses))
+
+        # A generation of scene_3 that is cancelled while the requests wait on it
+        session = await load_session(BOOK_ID, store.get_script(SCRIPT_ID))
+        calls = FakeAsyncOpenAI.calls
+        writer = asyncio.create_task(generate_next_scene(session, "scene_3", FakeAsyncOpenAI()))
+        await asyncio.sleep(0)
+        requests = asyncio.ensure_future(request_scenes(http, "scene_3", args.requests))
+        await asyncio.sleep(args.llm_latency / 2)
+        writer.cancel()
+        responses = await requests
+        results.append(summary("cancelled writer", FakeAsyncOpenAI.calls - calls, 2, responses))
+    await server.lookahead.stop()
+    return results
+
+def main(args):
+    FakeAsyncOpenAI.latency = Latency(args.llm_latency)
+    server.AsyncOpenAI = FakeAsyncOpenAI
+    with contextlib.redirect_stdout(open(os.devnull, "w")) if not args.verbose else contextlib.nullcontext():
+        results = asyncio.run(run(args))
+
+    failed = False
+    for result in results:
+        print(f"{result['case']:>16}: {result['llm_calls']} LLM calls (expected {result['expected_calls']}) | "
+              f"{result['succeeded']}/{result['requests']} requests got the scene | "
+              f"mean {result['mean_seconds']:.2f}s, max {result['max_seconds']:.2f}s")
+        failed |= result["llm_calls"] != result["expected_calls"] or result["succeeded"] != result["requests"]
+    if failed:
+        raise SystemExit("Concurrent scene requests didn't share one generation")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="concurrent requests for the scene")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument("--verbose", action="store_true", help="show the backend's own log output")
+    main(parser.parse_args())
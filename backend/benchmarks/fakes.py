@@ -0,0 +1,379 @@
+# File: benchmarks/fakes.py
+"""
+Local stand-ins for the services the pipeline calls: AsyncOpenAI, the
+Gemini SDK (genai) and Replicate, plus a small HTTP server for the image
+URLs the fake Replicate returns. FakeReplicateServer fakes Replicate's
+HTTP API instead, for benchmarks of the real client (retries, rate
+limits). Each has a configurable latency, so a benchmark sees realistic
+waiting without any network access.
+
+Responses are shaped after the prompts they answer (analysis, map-reduce
+chunks and summaries, outlines, scenes) and valid enough for the
+pipeline to run every stage as it would against the real services.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import random
+import re
+import time
+import uuid
+from types import SimpleNamespace
+
+from aiohttp import web
+from PIL import Image
+
+from llm_client import count_tokens, count_message_tokens
+from benchmarks.synthetic_pdf import CAST, PLACES
+
+class Latency:
+    """base seconds, plus or minus up to jitter, plus per_token seconds per completion token"""
+
+    def __init__(self, base: float = 0.0, jitter: float = 0.0, per_token: float = 0.0, seed: int = 0):
+        self.base = base
+        self.jitter = jitter
+        self.per_token = per_token
+        self._rng = random.Random(seed)
+
+    def sample(self, tokens: int = 0) -> float:
+        return max(0.0, self.base + self._rng.uniform(-self.jitter, self.jitter) + tokens * self.per_token)
+
+def _match(pattern: str, text: str, default: str) -> str:
+    match = re.search(pattern, text)
+    return match.group(1).strip() if match else default
+
+def _found(names, text, fallback):
+    present = [name for name in names if name in text]
+    return present or fallback
+
+def fake_analysis(prompt: str) -> dict:
+    title = _match(r"Title: (.*)", prompt, None) or _match(r'book "([^"]*)"', prompt, "Unknown")
+    cast = _found(CAST, prompt, CAST[:3])
+    places = _found([p.title() for p in PLACES], prompt.title(), ["The Old Mill"])
+    return {
+        "characters": [
+            {"id": name.lower().replace(" ", "_"), "name": name, "role": "Protagonist" if i == 0 else "Supporting",
+             "description": f"{name} of {title}, tall, with a grey coat and a watchful look",
+             "personality": "Guarded but loyal", "speech_patterns": "Short, careful sentences",
+             "motivations": "To learn what happened to the letter", "relationships": "Knows everyone in town",
+             "importance": "high" if i < 3 else "medium"}
+            for i, name in enumerate(cast)
+        ],
+        "settings": [
+            {"id": place.lower().replace(" ", "_"), "name": place,
+             "description": f"{place} in {title}, weathered and quiet", "atmosphere": "Tense",
+             "significance": "Where the secret is kept"}
+            for place in places[:6]
+        ],
+        "plot": {
+            "summary": f"In {title}, {cast[0]} uncovers a secret that binds the town together.",
+            "central_conflict": f"{cast[0]} against the silence of {cast[-1]}",
+            "key_points": [f"{name} reveals what they know" for name in cast],
+            "branching_points": [{"description": f"Whether to trust {name}", "options": ["Trust", "Refuse"]}
+                                 for name in cast[:4]]
+        },
+        "themes": ["secrets", "loyalty", "memory"],
+        "tone": "Melancholic"
+    }
+
+def fake_outline(prompt: str) -> dict:
+    count = int(_match(r"Create exactly (\d+) scenes", prompt, "5"))
+    title = _match(r"TITLE: (.*)", prompt, "Untitled")
+    cast = _found(CAST, prompt, CAST[:3])
+    scenes = []
+    for i in range(count):
+        scenes.append({
+            "id": f"scene_{i + 1}",
+            "description": f"{cast[i % len(cast)]} confronts the past in part {i + 1} of {title}.",
+            "characters": [name.lower().replace(" ", "_") for name in cast[i % len(cast):][:2]],
+            "setting": f"{PLACES[i % len(PLACES)]} in {title} at dusk",
+            "atmosphere": "Uneasy",
+            "dialogue_count": 8,
+            "connects_to": [f"scene_{j}" for j in (i + 2, i + 3) if j <= count] or ["scene_next", "scene_alt"]
+        })
+    return {"scenes": scenes}
+
+def fake_scene(prompt: str) -> dict:
+    scene_id = _match(r"- ID: (\S+)", prompt, "scene_x")
+    setting = _match(r"- Setting: (.*)", prompt, "a quiet room")
+    connects = _match(r"connect to these scenes: (.*)", prompt, "None specified")
+    targets = [t.strip() for t in connects.split(",") if t.strip() and t.strip() != "None specified"] or ["exit"]
+    cast = _found(CAST, prompt, ["Narrator"])
+    dialogue = []
+    for i in range(8):
+        speaker = "Narrator" if i % 3 == 0 else cast[i % len(cast)]
+        line = {"speaker": speaker, "text": f"Line {i + 1} of {scene_id}: the wind rattles the shutters as {speaker} speaks."}
+        if speaker != "Narrator":
+            line["character"] = speaker.lower().replace(" ", "_")
+        dialogue.append(line)
+    dialogue[-1]["choices"] = [{"text": f"Go on to {target}", "nextScene": target} for target in targets]
+    return {
+        "id": scene_id,
+        "background": f"{setting}, lamplight on wet cobblestones",
+        "characters": [{"id": name.lower().replace(" ", "_"), "image": f"{name} in a grey coat"}
+                       for name in cast if name != "Narrator"][:2],
+        "dialogue": dialogue
+    }
+
+def fake_scene_batch(prompt: str) -> dict:
+    """Every scene asked for in a batched scene prompt, each written from its own brief"""
+    briefs = re.split(r"\n\s*SCENE \d+:", prompt)[1:]
+    return {"scenes": [fake_scene(brief) for brief in briefs]}
+
+def fake_completion(prompt: str) -> dict:
+    """Pick a response shape from the prompt it answers"""
+    if "Combine them into one coherent summary" in prompt:
+        return {"summary": "The parts, taken together, tell of a town keeping a secret.",
+                "central_conflict": "Truth against loyalty"}
+    if "Create a detailed outline" in prompt:
+        return fake_outline(prompt)
+    if "Generate a detailed scene" in prompt:
+        return fake_scene(prompt)
+    if "Write each of these" in prompt:
+        return fake_scene_batch(prompt)
+    return fake_analysis(prompt)
+
+def flaw_scenes(response: dict, rate: float, rng: random.Random) -> dict:
+    """Drop the choices from some of the scenes in response, as a weaker model might"""
+    for scene in response.get("scenes", [response]):
+        if "dialogue" in scene and rng.random() < rate:
+            for line in scene["dialogue"]:
+                line.pop("choices", None)
+    return response
+
+class FakeAsyncOpenAI:
+    """
+    Drop-in for openai.AsyncOpenAI's chat.completions.create. Per model,
+    speed scales the latency (e.g. {"gpt-4o-mini": 0.4}) and flaw_rates is
+    the fraction of scenes written without choices.
+    """
+    latency = Latency()
+    speed = {}
+    flaw_rates = {}
+    calls = 0
+    _rng = random.Random(0)
+
+    def __init__(self, api_key: str = None, **_):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model: str, messages: list, stream: bool = False, **kwargs):
+        type(self).calls += 1
+        response = fake_completion(messages[-1]["content"])
+        if self.flaw_rates.get(model):
+            response = flaw_scenes(response, self.flaw_rates[model], self._rng)
+        content = json.dumps(response)
+        completion_tokens = count_tokens(content, model)
+        if stream:
+            return self._stream(content, count_message_tokens(messages, model), completion_tokens, self.speed.get(model, 1.0))
+        await asyncio.sleep(self.latency.sample(completion_tokens) * self.speed.get(model, 1.0))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(index=0, finish_reason="stop",
+                                     message=SimpleNamespace(role="assistant", content=content))],
+            usage=SimpleNamespace(prompt_tokens=count_message_tokens(messages, model),
+                                  completion_tokens=completion_tokens)
+        )
+
+    async def _stream(self, content: str, prompt_tokens: int, completion_tokens: int, speed: float = 1.0,
+                      piece_chars: int = 16):
+        """Chunks of content at the latency's per-token pace, after its base latency"""
+        pieces = [content[i:i + piece_chars] for i in range(0, len(content), piece_chars)]
+        await asyncio.sleep(self.latency.sample() * speed)
+        for piece in pieces:
+            await asyncio.sleep(self.latency.per_token * completion_tokens / len(pieces) * speed)
+            yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=piece),
+                                                           finish_reason=None)], usage=None)
+        yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=None),
+                                                       finish_reason="stop")], usage=None)
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=prompt_tokens,
+                                                                completion_tokens=completion_tokens))
+
+class FakeGenerativeModel:
+    def __init__(self, name: str):
+        self.name = name
+
+    def generate_content(self, prompt: str):
+        # The real SDK call is blocking too, which is what the benchmark should see
+        FakeGenAI.calls += 1
+        time.sleep(FakeGenAI.latency.sample())
+        return SimpleNamespace(text="```json\n" + json.dumps(fake_analysis(prompt)) + "\n```")
+
+class FakeGenAI:
+    """Drop-in for the google.generativeai module"""
+    latency = Latency()
+    calls = 0
+    GenerativeModel = FakeGenerativeModel
+
+    @staticmethod
+    def configure(api_key: str = None, **_):
+        pass
+
+class FakeReplicate:
+    """
+    Drop-in for replicate.run and replicate.Client().run, returning URLs
+    served by ImageServer (FakeReplicateServer fakes the HTTP API instead)
+    """
+
+    def __init__(self, base_url: str, latency: Latency):
+        self.base_url = base_url
+        self.latency = latency
+        self.calls = 0
+
+    def Client(self, *args, **kwargs):
+        return self
+
+    def run(self, model: str, input: dict, **_):
+        self.calls += 1
+        time.sleep(self.latency.sample())
+        digest = hashlib.sha256(input["prompt"].encode("utf-8")).hexdigest()[:16]
+        return [f"{self.base_url}/{digest}.png"]
+
+def solid_png(name: str, size: tuple) -> bytes:
+    """A PNG of one colour, picked by name, so each generated image looks distinct"""
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    buffer = io.BytesIO()
+    Image.new("RGB", size, tuple(digest[:3])).save(buffer, "PNG")
+    return buffer.getvalue()
+
+class ImageServer:
+    """Serves a distinct solid-colour PNG for each path, like a CDN would serve generated images"""
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self._runner = None
+        self.base_url = None
+
+    async def _image(self, request):
+        data = await asyncio.to_thread(solid_png, request.match_info["name"], (self.size, self.size))
+        return web.Response(body=data, content_type="image/png")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{name}", self._image)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+class FakeReplicateServer:
+    """
+    Minimal HTTP server speaking the parts of the Replicate API used by
+    replicate.Client.run: creating a prediction and fetching a model version.
+    Predictions complete after `latency` seconds (+/- jitter) and point at
+    PNG files served by the same server. A fraction of requests can be
+    rejected with 429 to exercise retries.
+    """
+
+    def __init__(self, latency=1.0, jitter=0.0, failure_rate=0.0, image_size=(512, 512), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.image_size = image_size
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.rejected = 0
+        self.active = 0
+        self.max_active = 0
+        self.base_url = None
+        self._runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/v1/predictions", self._create_prediction)
+        app.router.add_get("/v1/models/{owner}/{name}/versions/{version}", self._get_version)
+        app.router.add_get("/files/{name}", self._get_file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _create_prediction(self, request):
+        self.requests += 1
+        body = await request.json()
+        if self.rng.random() < self.failure_rate:
+            self.rejected += 1
+            return web.json_response({"detail": "Request was throttled", "status": 429}, status=429)
+
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        finally:
+            self.active -= 1
+
+        prediction_id = uuid.uuid4().hex
+        name = f"{prediction_id}.png"
+        return web.json_response({
+            "id": prediction_id,
+            "model": "fake/model",
+            "version": body.get("version", ""),
+            "status": "succeeded",
+            "input": body.get("input", {}),
+            "output": [f"{self.base_url}/files/{name}"],
+            "logs": "",
+            "error": None,
+            "metrics": {"predict_time": self.latency},
+            "created_at": "2024-01-01T00:00:00Z",
+            "started_at": "2024-01-01T00:00:00Z",
+            "completed_at": "2024-01-01T00:00:01Z",
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel"
+            }
+        }, status=201)
+
+    async def _get_version(self, request):
+        return web.json_response({
+            "id": request.match_info["version"],
+            "created_at": "2024-01-01T00:00:00Z",
+            "cog_version": "0.9.0",
+            "openapi_schema": {
+                "components": {"schemas": {"Output": {"type": "array", "items": {"type": "string", "format": "uri"}}}}
+            }
+        })
+
+    async def _get_file(self, request):
+        data = await asyncio.to_thread(solid_png, request.match_info["name"], self.image_size)
+        return web.Response(body=data, content_type="image/png")
+
+def install_fakes(llm: Latency, images: Latency, image_base_url: str, gemini: bool = False):
+    """Point the backend modules at the fakes; call after importing them"""
+    import os
+    import book_analyzer
+    import chunked_analysis
+    import image_jobs
+    import lookahead
+    import vn_generator
+
+    FakeAsyncOpenAI.latency = llm
+    FakeGenAI.latency = llm
+    for module in (book_analyzer, chunked_analysis, vn_generator, lookahead):
+        module.AsyncOpenAI = FakeAsyncOpenAI
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+    book_analyzer.genai = FakeGenAI
+    book_analyzer.GEMINI_AVAILABLE = gemini
+    if gemini:
+        os.environ["GEMINI_API_KEY"] = "fake"
+    else:
+        os.environ.pop("GEMINI_API_KEY", None)
+
+    replicate = FakeReplicate(image_base_url, images)
+    image_jobs.replicate = replicate
+    image_jobs.image_scheduler._client = None
+    os.environ["REPLICATE_API_TOKEN"] = "fake"
+    return replicate
@@ -0,0 +1,86 @@
+# File: benchmarks/synthetic_pdf.py
+"""
+Synthetic novels as real PDFs, for benchmarks. Pages hold a few thousand
+characters of prose about a fixed cast, with a "Chapter N" heading every
+few pages, so extraction, chapter detection and analysis all have
+something realistic to chew on. The same seed gives the same book.
+"""
+import random
+import zlib
+
+CAST = ["Elinor Marsh", "Tobias Wren", "Margaret Hale", "Silas Crane", "Ada Fairfax",
+        "Jonah Pike", "Clara Voss", "Edmund Ashdown", "Harriet Lowe", "Felix Moreau"]
+PLACES = ["the old mill", "the harbour", "Ashdown Hall", "the lighthouse", "the market square",
+          "the orchard", "the vicarage", "the railway station", "the library", "the moor"]
+VERBS = ["walked to", "hurried towards", "waited outside", "returned to", "searched", "remembered"]
+SPEECH = ["I never meant for any of this to happen.", "You should not have come here tonight.",
+          "There is something about the letter you have not told me.", "We leave at first light.",
+          "Whatever happens, keep the key safe.", "I saw him at the station, I am certain of it."]
+
+LINES_PER_PAGE = 46
+LINE_CHARS = 88
+PAGES_PER_CHAPTER = 12
+
+def _sentence(rng: random.Random) -> str:
+    name = rng.choice(CAST)
+    if rng.random() < 0.35:
+        return f'"{rng.choice(SPEECH)}" said {name}.'
+    return f"{name} {rng.choice(VERBS)} {rng.choice(PLACES)}, thinking of {rng.choice(CAST)}."
+
+def page_lines(rng: random.Random, page: int) -> list:
+    lines = []
+    if page % PAGES_PER_CHAPTER == 0:
+        lines += [f"Chapter {page // PAGES_PER_CHAPTER + 1}", ""]
+    text = ""
+    while len(lines) < LINES_PER_PAGE:
+        text += _sentence(rng) + " "
+        while len(text) > LINE_CHARS:
+            cut = text.rfind(" ", 0, LINE_CHARS)
+            lines.append(text[:cut])
+            text = text[cut + 1:]
+    return lines[:LINES_PER_PAGE]
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_synthetic_pdf(path: str, pages: int, seed: int = 0, title: str = None, author: str = "A. Benchmark"):
+    """Write a `pages`-page novel to path"""
+    rng = random.Random(seed)
+    title = title or f"Synthetic Novel {seed}"
+    objects = {}   # Object number -> bytes
+    font, info, catalog, page_tree = 1, 2, 3, 4
+    page_ids = []
+    next_id = 5
+    for page in range(pages):
+        lines = page_lines(rng, page)
+        ops = ["BT", "/F1 10 Tf", "13 TL", "56 770 Td"]
+        ops += [f"({_escape(line)}) Tj T*" for line in lines]
+        ops.append("ET")
+        stream = zlib.compress("\n".join(ops).encode("latin-1"))
+        content_id, page_id = next_id, next_id + 1
+        next_id += 2
+        objects[content_id] = (f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode()
+                               + stream + b"\nendstream")
+        objects[page_id] = (f"<< /Type /Page /Parent {page_tree} 0 R /MediaBox [0 0 612 792] "
+                            f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {content_id} 0 R >>").encode()
+        page_ids.append(page_id)
+
+    objects[font] = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    objects[info] = f"<< /Title ({_escape(title)}) /Author ({_escape(author)}) >>".encode("latin-1")
+    objects[catalog] = f"<< /Type /Catalog /Pages {page_tree} 0 R >>".encode()
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[page_tree] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    with open(path, "wb") as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = {}
+        for number in sorted(objects):
+            offsets[number] = file.tell()
+            file.write(f"{number} 0 obj\n".encode() + objects[number] + b"\nendobj\n")
+        xref = file.tell()
+        file.write(f"xref\n0 {next_id}\n0000000000 65535 f \n".encode())
+        for number in range(1, next_id):
+            file.write(f"{offsets[number]:010d} 00000 n \n".encode())
+        file.write(f"trailer\n<< /Size {next_id} /Root {catalog} 0 R /Info {info} 0 R >>\n"
+                   f"startxref\n{xref}\n%%EOF\n".encode())
+    return path
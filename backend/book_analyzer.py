@@ -1,11 +1,17 @@
 # File: book_analyzer.py
 import asyncio
-import json
 import re
 import os
+from collections import deque
 from typing import Dict, List, Any
 from openai import AsyncOpenAI  # For OpenAI models
 
+from pdf_processor import section_start_pages
+from llm_client import PromptBuilder, INPUT_BUDGETS, CHARS_PER_TOKEN
+from model_router import router
+from telemetry import span
+from json_stream import parse_json, json_parser
+
 # Import Google Gemini library for better analysis
 try:
     import google.generativeai as genai
@@ -14,6 +20,108 @@ except ImportError:
     GEMINI_AVAILABLE = False
     print("Google Generative AI package not available. To install: pip install google-generativeai")
 
+# Model used for analysis with Gemini (OpenAI models are picked by model_router)
+GEMINI_MODEL = "gemini-2.0-flash-thinking-exp-01-21"
+
+# Bump whenever the analysis prompts or sampling change, so cached analyses are not reused
+ANALYSIS_PROMPT_VERSION = "2"
+
+# "sample" analyzes excerpts of the book in one call; "map_reduce" analyzes
+# the full text in chunks and merges the results (see chunked_analysis.py)
+ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "sample").lower()
+
+# Tokens of the OpenAI analysis budget taken by the instructions rather than the excerpt
+ANALYSIS_PROMPT_TOKENS = 1000
+
+# Text sampling profiles: books up to full_text_limit characters are sent whole,
+# longer ones as the opening, windows starting at the given fractions of the book,
+# and the ending. The OpenAI excerpt is sized from the analysis token budget
+# (the prompt builder trims whatever the character estimate gets wrong).
+GEMINI_SAMPLE = {"full_text_limit": 30000, "head_chars": 8000, "window_chars": 8000, "window_starts": (0.5,), "tail_chars": 8000}
+_openai_sample_chars = int((INPUT_BUDGETS["analysis"] - ANALYSIS_PROMPT_TOKENS) * CHARS_PER_TOKEN)
+OPENAI_SAMPLE = {"full_text_limit": _openai_sample_chars, "head_chars": _openai_sample_chars // 4,
+                 "window_chars": _openai_sample_chars // 4, "window_starts": (1/3, 2/3), "tail_chars": _openai_sample_chars // 4}
+
+class TextSampler:
+    """
+    Build the analysis excerpt of a book from pages fed one at a time.
+    Only the parts that end up in the excerpt are kept, so memory is bounded
+    by the sample size rather than by the length of the book.
+
+    If anchors (0-based pages where chapters start) are given, each window
+    starts at the chapter start nearest its position instead of mid-chapter.
+    """
+
+    def __init__(self, total_pages, full_text_limit, head_chars, window_chars, window_starts, tail_chars, anchors=None):
+        self.full_text_limit = full_text_limit
+        self.head_chars = head_chars
+        self.window_chars = window_chars
+        self.tail_chars = tail_chars
+        self.window_pages = [int(total_pages * start) for start in window_starts]
+        if anchors:
+            self.window_pages = [min(anchors, key=lambda page: abs(page - target)) for target in self.window_pages]
+
+        self.full = []          # Whole text, kept only while the book is short
+        self.total_chars = 0
+        self.head = []
+        self.head_len = 0
+        self.windows = [[] for _ in self.window_pages]
+        self.window_lens = [0 for _ in self.window_pages]
+        self.tail = deque()
+        self.tail_len = 0
+        self.page_index = 0
+
+    def add(self, page: dict):
+        text = page["content"] + "\n\n"
+        self.total_chars += len(text)
+
+        if self.full is not None:
+            self.full.append(text)
+            if self.total_chars > self.full_text_limit:
+                self.full = None
+
+        if self.head_len < self.head_chars:
+            self.head.append(text)
+            self.head_len += len(text)
+
+        for i, start_page in enumerate(self.window_pages):
+            if self.page_index >= start_page and self.window_lens[i] < self.window_chars:
+                self.windows[i].append(text)
+                self.window_lens[i] += len(text)
+
+        self.tail.append(text)
+        self.tail_len += len(text)
+        while len(self.tail) > 1 and self.tail_len - len(self.tail[0]) >= self.tail_chars:
+            self.tail_len -= len(self.tail.popleft())
+
+        self.page_index += 1
+
+    def text(self) -> str:
+        if self.full is not None:
+            return "".join(self.full)
+
+        parts = ["".join(self.head)[:self.head_chars]]
+        parts += ["".join(window)[:self.window_chars] for window in self.windows]
+        parts.append("".join(self.tail)[-self.tail_chars:])
+        return "\n\n[...]\n\n".join(parts)
+
+def sample_book_text(book_content: dict, profile: dict) -> str:
+    """Build the analysis excerpt for an already extracted book"""
+    anchors = section_start_pages(book_content.get("structure"))
+    sampler = TextSampler(len(book_content["content"]), anchors=anchors, **profile)
+    for page in book_content["content"]:
+        sampler.add(page)
+    return sampler.text()
+
+def analysis_cache_tag() -> str:
+    """Identify the model and prompt version an analysis would be produced with"""
+    if ANALYSIS_MODE == "map_reduce":
+        return f"{router.model('analysis_chunk')}:{router.model('analysis_summary')}:map_reduce:{ANALYSIS_PROMPT_VERSION}"
+    if GEMINI_AVAILABLE and os.environ.get("GEMINI_API_KEY"):
+        return f"{GEMINI_MODEL}:{ANALYSIS_PROMPT_VERSION}"
+    # The excerpt size follows the token budget, so a different budget is a different analysis
+    return f"{router.model('analysis')}:{ANALYSIS_PROMPT_VERSION}:{INPUT_BUDGETS['analysis']}"
+
 async def analyze_book(book_content: dict) -> dict:
     """
     Analyze the book content using AI to extract characters, settings, and plot
@@ -29,7 +137,37 @@ async def analyze_book(book_content: dict) -> dict:
     else:
         return await analyze_with_openai(book_content)
 
-async def analyze_with_gemini(book_content: dict) -> dict:
+async def analyze_book_stream(metadata: dict, pages, anchors=None) -> dict:
+    """
+    Analyze a book from a stream of {"page", "content"} records, such as
+    pdf_processor.iter_pdf_pages. Pages are sampled as they arrive and
+    then dropped, so the full text is never held in memory.
+    anchors are the 0-based pages where chapters start, if known up front.
+    """
+    use_gemini = GEMINI_AVAILABLE and os.environ.get("GEMINI_API_KEY")
+    total_pages = metadata.get("pages", 0)
+    openai_sampler = TextSampler(total_pages, anchors=anchors, **OPENAI_SAMPLE)
+    gemini_sampler = TextSampler(total_pages, anchors=anchors, **GEMINI_SAMPLE) if use_gemini else None
+
+    async for page in pages:
+        openai_sampler.add(page)
+        if gemini_sampler:
+            gemini_sampler.add(page)
+
+    openai_sample = openai_sampler.text()
+    print(f"Streamed {openai_sampler.page_index} pages ({openai_sampler.total_chars} characters) for analysis")
+
+    # The excerpt stands in for the full content (used by the placeholder fallback)
+    book_content = {"metadata": metadata, "content": [{"page": 1, "content": openai_sample}]}
+
+    if use_gemini:
+        try:
+            return await analyze_with_gemini(book_content, sample_text=gemini_sampler.text())
+        except Exception as e:
+            print(f"Gemini analysis failed: {str(e)}. Falling back to OpenAI.")
+    return await analyze_with_openai(book_content, sample_text=openai_sample)
+
+async def analyze_with_gemini(book_content: dict, sample_text: str = None) -> dict:
     """
     Use Google's Gemini for deep contextual analysis of the book
     """
@@ -40,18 +178,9 @@ async def analyze_with_gemini(book_content: dict) -> dict:
     # Configure Gemini
     genai.configure(api_key=api_key)
     
-    # Extract text from the book content
-    book_text = ""
-    for page in book_content["content"]:
-        book_text += page["content"] + "\n\n"
-    
-    # For large books, take strategic samples
-    sample_text = book_text
-    if len(book_text) > 30000:  # Gemini can handle more context
-        first_part = book_text[:8000]
-        middle_part = book_text[len(book_text)//2-4000:len(book_text)//2+4000]
-        last_part = book_text[-8000:]
-        sample_text = f"{first_part}\n\n[...]\n\n{middle_part}\n\n[...]\n\n{last_part}"
+    # For large books, take strategic samples (Gemini can handle more context)
+    if sample_text is None:
+        sample_text = sample_book_text(book_content, GEMINI_SAMPLE)
     
     print(f"Analyzing book with Gemini: {len(sample_text)} characters of text")
     
@@ -143,23 +272,23 @@ async def analyze_with_gemini(book_content: dict) -> dict:
     """
     
     # Create a Gemini model instance with thinking capabilities
-    model = genai.GenerativeModel('gemini-2.0-flash-thinking-exp-01-21')
+    model = genai.GenerativeModel(GEMINI_MODEL)
     
     # Generate content with the model
-    response = model.generate_content(prompt)
+    with span("llm", "analysis_gemini", model=GEMINI_MODEL) as call:
+        response = model.generate_content(prompt)
+        usage = getattr(response, "usage_metadata", None)
+        call.set(prompt_tokens=getattr(usage, "prompt_token_count", None),
+                 completion_tokens=getattr(usage, "candidates_token_count", None))
     
     # Process the response
     try:
-        # Extract the JSON part from the response
-        analysis_text = response.text
-        
-        # Look for JSON content within the response
-        json_match = re.search(r'```json\s*(.*?)\s*```', analysis_text, re.DOTALL)
-        if json_match:
-            analysis_text = json_match.group(1)
-        
-        # Try to parse as JSON
-        analysis_data = json.loads(analysis_text)
+        # Parse the JSON in the response (usually in a ```json fence), keeping what's complete
+        parsed = parse_json(response.text)
+        parsed.log("analysis")
+        if not isinstance(parsed.value, dict):
+            raise ValueError("no JSON object in the response")
+        analysis_data = parsed.value
         
         # Validate and clean up the analysis data
         analysis_data = validate_analysis_data(analysis_data, book_content)
@@ -171,7 +300,7 @@ async def analyze_with_gemini(book_content: dict) -> dict:
         print(f"Response preview: {response.text[:200]}...")
         raise e
 
-async def analyze_with_openai(book_content: dict) -> dict:
+async def analyze_with_openai(book_content: dict, sample_text: str = None) -> dict:
     """
     Use OpenAI for book analysis as a fallback
     """
@@ -180,25 +309,15 @@ async def analyze_with_openai(book_content: dict) -> dict:
         api_key = os.environ.get("OPENAI_API_KEY", "your-openai-api-key")
         client = AsyncOpenAI(api_key=api_key)
         
-        # Extract text from the book content
-        book_text = ""
-        for page in book_content["content"]:
-            book_text += page["content"] + "\n\n"
-        
-        # Better text sampling for large books
-        sample_text = book_text
-        if len(book_text) > 12000:
-            # Take beginning, 2 middle sections, and end
-            first_part = book_text[:3000]
-            middle_part1 = book_text[len(book_text)//3:len(book_text)//3 + 3000]
-            middle_part2 = book_text[2*len(book_text)//3:2*len(book_text)//3 + 3000]
-            last_part = book_text[-3000:]
-            sample_text = f"{first_part}\n\n[...]\n\n{middle_part1}\n\n[...]\n\n{middle_part2}\n\n[...]\n\n{last_part}"
+        # Better text sampling for large books: beginning, 2 middle sections, and end
+        if sample_text is None:
+            sample_text = sample_book_text(book_content, OPENAI_SAMPLE)
         
         print(f"Analyzing book with OpenAI: {len(sample_text)} characters of text")
         
         # Create a comprehensive prompt for literary analysis
-        prompt = f"""
+        def render(sample_text):
+            return f"""
         You are a literary analyst with expertise in deep narrative analysis. Analyze this book excerpt and create a detailed breakdown suitable for adaptation into an interactive visual novel.
 
         BOOK METADATA:
@@ -278,54 +397,43 @@ async def analyze_with_openai(book_content: dict) -> dict:
         
         Provide DEEP, RICH DETAILS for each element. No generalities or placeholders.
         """
+
+        builder = PromptBuilder(router.model("analysis"), INPUT_BUDGETS["analysis"])
+        prompt = builder.slot("sample_text", [sample_text], truncate=True).render(render)
+        print(f"Analysis prompt: {builder.report['prompt_tokens']} tokens")
         
-        # Make the API call to OpenAI with increased token limits
-        response = await client.chat.completions.create(
-            model="gpt-4-turbo",  # Using the most capable model for analysis
+        # Make the API call to OpenAI; the model and completion limit come from the call site's settings.
+        # A truncated or malformed response keeps every complete character, setting, etc.
+        analysis_data = await router.complete(
+            client, "analysis", json_parser("analysis"), analysis_is_valid,
             response_format={"type": "json_object"},
             messages=[
                 {"role": "system", "content": "You are a literary analyst with expertise in deep narrative analysis."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,  # Lower temperature for more consistent formatting
-            max_tokens=3500,  # Increased to ensure complete response
             timeout=90  # Extended timeout for longer processing
         )
-        
-        # Parse the response with better error handling
-        analysis_text = response.choices[0].message.content
-        
-        try:
-            print(f"Received analysis from OpenAI ({len(analysis_text)} chars)")
-            analysis_data = json.loads(analysis_text)
-            
-            # Validate and clean up the analysis data
-            analysis_data = validate_analysis_data(analysis_data, book_content)
-            return analysis_data
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error at position {e.pos}: {e.msg}")
-            print(f"Response snippet near error: '{analysis_text[max(0, e.pos-30):min(len(analysis_text), e.pos+30)]}'")
-            
-            # Try to fix the JSON
-            try:
-                fixed_text = attempt_json_repair(analysis_text)
-                if fixed_text != analysis_text:
-                    analysis_data = json.loads(fixed_text)
-                    print("Successfully fixed and parsed JSON")
-                    analysis_data = validate_analysis_data(analysis_data, book_content)
-                    return analysis_data
-            except:
-                print("Failed to fix JSON, falling back to placeholder")
-            
-            # Fall back to placeholder
+        if not isinstance(analysis_data, dict):
+            print("Nothing could be salvaged from the response, falling back to placeholder")
             return await placeholder_analysis(book_content)
+        
+        # Validate and clean up the analysis data, filling in what was lost
+        return validate_analysis_data(analysis_data, book_content)
             
     except Exception as e:
         print(f"Error in OpenAI book analysis: {str(e)}")
         # Return placeholder analysis on any error
         return await placeholder_analysis(book_content)
 
+def analysis_is_valid(analysis_data) -> bool:
+    """Whether an analysis has the characters, settings and plot asked for (escalates it otherwise)"""
+    return (isinstance(analysis_data, dict)
+            and isinstance(analysis_data.get("characters"), list) and len(analysis_data["characters"]) > 0
+            and all(isinstance(char, dict) and char.get("name") for char in analysis_data["characters"])
+            and isinstance(analysis_data.get("settings"), list) and len(analysis_data["settings"]) > 0
+            and isinstance(analysis_data.get("plot"), dict) and bool(analysis_data["plot"].get("summary")))
+
 def validate_analysis_data(analysis_data, book_content):
     """Ensure the analysis data has all required fields and is properly formatted"""
     # Ensure metadata is included
@@ -423,26 +531,6 @@ def validate_analysis_data(analysis_data, book_content):
     
     return analysis_data
 
-# Helper function to attempt to repair broken JSON
-def attempt_json_repair(json_text):
-    """Attempt to fix common JSON errors"""
-    # Try to fix unclosed quotes
-    json_text = re.sub(r'([^\\])"([^"]*)$', r'\1"\2"', json_text)
-    
-    # Try to fix missing closing braces
-    open_braces = json_text.count('{')
-    close_braces = json_text.count('}')
-    if open_braces > close_braces:
-        json_text += '}' * (open_braces - close_braces)
-    
-    # Try to fix missing closing brackets
-    open_brackets = json_text.count('[')
-    close_brackets = json_text.count(']')
-    if open_brackets > close_brackets:
-        json_text += ']' * (open_brackets - close_brackets)
-    
-    return json_text
-
 # Enhanced placeholder analysis for when AI fails
 async def placeholder_analysis(book_content: dict) -> dict:
     """Improved fallback analysis if AI fails"""
@@ -570,5 +658,6 @@ async def placeholder_analysis(book_content: dict) -> dict:
             ]
         },
         "themes": ["personal growth", "conflict and resolution", "challenges and triumphs", "relationships"],
-        "tone": "immersive and engaging"
+        "tone": "immersive and engaging",
+        "placeholder": True  # Marks fallback output so it is never cached
     }
\ No newline at end of file
@@ -0,0 +1,64 @@
+# File: book_events.py
+import asyncio
+import json
+import os
+
+# Idle streams get a comment line this often so proxies keep the connection open
+BOOK_EVENTS_KEEPALIVE_SECONDS = float(os.environ.get("BOOK_EVENTS_KEEPALIVE_SECONDS", "15"))
+
+# Streams re-read the book this often even without a notification,
+# which is how changes made by workers in other processes show up
+BOOK_EVENTS_POLL_SECONDS = float(os.environ.get("BOOK_EVENTS_POLL_SECONDS", "2"))
+
+# Book record fields sent to progress subscribers
+PROGRESS_FIELDS = (
+    "id", "status", "progress", "error", "script_id",
+    "pages_extracted", "pages_total", "scenes_generated", "scenes_total"
+)
+
+# Statuses after which a book no longer changes
+FINAL_STATUSES = ("ready", "error")
+
+class BookEvents:
+    """
+    Wakes up progress streams when a book changes. Streams re-read the book
+    after each wake-up (or keep-alive timeout), so a missed notification
+    only delays an update instead of losing it.
+    """
+
+    def __init__(self):
+        self._waiters = {}  # Book ID -> set of (loop, asyncio.Event)
+
+    def notify(self, book_id: str):
+        """Wake every stream watching book_id; safe to call from any thread"""
+        for loop, event in list(self._waiters.get(book_id, ())):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The stream's loop has shut down
+                pass
+
+    async def wait(self, book_id: str, timeout: float) -> bool:
+        """Wait until book_id changes; False if timeout passed first"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._waiters.setdefault(book_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(book_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[book_id]
+
+def progress_snapshot(book: dict) -> dict:
+    return {field: book.get(field) for field in PROGRESS_FIELDS if field in book}
+
+def format_event(event: str, data: dict) -> str:
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+book_events = BookEvents()
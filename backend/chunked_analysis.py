@@ -0,0 +1,313 @@
+# File: chunked_analysis.py
+"""
+Map-reduce book analysis over the full text.
+
+The book is cut into chunks at chapter starts, taken from the structure
+index when there is one (or when a chunk reaches its size budget). Each chunk is analyzed on its own, several at a time, and the
+per-chunk characters, settings and plot notes are merged into the schema
+checked by book_analyzer.validate_analysis_data. Chunk summaries are then
+condensed a group at a time, so the reduce step takes a few rounds no
+matter how long the book is.
+"""
+import asyncio
+import os
+import re
+from collections import Counter
+
+from openai import AsyncOpenAI
+
+from book_analyzer import validate_analysis_data, placeholder_analysis
+from pdf_processor import find_headings
+from llm_client import truncate_to_tokens, PromptBuilder, INPUT_BUDGETS
+from model_router import router
+from json_stream import json_parser
+
+# Target size of one chunk; a chapter start closes a chunk early once it is half full
+ANALYSIS_CHUNK_CHARS = int(os.environ.get("ANALYSIS_CHUNK_CHARS", "24000"))
+
+# Chunk analyses (and summary merges) in flight at once for one book
+ANALYSIS_CONCURRENCY = int(os.environ.get("ANALYSIS_CONCURRENCY", "8"))
+
+# Number of summaries condensed into one in each reduce round
+SUMMARY_FANOUT = 8
+
+# Caps on the merged analysis
+MAX_CHARACTERS = 12
+MAX_SETTINGS = 8
+MAX_KEY_POINTS = 16
+MAX_BRANCHING_POINTS = 8
+
+CHUNK_PROMPT = """
+You are a literary analyst. Below is part {index} of the book "{title}" by {author}.
+Extract what THIS PART shows; later parts are analyzed separately and merged.
+
+TEXT:
+{text}
+
+Respond with a JSON object:
+{{
+  "characters": [
+    {{
+      "name": "Full Name",
+      "role": "Role in story",
+      "description": "Physical description",
+      "personality": "Personality traits",
+      "speech_patterns": "How they typically speak",
+      "motivations": "What drives them",
+      "relationships": "Connections to other characters",
+      "importance": "high/medium/low"
+    }}
+  ],
+  "settings": [
+    {{
+      "name": "Setting Name",
+      "description": "Physical description",
+      "atmosphere": "Mood and feeling of the place",
+      "significance": "Importance to the plot"
+    }}
+  ],
+  "plot": {{
+    "summary": "What happens in this part",
+    "central_conflict": "Main tension in this part",
+    "key_points": ["Plot point", "..."],
+    "branching_points": [{{"description": "Potential choice point", "options": ["Option 1", "Option 2"]}}]
+  }},
+  "themes": ["theme"],
+  "tone": "Tone of this part"
+}}
+Only include characters and settings that actually appear in this part.
+"""
+
+SUMMARY_PROMPT = """
+Below are consecutive summaries of parts of the book "{title}" by {author}, in order.
+Combine them into one coherent summary of the whole span, and name its central conflict.
+
+{summaries}
+
+Respond with a JSON object: {{"summary": "...", "central_conflict": "..."}}
+"""
+
+def starts_chapter(text: str) -> bool:
+    """True if a page opens with a chapter heading"""
+    head = text.lstrip()[:200]
+    return any(offset == 0 for offset, _, _ in find_headings(head))
+
+async def chunk_pages(pages, max_chars: int = ANALYSIS_CHUNK_CHARS, chapter_pages=None):
+    """
+    Group an async stream of {"page", "content"} records into text chunks of
+    about max_chars, yielding each chunk as soon as it is complete.
+    Chunks break at chapter starts once they are half full; chapter_pages
+    (0-based page indexes) lists them, otherwise pages are checked for headings.
+    """
+    chapter_pages = set(chapter_pages) if chapter_pages else None
+    parts = []
+    size = 0
+    async for page in pages:
+        text = page["content"]
+        chapter = page["page"] - 1 in chapter_pages if chapter_pages is not None else starts_chapter(text)
+        if parts and (size + len(text) > max_chars or (size >= max_chars // 2 and chapter)):
+            yield "\n\n".join(parts)
+            parts, size = [], 0
+        # A single oversized page is split rather than sent whole
+        while len(text) > max_chars:
+            yield text[:max_chars]
+            text = text[max_chars:]
+        parts.append(text)
+        size += len(text)
+    if parts:
+        yield "\n\n".join(parts)
+
+def chunk_is_valid(result) -> bool:
+    """A chunk analysis needs its lists of characters and settings and a summary of the part"""
+    return (isinstance(result, dict) and isinstance(result.get("characters"), list)
+            and isinstance(result.get("settings"), list)
+            and isinstance(result.get("plot"), dict) and bool(result["plot"].get("summary")))
+
+def summary_is_valid(result) -> bool:
+    return isinstance(result, dict) and bool(result.get("summary"))
+
+async def complete_json(client, prompt: str, call_site: str, valid):
+    # A cut-off response still yields its complete characters, settings, etc.
+    result = await router.complete(
+        client, call_site, json_parser(call_site), valid,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": "You are a literary analyst with expertise in deep narrative analysis."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        timeout=90
+    )
+    return result if isinstance(result, dict) else None
+
+async def analyze_chunk(client, metadata: dict, text: str, index: int):
+    """Analyze one chunk; returns its partial analysis, or None on failure"""
+    # An oversized chunk is cut down to the prompt budget rather than rejected
+    prompt = PromptBuilder(router.model("analysis_chunk"), INPUT_BUDGETS["analysis_chunk"]).slot("text", [text], truncate=True).render(
+        lambda text: CHUNK_PROMPT.format(
+            index=index + 1, text=text,
+            title=metadata.get("title", "Unknown"), author=metadata.get("author", "Unknown")
+        )
+    )
+    try:
+        result = await complete_json(client, prompt, "analysis_chunk", chunk_is_valid)
+        if not isinstance(result, dict):
+            print(f"Chunk {index + 1}: unusable analysis response, skipping")
+            return None
+        return result
+    except Exception as e:
+        print(f"Chunk {index + 1}: analysis failed: {str(e)}")
+        return None
+
+def name_key(name: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9']+", str(name).lower()))
+
+def merge_entities(chunk_lists, fields, limit):
+    """
+    Merge the characters (or settings) found in each chunk. Entries with the
+    same name, or whose name is a leading part of a longer one ("Elizabeth"
+    and "Elizabeth Bennet"), are one entity. For each field the most detailed
+    description wins. Entities seen in the most chunks come first.
+    """
+    merged = {}   # Name key -> merged entry
+    seen = Counter()
+    for entities in chunk_lists:
+        for entity in entities:
+            if not isinstance(entity, dict) or not entity.get("name"):
+                continue
+            key = name_key(entity["name"])
+            if not key:
+                continue
+            match = next((k for k in merged if k == key or k.startswith(key + " ") or key.startswith(k + " ")), None)
+            if match is None:
+                merged[key] = dict(entity)
+                match = key
+            else:
+                current = merged[match]
+                for field in fields:
+                    value = entity.get(field)
+                    if isinstance(value, str) and len(value) > len(str(current.get(field, ""))):
+                        current[field] = value
+                # Keep the fullest form of the name
+                if len(key) > len(match) and key not in merged:
+                    current["name"] = entity["name"]
+                    merged[key] = merged.pop(match)
+                    seen[key] = seen.pop(match)
+                    match = key
+            seen[match] += 1
+
+    ranked = sorted(merged, key=lambda k: seen[k], reverse=True)[:limit]
+    return [dict(merged[key], id=key.replace(" ", "_"), mentions=seen[key]) for key in ranked]
+
+def spread(items: list, limit: int) -> list:
+    """Pick up to limit items evenly across the list, keeping their order"""
+    if len(items) <= limit:
+        return items
+    step = len(items) / limit
+    return [items[int(i * step)] for i in range(limit)]
+
+async def reduce_summaries(client, metadata: dict, plots: list, semaphore) -> dict:
+    """Condense per-chunk summaries, SUMMARY_FANOUT at a time, until one is left"""
+    level = [{"summary": p.get("summary", ""), "central_conflict": p.get("central_conflict", "")}
+             for p in plots if p.get("summary")]
+    while len(level) > 1:
+        groups = [level[i:i + SUMMARY_FANOUT] for i in range(0, len(level), SUMMARY_FANOUT)]
+
+        async def condense(group):
+            if len(group) == 1:
+                return group[0]
+            # Each part keeps its summary up to an even share of the budget
+            share = INPUT_BUDGETS["analysis_summary"] // len(group)
+            summaries = "\n\n".join(
+                f"PART {i + 1}: {truncate_to_tokens(item['summary'], share, router.model('analysis_summary'))}" for i, item in enumerate(group)
+            )
+            prompt = SUMMARY_PROMPT.format(
+                summaries=summaries, title=metadata.get("title", "Unknown"), author=metadata.get("author", "Unknown")
+            )
+            try:
+                async with semaphore:
+                    result = await complete_json(client, prompt, "analysis_summary", summary_is_valid)
+                if isinstance(result, dict) and result.get("summary"):
+                    return result
+            except Exception as e:
+                print(f"Summary merge failed: {str(e)}")
+            # Fall back to the parts' summaries side by side
+            return {"summary": " ".join(item["summary"] for item in group),
+                    "central_conflict": group[0].get("central_conflict", "")}
+
+        level = await asyncio.gather(*[condense(group) for group in groups])
+    return level[0] if level else {}
+
+async def merge_chunk_analyses(client, metadata: dict, results: list, semaphore) -> dict:
+    """Merge per-chunk analyses, in book order, into a single analysis"""
+    character_fields = ["role", "description", "personality", "speech_patterns", "motivations", "relationships"]
+    characters = merge_entities([r.get("characters") or [] for r in results], character_fields, MAX_CHARACTERS)
+    for char in characters:
+        # Characters who recur through the book are the important ones
+        if char["mentions"] >= max(2, len(results) // 3):
+            char["importance"] = "high"
+
+    setting_fields = ["description", "atmosphere", "significance"]
+    settings = merge_entities([r.get("settings") or [] for r in results], setting_fields, MAX_SETTINGS)
+
+    plots = [r["plot"] for r in results if isinstance(r.get("plot"), dict)]
+    key_points = [point for plot in plots for point in plot.get("key_points") or [] if isinstance(point, str)]
+    branching_points = [point for plot in plots for point in plot.get("branching_points") or [] if isinstance(point, dict)]
+    overall = await reduce_summaries(client, metadata, plots, semaphore)
+
+    themes = Counter(theme.lower() for r in results for theme in r.get("themes") or [] if isinstance(theme, str))
+    tones = Counter(r["tone"] for r in results if isinstance(r.get("tone"), str) and r["tone"])
+
+    return {
+        "characters": characters,
+        "settings": settings,
+        "plot": {
+            "summary": overall.get("summary", ""),
+            "central_conflict": overall.get("central_conflict", ""),
+            "key_points": spread(key_points, MAX_KEY_POINTS),
+            "branching_points": spread(branching_points, MAX_BRANCHING_POINTS)
+        },
+        "themes": [theme for theme, _ in themes.most_common(8)],
+        "tone": tones.most_common(1)[0][0] if tones else ""
+    }
+
+async def analyze_book_chunked(metadata: dict, pages, concurrency: int = ANALYSIS_CONCURRENCY, chapter_pages=None) -> dict:
+    """
+    Analyze a whole book from an async stream of {"page", "content"} records.
+    Chunks are sent for analysis as soon as they fill up, at most
+    `concurrency` at a time, so pages are read while earlier chunks run.
+    chapter_pages are the 0-based pages where chapters start, if known.
+    """
+    api_key = os.environ.get("OPENAI_API_KEY", "your-openai-api-key")
+    client = AsyncOpenAI(api_key=api_key)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(text, index):
+        async with semaphore:
+            return await analyze_chunk(client, metadata, text, index)
+
+    tasks = []
+    first_text = ""
+    async for text in chunk_pages(pages, chapter_pages=chapter_pages):
+        if not tasks:
+            first_text = text
+        # Wait for a free slot before reading further, so memory stays bounded
+        while len(tasks) - sum(task.done() for task in tasks) >= concurrency * 2:
+            await asyncio.wait([task for task in tasks if not task.done()], return_when=asyncio.FIRST_COMPLETED)
+        tasks.append(asyncio.create_task(run(text, len(tasks))))
+
+    results = [result for result in await asyncio.gather(*tasks) if result]
+    print(f"Analyzed {len(results)} of {len(tasks)} chunks")
+
+    # The first chunk stands in for the full content (used by the placeholder fallback)
+    book_content = {"metadata": metadata, "content": [{"page": 1, "content": first_text}]}
+    if not results:
+        return await placeholder_analysis(book_content)
+
+    analysis = await merge_chunk_analyses(client, metadata, results, semaphore)
+    return validate_analysis_data(analysis, book_content)
+
+async def iter_book_pages(book_content: dict):
+    """Stream the pages of an already extracted book"""
+    for page in book_content["content"]:
+        yield page
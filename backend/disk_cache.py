@@ -0,0 +1,124 @@
+# File: disk_cache.py
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+def sha256_file(file_path: str) -> str:
+    """Hex SHA-256 of a file's bytes, read in blocks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DiskCache:
+    """
+    JSON cache stored as gzip files in a directory, one file per key.
+    Entries are evicted least-recently-used first once the directory
+    grows past max_bytes; a file's mtime records its last use.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith(".json.gz"):
+                self._sizes[name] = os.path.getsize(os.path.join(directory, name))
+        self._total = sum(self._sizes.values())
+
+    def _filename(self, key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json.gz"
+
+    def get(self, key: str):
+        """Return the cached value for key, or None"""
+        name = self._filename(key)
+        path = os.path.join(self.directory, name)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                value = json.load(file)
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Discarding unreadable cache entry {name}: {str(e)}")
+            self.delete(key)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        """Store a JSON-serializable value under key"""
+        name = self._filename(key)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total += size - self._sizes.get(name, 0)
+            self._sizes[name] = size
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def delete(self, key: str):
+        name = self._filename(key)
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+        self._total -= self._sizes.pop(name, 0)
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        def last_used(name):
+            try:
+                return os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                return 0
+
+        for name in sorted(self._sizes, key=last_used):
+            if self._total <= self.max_bytes:
+                break
+            self._remove(name)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._sizes),
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+# Cache for PDF extraction and book analysis results
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+BOOK_CACHE_MAX_BYTES = int(os.environ.get("BOOK_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+book_cache = DiskCache(os.path.join(CACHE_DIR, "books"), BOOK_CACHE_MAX_BYTES)
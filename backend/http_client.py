@@ -0,0 +1,95 @@
+# File: http_client.py
+import asyncio
+import hashlib
+import os
+import time
+from collections import deque
+
+import aiofiles
+import aiohttp
+
+# Connection pool and timeout settings for outbound fetches
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "32"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", "8"))
+HTTP_KEEPALIVE_SECONDS = float(os.environ.get("HTTP_KEEPALIVE_SECONDS", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_TOTAL_TIMEOUT = float(os.environ.get("HTTP_TOTAL_TIMEOUT", "120"))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Totals across all fetches, plus the most recent individual fetches
+FETCH_STATS = {"fetches": 0, "failures": 0, "bytes": 0, "seconds": 0.0}
+RECENT_FETCHES = deque(maxlen=100)
+
+_session = None
+_session_loop = None
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Return the shared client session for the running event loop.
+    Connections are pooled and kept alive between fetches to the same host.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS,
+            limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _session_loop = loop
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def _record_fetch(url, status, size, seconds, error=None):
+    FETCH_STATS["fetches"] += 1
+    FETCH_STATS["bytes"] += size
+    FETCH_STATS["seconds"] += seconds
+    if error is not None:
+        FETCH_STATS["failures"] += 1
+    record = {"url": url, "status": status, "bytes": size, "seconds": round(seconds, 3), "error": error}
+    RECENT_FETCHES.append(record)
+    return record
+
+async def download_to_file(url: str, path: str) -> dict:
+    """
+    Stream a URL to a file without holding the body in memory.
+    Returns the fetch record (status, bytes, seconds) with the body's
+    SHA-256 as "sha256"; raises on HTTP or network errors.
+    """
+    start = time.perf_counter()
+    size = 0
+    status = None
+    digest = hashlib.sha256()
+    try:
+        async with get_session().get(url) as response:
+            status = response.status
+            response.raise_for_status()
+            async with aiofiles.open(path, "wb") as file:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await file.write(chunk)
+    except Exception as e:
+        _record_fetch(url, status, size, time.perf_counter() - start, error=str(e) or type(e).__name__)
+        raise
+
+    record = _record_fetch(url, status, size, time.perf_counter() - start)
+    print(f"Fetched {size} bytes in {record['seconds']:.2f}s from {url[:60]}")
+    return dict(record, sha256=digest.hexdigest())
+
+def fetch_stats() -> dict:
+    fetches = FETCH_STATS["fetches"]
+    return dict(
+        FETCH_STATS,
+        seconds=round(FETCH_STATS["seconds"], 3),
+        average_seconds=round(FETCH_STATS["seconds"] / fetches, 3) if fetches else 0.0,
+        recent=list(RECENT_FETCHES)[-10:]
+    )
@@ -0,0 +1,154 @@
+# File: image_cache.py
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from disk_cache import CACHE_DIR
+
+# Maximum number of cached prompts; least recently used ones are forgotten first.
+# Image files themselves stay on disk because saved scripts still reference them.
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "5000"))
+
+# Prompts at least this similar (Jaccard over word shingles) share one image
+IMAGE_SIMILARITY_THRESHOLD = float(os.environ.get("IMAGE_SIMILARITY_THRESHOLD", "0.8"))
+
+# Backgrounds describe a place, not a book's character, so books can share them
+SHARED_NAMESPACE = "shared"
+SHARE_BACKGROUNDS = os.environ.get("SHARE_BACKGROUNDS_ACROSS_BOOKS", "true").lower() in ("1", "true", "yes")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    namespace TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    url TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (namespace, kind, key)
+);
+CREATE INDEX IF NOT EXISTS idx_images_last_used ON images(last_used);
+"""
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace"""
+    return " ".join(re.findall(r"[a-z0-9']+", prompt.lower()))
+
+def prompt_shingles(normalized: str) -> frozenset:
+    """Words and word pairs of a normalized prompt"""
+    words = normalized.split()
+    return frozenset(words) | frozenset(zip(words, words[1:]))
+
+def similarity(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class ImageCache:
+    """
+    Persistent map from (namespace, kind, normalized prompt hash) to the URL
+    of a stored image. Lookups fall back to the most similar cached prompt in
+    the same namespace, so near-identical prompts reuse an existing render.
+    """
+
+    def __init__(self, path: str, max_entries: int = IMAGE_CACHE_MAX_ENTRIES,
+                 threshold: float = IMAGE_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.stats = {"hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        # Shingles of the cached prompts per (namespace, kind), loaded on first use
+        self._shingles = {}
+
+    def _namespace_shingles(self, namespace, kind):
+        index = self._shingles.get((namespace, kind))
+        if index is None:
+            rows = self._conn.execute(
+                "SELECT key, prompt FROM images WHERE namespace = ? AND kind = ?", (namespace, kind)
+            ).fetchall()
+            index = {key: prompt_shingles(prompt) for key, prompt in rows}
+            self._shingles[(namespace, kind)] = index
+        return index
+
+    def get(self, namespace: str, kind: str, prompt: str, fuzzy: bool = True):
+        """Return the URL cached for prompt (or, if fuzzy, a near-identical one), or None"""
+        normalized = normalize_prompt(prompt)
+        key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url FROM images WHERE namespace = ? AND kind = ? AND key = ?", (namespace, kind, key)
+            ).fetchone()
+            if row:
+                self.stats["hits"] += 1
+            elif not fuzzy:
+                self.stats["misses"] += 1
+                return None
+            else:
+                match = self.most_similar(self._namespace_shingles(namespace, kind), prompt_shingles(normalized))
+                if match is None:
+                    self.stats["misses"] += 1
+                    return None
+                key = match
+                row = self._conn.execute(
+                    "SELECT url FROM images WHERE namespace = ? AND kind = ? AND key = ?", (namespace, kind, key)
+                ).fetchone()
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                self.stats["similar_hits"] += 1
+
+            self._conn.execute(
+                "UPDATE images SET last_used = ? WHERE namespace = ? AND kind = ? AND key = ?",
+                (time.time(), namespace, kind, key)
+            )
+            return row[0]
+
+    def most_similar(self, candidates: dict, shingles: frozenset):
+        """Key of the candidate whose shingles are most similar, if above the threshold"""
+        best_key, best_score = None, self.threshold
+        for key, other in candidates.items():
+            score = similarity(shingles, other)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def put(self, namespace: str, kind: str, prompt: str, url: str):
+        normalized = normalize_prompt(prompt)
+        key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO images (namespace, kind, key, prompt, url, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, kind, key, normalized, url, time.time())
+            )
+            self._namespace_shingles(namespace, kind)[key] = prompt_shingles(normalized)
+            self._evict()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        rows = self._conn.execute(
+            "SELECT namespace, kind, key FROM images ORDER BY last_used LIMIT ?", (excess,)
+        ).fetchall()
+        for namespace, kind, key in rows:
+            self._conn.execute(
+                "DELETE FROM images WHERE namespace = ? AND kind = ? AND key = ?", (namespace, kind, key)
+            )
+            self._shingles.get((namespace, kind), {}).pop(key, None)
+            self.stats["evictions"] += 1
+
+def background_namespace(book_id: str) -> str:
+    return SHARED_NAMESPACE if SHARE_BACKGROUNDS or not book_id else book_id
+
+def character_namespace(book_id: str) -> str:
+    # Portraits are per book: two books' "protagonist" are different people
+    return book_id or "unscoped"
+
+image_cache = ImageCache(os.path.join(CACHE_DIR, "images.db"))
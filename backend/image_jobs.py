@@ -0,0 +1,109 @@
+# File: image_jobs.py
+import asyncio
+import os
+import random
+import time
+
+import replicate
+
+from telemetry import span
+
+# Model used for all generated backgrounds and portraits
+REPLICATE_MODEL = "bytedance/sdxl-lightning-4step:5599ed30703defd1d160a25a63321b4dec97101d98b4674bcc56e41f62f35637"
+
+# Scheduler limits (the Replicate client also honours REPLICATE_BASE_URL, e.g. for a local fake server)
+IMAGE_CONCURRENCY = int(os.environ.get("IMAGE_CONCURRENCY", "4"))
+IMAGE_RATE_PER_SECOND = float(os.environ.get("IMAGE_RATE_PER_SECOND", "2"))
+IMAGE_RATE_BURST = int(os.environ.get("IMAGE_RATE_BURST", "4"))
+IMAGE_MAX_RETRIES = int(os.environ.get("IMAGE_MAX_RETRIES", "3"))
+IMAGE_RETRY_BACKOFF = float(os.environ.get("IMAGE_RETRY_BACKOFF", "1.0"))
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ImageJobScheduler:
+    """
+    Runs image generation jobs off the event loop with a cap on concurrent
+    jobs, a token-bucket rate limit on requests to Replicate, and retries
+    with exponential backoff and jitter.
+    """
+
+    def __init__(self, concurrency=IMAGE_CONCURRENCY, rate_per_second=IMAGE_RATE_PER_SECOND,
+                 burst=IMAGE_RATE_BURST, max_retries=IMAGE_MAX_RETRIES, backoff=IMAGE_RETRY_BACKOFF):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._client = None
+        self.stats = {"submitted": 0, "succeeded": 0, "failed": 0, "retries": 0}
+
+    def _run_model(self, prompt: str):
+        """Blocking Replicate call; runs in a worker thread"""
+        if self._client is None:
+            self._client = replicate.Client()
+        return self._client.run(
+            REPLICATE_MODEL,
+            input={
+                "width": 1024,
+                "height": 1024,
+                "prompt": prompt,
+                "scheduler": "K_EULER",
+                "num_outputs": 1,
+                "guidance_scale": 0,
+                "negative_prompt": "worst quality, low quality, blurry, distorted features",
+                "num_inference_steps": 4
+            },
+            use_file_output=False
+        )
+
+    async def generate(self, prompt: str):
+        """Generate one image and return its URL, or None once retries are exhausted"""
+        self.stats["submitted"] += 1
+        async with self._semaphore:
+            with span("image", "generate") as job:
+                for attempt in range(self.max_retries + 1):
+                    await self._bucket.acquire()
+                    try:
+                        output = await asyncio.to_thread(self._run_model, prompt)
+                        # The output is a list of URLs
+                        if output and len(output) > 0:
+                            self.stats["succeeded"] += 1
+                            return str(output[0])  # Return the first image URL
+                        self.stats["failed"] += 1
+                        job.fail("no output")
+                        return None
+                    except Exception as e:
+                        if attempt == self.max_retries:
+                            print(f"Error generating image with Replicate: {str(e)}")
+                            self.stats["failed"] += 1
+                            job.fail(e)
+                            return None
+                        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                        print(f"Image generation failed ({str(e)}), retrying in {delay:.1f}s")
+                        self.stats["retries"] += 1
+                        job.set(retries=attempt + 1)
+                        await asyncio.sleep(delay)
+
+# Shared scheduler, so limits apply across every book processed by this worker
+image_scheduler = ImageJobScheduler()
@@ -0,0 +1,78 @@
+# File: image_store.py
+import asyncio
+import os
+import uuid
+
+from PIL import Image
+
+from http_client import download_to_file
+from telemetry import span
+
+# Generated images are written here and served by the static files mount
+IMAGE_DIR = os.path.join("static", "images")
+IMAGE_URL_PATH = "/images"
+
+# Optional absolute prefix for image URLs, e.g. "https://plottwist-backend.onrender.com"
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+
+# Images are shrunk to fit this box and stored as JPEG
+MAX_IMAGE_SIZE = (800, 800)
+JPEG_QUALITY = 85
+
+# Downloads and half-written images are staged here, outside the served static root
+# (on the same filesystem as IMAGE_DIR, so finished files can be moved into place)
+IMAGE_STAGING_DIR = os.environ.get("IMAGE_STAGING_DIR", os.path.join("cache", "image-staging"))
+
+os.makedirs(IMAGE_DIR, exist_ok=True)
+os.makedirs(IMAGE_STAGING_DIR, exist_ok=True)
+
+def image_url(name: str) -> str:
+    return f"{PUBLIC_BASE_URL}{IMAGE_URL_PATH}/{name}"
+
+def is_image_reference(value) -> bool:
+    """True if a scene field already points at an image rather than describing one"""
+    return isinstance(value, str) and (
+        value.startswith("data:") or value.startswith(f"{PUBLIC_BASE_URL}{IMAGE_URL_PATH}/")
+    )
+
+def _write_jpeg(source_path: str, path: str):
+    """Resize an image to a reasonable size and save it as JPEG at path"""
+    with Image.open(source_path) as image:
+        image.thumbnail(MAX_IMAGE_SIZE)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # Write to a staging file first so a half-written file is never served; the name
+        # is unique, as the same content may be stored by two requests at once
+        tmp_path = os.path.join(IMAGE_STAGING_DIR, f"{uuid.uuid4().hex}.jpg.tmp")
+        try:
+            image.save(tmp_path, format="JPEG", quality=JPEG_QUALITY)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+async def store_image_from_url(url: str):
+    """
+    Download an image and store it once under the hash of its content;
+    returns its URL or None. The file name never changes for given content,
+    so it can be cached forever.
+    """
+    download_path = os.path.join(IMAGE_STAGING_DIR, f"download-{uuid.uuid4().hex}")
+    with span("image", "download") as download:
+        try:
+            fetch = await download_to_file(url, download_path)
+            download.set(bytes=fetch["bytes"])
+            name = fetch["sha256"][:32] + ".jpg"
+            path = os.path.join(IMAGE_DIR, name)
+            if not os.path.exists(path):
+                await asyncio.to_thread(_write_jpeg, download_path, path)
+            return image_url(name)
+        except Exception as e:
+            print(f"Error storing image: {str(e)}")
+            download.fail(e)
+            return None
+        finally:
+            if os.path.exists(download_path):
+                os.remove(download_path)
@@ -0,0 +1,213 @@
+# File: job_queue.py
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from storage import DATABASE_PATH, compress_json, decompress_json
+
+# A running job whose worker hasn't checked in for this long is handed to another worker
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "120"))
+
+# Failed jobs are retried until they have been attempted this many times
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# Pipeline stages, in order; each one's output is checkpointed when it finishes
+STAGES = ("extracted", "analyzed", "outlined", "scenes", "images")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    book_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, seq);
+CREATE INDEX IF NOT EXISTS idx_jobs_book_id ON jobs(book_id);
+
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+def new_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class JobQueue:
+    """
+    Durable queue of book processing jobs in SQLite.
+
+    Workers (in this process or others sharing the database file) claim a
+    job with a lease and renew it while they work. If a worker dies, its
+    lease runs out and the job is claimed again, resuming from the last
+    stage checkpoint saved for it.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = JOB_LEASE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    # Jobs
+
+    def enqueue(self, book_id: str) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, book_id, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, book_id, now, now)
+            )
+        return job_id
+
+    def claim(self, worker_id: str):
+        """
+        Take the oldest queued job, or a running one whose lease expired
+        with attempts left (see reap for the others). Returns the job as a dict, or None if there is nothing to do.
+        """
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, book_id, attempts FROM jobs "
+                    "WHERE status = 'queued' OR (status = 'running' AND lease_expires < ? AND attempts < ?) "
+                    "ORDER BY seq LIMIT 1", (now, self.max_attempts)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                job_id, book_id, attempts = row
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = ?, worker_id = ?, lease_expires = ?, updated_at = ? "
+                    "WHERE id = ?", (attempts + 1, worker_id, now + self.lease_seconds, now, job_id)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {"id": job_id, "book_id": book_id, "attempts": attempts + 1, "worker_id": worker_id}
+
+    def reap(self) -> list:
+        """
+        Fail running jobs whose lease expired on their last attempt (their
+        worker died, e.g. killed by the job itself, so fail() never ran).
+        Returns their book IDs.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, book_id, attempts FROM jobs "
+                    "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts)
+                ).fetchall()
+                for job_id, _, attempts in rows:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, lease_expires = NULL, updated_at = ? WHERE id = ?",
+                        (f"Worker stopped responding on attempt {attempts} of {self.max_attempts}", now, job_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [book_id for _, book_id, _ in rows]
+
+    def renew(self, job_id: str, worker_id: str) -> bool:
+        """Extend a job's lease; False if the job no longer belongs to this worker"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+                (now + self.lease_seconds, now, job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', lease_expires = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+            # The checkpoints were only needed to resume this job
+            self._conn.execute("DELETE FROM job_checkpoints WHERE job_id = ?", (job_id,))
+
+    def fail(self, job_id: str, error: str) -> bool:
+        """
+        Record a failed attempt. The job goes back on the queue unless it has
+        used up its attempts; returns True if it will be retried.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            retry = row is not None and row[0] < self.max_attempts
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_expires = NULL, updated_at = ? WHERE id = ?",
+                ("queued" if retry else "failed", error, time.time(), job_id)
+            )
+        return retry
+
+    def book_ids_with_open_jobs(self) -> set:
+        with self._lock:
+            rows = self._conn.execute("SELECT book_id FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        return {row[0] for row in rows}
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    # Checkpoints
+
+    def save_checkpoint(self, job_id: str, stage: str, value):
+        blob = compress_json(value)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_checkpoints (job_id, stage, data, updated_at) VALUES (?, ?, ?, ?)",
+                (job_id, stage, blob, time.time())
+            )
+
+    def get_checkpoint(self, job_id: str, stage: str):
+        """Return the saved output of a stage, or None if it hasn't finished"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM job_checkpoints WHERE job_id = ? AND stage = ?", (job_id, stage)
+            ).fetchone()
+        return decompress_json(row[0]) if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class JobCheckpoints:
+    """Stage checkpoints of one job, handed to the pipeline"""
+
+    def __init__(self, queue: JobQueue, job_id: str):
+        self.queue = queue
+        self.job_id = job_id
+
+    def get(self, stage: str):
+        return self.queue.get_checkpoint(self.job_id, stage)
+
+    def save(self, stage: str, value):
+        self.queue.save_checkpoint(self.job_id, stage, value)
+
+job_queue = JobQueue(os.environ.get("JOB_DATABASE_PATH", DATABASE_PATH))
@@ -0,0 +1,464 @@
+# File: json_stream.py
+"""
+JSON from LLM responses, which can arrive in pieces, cut off at the token
+limit, or slightly malformed.
+
+parse_json() parses strict JSON quickly and anything else tolerantly:
+every complete value is recovered (trailing commas, missing commas,
+comments, single quotes, unquoted keys, Python literals, raw newlines in
+strings and text around the JSON are all accepted), an incomplete record
+at the end of a truncated response is dropped rather than guessed at,
+and the result says exactly what was repaired, salvaged and dropped.
+
+JSONItemStream picks complete array elements (e.g. dialogue lines) out of
+a response while it is still streaming.
+"""
+import json
+import re
+from collections import Counter
+from json.decoder import scanstring
+
+from telemetry import metrics
+
+# Whitespace and comments between tokens
+_SPACE = re.compile(r'(?:\s+|//[^\n]*|/\*.*?(?:\*/|\Z)|#[^\n]*)*', re.S)
+_NUMBER = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+_IDENTIFIER = re.compile(r'[A-Za-z_$][\w$-]*')
+_DECODER = json.JSONDecoder()
+_FENCE = re.compile(r'```(?:json)?\s*\n?(.*?)(?:```|\Z)', re.S | re.I)
+
+# Containers that fail strict decoding, beyond those that pass, before parse_json
+# stops trying to decode them whole and reads everything character by character
+FAST_PATH_MISSES = 8
+
+# Bare words read as values; the capitalised ones are Python's
+LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+
+metrics.describe("plottwist_json_salvage_total", "counter", "LLM responses that were not strict JSON, by outcome")
+
+class Salvage:
+    """
+    The result of parse_json: value (None if nothing could be recovered),
+    whether the text was strict JSON, and otherwise the repairs made
+    (repair -> count), the complete objects recovered per array path
+    (e.g. "characters", "dialogue.choices") and the paths of incomplete
+    or unreadable values that were dropped (e.g. "settings[3]").
+    """
+
+    def __init__(self, value=None, complete: bool = False, repairs=None, salvaged=None, dropped=None):
+        self.value = value
+        self.complete = complete
+        self.repairs = repairs or Counter()
+        self.salvaged = salvaged or Counter()
+        self.dropped = dropped or []
+
+    @property
+    def truncated(self) -> bool:
+        return self.repairs.get("truncated", 0) > 0
+
+    def summary(self) -> str:
+        if self.complete:
+            return "strict JSON"
+        if self.value is None:
+            return "nothing recovered"
+        repairs = ", ".join(f"{name} x{count}" for name, count in sorted(self.repairs.items()))
+        salvaged = ", ".join(f"{count} {path or 'root'}" for path, count in sorted(self.salvaged.items()))
+        dropped = ", ".join(self.dropped[:5]) + (f" and {len(self.dropped) - 5} more" if len(self.dropped) > 5 else "")
+        return f"repaired ({repairs}); salvaged {salvaged or 'no objects'}; dropped {dropped or 'nothing'}"
+
+    def log(self, what: str):
+        """Print what was done to a response that wasn't strict JSON, and count it"""
+        if self.complete:
+            return
+        outcome = "failed" if self.value is None else ("truncated" if self.truncated else "repaired")
+        metrics.inc("plottwist_json_salvage_total", what=what, outcome=outcome)
+        print(f"Salvaged {what} JSON: {self.summary()}")
+
+class _Truncated(Exception):
+    """The text ended inside a value; partial is the container read so far (None for scalars)"""
+
+    def __init__(self, partial=None):
+        self.partial = partial
+
+class _Invalid(Exception):
+    pass
+
+def _path_name(path: tuple) -> str:
+    name = ""
+    for part in path:
+        name += f"[{part}]" if isinstance(part, int) else (f".{part}" if name else str(part))
+    return name
+
+class _TolerantParser:
+    def __init__(self, text: str, start: int = 0):
+        self.text = text
+        self.pos = start
+        self.repairs = Counter()
+        self.salvaged = Counter()
+        self.dropped = []
+        self.hits = 0
+        self.misses = 0
+
+    def skip(self):
+        """Skip whitespace and comments, noting comments as a repair"""
+        end = _SPACE.match(self.text, self.pos).end()
+        if end > self.pos and self.text[self.pos:end].strip():
+            self.repairs["comments"] += 1
+        self.pos = end
+
+    def value(self, path: tuple):
+        self.skip()
+        if self.pos >= len(self.text):
+            raise _Truncated()
+        char = self.text[self.pos]
+        if char in "{[":
+            # Damage is usually local (a cut-off end, one bad line): take intact containers
+            # whole, unless it turns out to be everywhere (e.g. single quotes throughout)
+            if self.misses <= self.hits + FAST_PATH_MISSES:
+                try:
+                    value, self.pos = _DECODER.raw_decode(self.text, self.pos)
+                except json.JSONDecodeError:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.count_records(value, path)
+                    return value
+            return self.object(path) if char == "{" else self.array(path)
+        if char in "\"'":
+            return self.string()
+        match = _NUMBER.match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            if self.pos >= len(self.text):
+                # The number may have been cut short
+                raise _Truncated()
+            number = match.group()
+            try:
+                return json.loads(number)
+            except ValueError:
+                self.repairs["numbers"] += 1
+                return float(number)
+        match = _IDENTIFIER.match(self.text, self.pos)
+        if match:
+            word = match.group()
+            if word in LITERALS:
+                self.pos = match.end()
+                if word not in ("true", "false", "null"):
+                    self.repairs["python_literals"] += 1
+                return LITERALS[word]
+            if match.end() >= len(self.text) and any(literal.startswith(word) for literal in LITERALS):
+                raise _Truncated()
+        raise _Invalid(f"unexpected {char!r}")
+
+    def count_records(self, value, path: tuple):
+        """Count the objects in arrays within a value taken whole"""
+        if isinstance(value, dict):
+            for key, member in value.items():
+                if isinstance(member, (dict, list)):
+                    self.count_records(member, path + (key,))
+        elif isinstance(value, list):
+            name = ".".join(part for part in path if not isinstance(part, int))
+            for index, element in enumerate(value):
+                if isinstance(element, dict):
+                    self.salvaged[name] += 1
+                if isinstance(element, (dict, list)):
+                    self.count_records(element, path + (index,))
+
+    def string(self) -> str:
+        if self.text[self.pos] == "'":
+            self.repairs["single_quotes"] += 1
+            end = self._closing_quote(self.pos + 1, "'")
+            body = self.text[self.pos + 1:end].replace("\\'", "'").replace('"', '\\"')
+            self.pos = end + 1
+            return self._decode(body + '"', 0)[0]
+        value, self.pos = self._decode(self.text, self.pos + 1)
+        return value
+
+    def _closing_quote(self, start: int, quote: str) -> int:
+        end = start
+        while True:
+            end = self.text.find(quote, end)
+            if end < 0:
+                raise _Truncated()
+            preceding = self.text[start:end]
+            if (len(preceding) - len(preceding.rstrip("\\"))) % 2 == 0:
+                return end
+            end += 1
+
+    def _decode(self, text: str, start: int, strict: bool = True):
+        """The string starting at text[start] (after its quote), and the offset after it"""
+        try:
+            return scanstring(text, start, strict)
+        except json.JSONDecodeError as e:
+            if e.msg.startswith("Unterminated string"):
+                raise _Truncated()
+            if e.msg.startswith("Invalid control character"):
+                # Usually a raw newline inside a line of dialogue
+                self.repairs["control_characters"] += 1
+                return self._decode(text, start, strict=False)
+            if e.msg.startswith("Invalid \\"):
+                # Keep backslashes that don't start a valid escape
+                self.repairs["escapes"] += 1
+                # (a single-quoted string was rewritten to end at its only unescaped quote)
+                end = self._closing_quote(start, '"') if text is self.text else len(text) - 1
+                body = re.sub(r'\\(?![\\"/bfnrt]|u[0-9a-fA-F]{4})', r'\\\\', text[start:end])
+                value, _ = self._decode(body + '"', 0, strict=False)
+                return value, end + 1
+            raise _Invalid(e.msg)
+
+    def recover(self):
+        """Skip an unreadable value, up to the next comma or closer at its own depth"""
+        depth = 0
+        text = self.text
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char == '"':
+                try:
+                    _, self.pos = scanstring(text, self.pos + 1, False)
+                except json.JSONDecodeError:
+                    self.pos = len(text)
+                continue
+            if char in "{[":
+                depth += 1
+            elif char in "}]":
+                if depth == 0:
+                    return
+                depth -= 1
+            elif char == "," and depth == 0:
+                return
+            self.pos += 1
+
+    def key(self) -> str:
+        char = self.text[self.pos]
+        if char in "\"'":
+            return self.string()
+        match = _IDENTIFIER.match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            self.repairs["unquoted_keys"] += 1
+            return match.group()
+        raise _Invalid(f"unexpected {char!r} in place of a key")
+
+    def object(self, path: tuple) -> dict:
+        self.pos += 1
+        result = {}
+        expecting = True    # A member may follow (after "{" or a comma)
+        while True:
+            self.skip()
+            if self.pos >= len(self.text):
+                raise _Truncated(result)
+            char = self.text[self.pos]
+            if char == "}":
+                self.pos += 1
+                if result and expecting:
+                    self.repairs["trailing_commas"] += 1
+                return result
+            if char == ",":
+                self.pos += 1
+                if expecting:
+                    self.repairs["extra_commas"] += 1
+                expecting = True
+                continue
+            if char == "]":
+                # Mismatched closer: treat it as the end of this object
+                self.repairs["mismatched_brackets"] += 1
+                self.pos += 1
+                return result
+            if not expecting:
+                self.repairs["missing_commas"] += 1
+            expecting = False
+            try:
+                key = self.key()
+            except _Invalid:
+                self.dropped.append(_path_name(path + ("?",)))
+                self.recover()
+                continue
+            self.skip()
+            if self.pos >= len(self.text):
+                raise _Truncated(result)
+            if self.text[self.pos] == ":":
+                self.pos += 1
+            elif self.text[self.pos] == "=":
+                self.repairs["missing_colons"] += 1
+                self.pos += 1
+            else:
+                self.repairs["missing_colons"] += 1
+            try:
+                result[key] = self.value(path + (key,))
+            except _Truncated as e:
+                if isinstance(e.partial, (dict, list)):
+                    result[key] = e.partial
+                else:
+                    self.dropped.append(_path_name(path + (key,)))
+                raise _Truncated(result)
+            except _Invalid:
+                self.dropped.append(_path_name(path + (key,)))
+                self.recover()
+
+    def array(self, path: tuple) -> list:
+        self.pos += 1
+        result = []
+        expecting = True
+        name = ".".join(part for part in path if not isinstance(part, int))
+        while True:
+            self.skip()
+            if self.pos >= len(self.text):
+                raise _Truncated(result)
+            char = self.text[self.pos]
+            if char == "]":
+                self.pos += 1
+                if result and expecting:
+                    self.repairs["trailing_commas"] += 1
+                return result
+            if char == ",":
+                self.pos += 1
+                if expecting:
+                    self.repairs["extra_commas"] += 1
+                expecting = True
+                continue
+            if char == "}":
+                self.repairs["mismatched_brackets"] += 1
+                self.pos += 1
+                return result
+            if not expecting:
+                self.repairs["missing_commas"] += 1
+            expecting = False
+            index = len(result)
+            try:
+                element = self.value(path + (index,))
+            except _Truncated as e:
+                # A record cut off part way is dropped rather than guessed at
+                if isinstance(e.partial, list):
+                    result.append(e.partial)
+                else:
+                    # Reported as a whole, not by the parts of it that were cut off
+                    dropped = _path_name(path + (index,))
+                    self.dropped = [d for d in self.dropped if not (d + ".").startswith(dropped + ".")
+                                    and not d.startswith(dropped + "[")]
+                    self.dropped.append(dropped)
+                raise _Truncated(result)
+            except _Invalid:
+                self.dropped.append(_path_name(path + (index,)))
+                self.recover()
+                continue
+            if isinstance(element, dict):
+                self.salvaged[name] += 1
+            result.append(element)
+
+def _document_start(text: str) -> int:
+    """Where the JSON starts: inside a code fence if there is one, else at the first { or ["""
+    fence = _FENCE.search(text)
+    search_from = fence.start(1) if fence else 0
+    starts = [i for i in (text.find("{", search_from), text.find("[", search_from)) if i >= 0]
+    return min(starts) if starts else -1
+
+def parse_json(text: str) -> Salvage:
+    """Parse an LLM response as JSON, recovering what can be recovered (see Salvage)"""
+    if not text:
+        return Salvage()
+    try:
+        return Salvage(json.loads(text), complete=True)
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    start = _document_start(text)
+    if start < 0:
+        return Salvage()
+    parser = _TolerantParser(text, start)
+    if text[:start].strip():
+        parser.repairs["surrounding_text"] += 1
+    try:
+        value = parser.value(())
+    except _Truncated as e:
+        value = e.partial
+        parser.repairs["truncated"] += 1
+    except (_Invalid, RecursionError):
+        value = None
+    else:
+        parser.skip()
+        rest = text[parser.pos:].strip()
+        if rest and rest.strip("`").strip() and not text[:start].strip():
+            parser.repairs["surrounding_text"] += 1
+    return Salvage(value, False, parser.repairs, parser.salvaged, parser.dropped)
+
+def json_parser(what: str):
+    """parse_json for text alone, returning the value and logging what was salvaged as `what`"""
+    def parse(text: str):
+        parsed = parse_json(text)
+        parsed.log(what)
+        return parsed.value
+    return parse
+
+class JSONItemStream:
+    """
+    Incremental scanner for a JSON document arriving in pieces (e.g. a
+    streamed completion). feed() returns the elements of the array at
+    `path` that were completed by that piece, parsed, so each one can be
+    used long before the document is whole:
+
+        items = JSONItemStream(("dialogue",))
+        for chunk in chunks:
+            for line in items.feed(chunk):
+                ...
+        scene = parse_json(items.text).value
+
+    Only object and array elements are returned. Text around the document
+    (e.g. a markdown fence) is ignored.
+    """
+
+    def __init__(self, path=("dialogue",)):
+        self.path = tuple(path)
+        self.text = ""
+        self.count = 0            # Elements returned so far
+        self._pos = 0             # Where scanning resumes in text
+        self._stack = []          # Open containers: [kind, key or index, expecting a key, start offset]
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+
+    def _container_path(self) -> tuple:
+        """Path of the innermost open container"""
+        return tuple(frame[1] for frame in self._stack[:-1])
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        items = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    top = self._stack[-1] if self._stack else None
+                    if top is not None and top[0] == "{" and top[2]:
+                        top[1] = json.loads(text[self._string_start:i + 1])
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                self._stack.append([char, None if char == "{" else 0, char == "{", i])
+            elif char in "}]":
+                if not self._stack:
+                    continue
+                start = self._stack.pop()[3]
+                # An element of the array at path just closed
+                if self._stack and self._stack[-1][0] == "[" and self._container_path() == self.path:
+                    element = parse_json(text[start:i + 1]).value
+                    if element is not None:
+                        items.append(element)
+                        self.count += 1
+            elif char == ":" and self._stack and self._stack[-1][0] == "{":
+                self._stack[-1][2] = False
+            elif char == "," and self._stack:
+                top = self._stack[-1]
+                if top[0] == "{":
+                    top[2] = True
+                else:
+                    top[1] += 1
+        self._pos = len(text)
+        return items
@@ -0,0 +1,119 @@
+# File: llm_cache.py
+"""
+Cache of chat completions, keyed by model, messages and parameters.
+
+LLM_CACHE_MODE picks how chat_completion uses it:
+  "readwrite"  serve repeated requests from the cache, store new responses (default)
+  "replay"     serve only from the cache; a request it hasn't seen raises
+               LLMCacheMiss instead of reaching the network
+  "off"        always call the API
+Replay makes a pipeline that already ran once deterministic and offline,
+for benchmarks and regression runs.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from disk_cache import DiskCache, CACHE_DIR
+
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "readwrite").lower()
+LLM_CACHE_MODES = ("readwrite", "replay", "off")
+
+# Entries older than this are treated as missing (0 keeps them until evicted)
+LLM_CACHE_TTL_SECONDS = float(os.environ.get("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Least recently used responses are evicted past this size
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Request parameters that don't change the response
+UNKEYED_PARAMS = ("timeout",)
+
+class LLMCacheMiss(Exception):
+    """Raised in replay mode for a request that isn't cached"""
+
+def completion_key(kwargs: dict) -> str:
+    request = {name: value for name, value in kwargs.items() if name not in UNKEYED_PARAMS}
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return "chat:" + hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def response_record(response) -> dict:
+    """The parts of a chat completion the callers use, as JSON"""
+    choice = response.choices[0]
+    usage = getattr(response, "usage", None)
+    return {
+        "content": choice.message.content,
+        "finish_reason": getattr(choice, "finish_reason", None),
+        "usage": {
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None)
+        } if usage is not None else None,
+        "created": time.time()
+    }
+
+def completion_response(content: str, finish_reason: str = None, usage=None):
+    """A response object shaped like the SDK's chat completion"""
+    message = SimpleNamespace(role="assistant", content=content)
+    choice = SimpleNamespace(index=0, message=message, finish_reason=finish_reason)
+    return SimpleNamespace(choices=[choice], usage=usage)
+
+def cached_response(record: dict):
+    """Rebuild a response object shaped like the SDK's from a cache record"""
+    usage = SimpleNamespace(**record["usage"]) if record.get("usage") else None
+    response = completion_response(record["content"], record.get("finish_reason"), usage)
+    response.cached = True
+    return response
+
+class CompletionCache:
+    """
+    Completion cache in front of a storage backend. The backend is anything
+    with DiskCache's get/set/delete/stats; DiskCache supplies the LRU
+    eviction and the TTL is checked here against each record's creation time.
+    """
+
+    def __init__(self, backend, mode: str = LLM_CACHE_MODE, ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"LLM_CACHE_MODE must be one of {', '.join(LLM_CACHE_MODES)}, not {mode!r}")
+        self.backend = backend
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        self.expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def get(self, key: str):
+        record = self.backend.get(key)
+        if record is None:
+            return None
+        if self.ttl_seconds and time.time() - record.get("created", 0) > self.ttl_seconds:
+            self.backend.delete(key)
+            self.expired += 1
+            return None
+        return cached_response(record)
+
+    def set(self, key: str, response):
+        self.backend.set(key, response_record(response))
+
+    async def lookup(self, kwargs: dict):
+        """(key, cached response or None); raises LLMCacheMiss on a replay miss"""
+        key = completion_key(kwargs)
+        response = await asyncio.to_thread(self.get, key)
+        if response is None and self.mode == "replay":
+            raise LLMCacheMiss(f"No cached completion for {kwargs.get('model')} request {key[6:18]}")
+        return key, response
+
+    async def store(self, key: str, response):
+        # A response cut off at max_tokens is usually broken JSON; let the next request retry it
+        if getattr(response.choices[0], "finish_reason", None) == "length":
+            return
+        if self.mode == "readwrite":
+            await asyncio.to_thread(self.set, key, response)
+
+    def stats(self) -> dict:
+        return dict(self.backend.stats(), mode=self.mode, ttl_seconds=self.ttl_seconds, expired=self.expired)
+
+llm_cache = CompletionCache(DiskCache(os.path.join(CACHE_DIR, "llm"), LLM_CACHE_MAX_BYTES))
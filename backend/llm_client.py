@@ -0,0 +1,300 @@
+# File: llm_client.py
+"""
+Shared pieces for LLM calls: local token counting, prompts packed into a
+token budget, and per-call-site accounting of prompt and completion tokens.
+"""
+import math
+import os
+import time
+
+from llm_cache import llm_cache, completion_response
+from telemetry import span
+
+# tiktoken gives exact counts for OpenAI models; without it counts are estimated
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# Average characters per token of English prose, for estimates without tiktoken
+CHARS_PER_TOKEN = 4.0
+
+# Context window sizes of the models we call; unknown models get the smallest
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+
+# List prices in USD per million (prompt, completion) tokens, for spend reporting
+MODEL_PRICES = {
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+def _limit(call_site: str, kind: str, default: int) -> int:
+    return int(os.environ.get(f"LLM_{call_site.upper()}_{kind}_TOKENS", default))
+
+# Prompt token budget per call site (override with e.g. LLM_SCENE_INPUT_TOKENS)
+INPUT_BUDGETS = {
+    "analysis": _limit("analysis", "INPUT", 4000),
+    "analysis_chunk": _limit("analysis_chunk", "INPUT", 7000),
+    "analysis_summary": _limit("analysis_summary", "INPUT", 4000),
+    "outline": _limit("outline", "INPUT", 3000),
+    "scene": _limit("scene", "INPUT", 2500),
+    "scene_batch": _limit("scene_batch", "INPUT", 4500),
+    "continuation": _limit("continuation", "INPUT", 2500),
+}
+
+# Completion token limit per call site (override with e.g. LLM_SCENE_OUTPUT_TOKENS)
+OUTPUT_LIMITS = {
+    "analysis": _limit("analysis", "OUTPUT", 3500),
+    "analysis_chunk": _limit("analysis_chunk", "OUTPUT", 2000),
+    "analysis_summary": _limit("analysis_summary", "OUTPUT", 1000),
+    "outline": _limit("outline", "OUTPUT", 2500),
+    "scene": _limit("scene", "OUTPUT", 3500),
+    "scene_batch": _limit("scene_batch", "OUTPUT", 4000),
+    "continuation": _limit("continuation", "OUTPUT", 3500),
+}
+
+# Token and latency totals per call site
+LLM_STATS = {}
+
+_encodings = {}
+
+def _encoding(model: str):
+    """The tiktoken encoding for model, or None to estimate instead"""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    if model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Encodings are downloaded on first use, which fails offline
+            print(f"Could not load a tokenizer for {model}, estimating token counts: {e}")
+            _encodings[model] = None
+    return _encodings[model]
+
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def count_message_tokens(messages: list, model: str) -> int:
+    # Each message carries a few tokens of framing on top of its content
+    return sum(count_tokens(message.get("content") or "", model) + 4 for message in messages) + 3
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """Cut text to at most max_tokens, at a line or sentence end where possible"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model)
+    if encoding is not None:
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        cut = text[:int(max_tokens * CHARS_PER_TOKEN)]
+    # Don't stop mid-sentence if a boundary is reasonably close
+    boundary = max(cut.rfind("\n"), cut.rfind(". "))
+    return cut[:boundary + 1] if boundary > len(cut) * 0.8 else cut
+
+def completion_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """What a call cost in USD at list price (0 for models without a known price)"""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+def completion_limit(call_site: str, model: str, prompt_tokens: int) -> int:
+    """The call site's completion limit, shrunk if the prompt leaves less room in the context"""
+    room = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - prompt_tokens
+    return max(256, min(OUTPUT_LIMITS.get(call_site, 2000), room))
+
+class PromptBuilder:
+    """
+    Fill a prompt's variable parts within a token budget.
+
+    Each slot holds a list of items (character blocks, plot points, an
+    excerpt) ordered from most to least valuable. Slots are filled in
+    priority order, each taking items until the next one doesn't fit (or
+    the slot's own limit is reached); a truncatable slot takes a cut-down
+    item instead of dropping it.
+
+        builder = PromptBuilder("gpt-4-turbo", budget=3000)
+        builder.slot("summary", [summary], priority=0, truncate=True, limit=1000)
+        builder.slot("characters", blocks, priority=1)
+        builder.slot("key_points", points, priority=1, joiner=", ")
+        prompt = builder.render(lambda summary, characters, key_points: f"...{summary}...{characters}...{key_points}...")
+    """
+
+    def __init__(self, model: str, budget: int, reserve: int = 0):
+        self.model = model
+        self.budget = budget
+        self.reserve = reserve   # Tokens kept back for other messages, such as the system prompt
+        self.slots = []
+        self.report = {}
+
+    def slot(self, name: str, items: list, priority: int = 0, joiner: str = "", truncate: bool = False,
+             limit: int = None):
+        self.slots.append({"name": name, "items": list(items), "priority": priority,
+                           "joiner": joiner, "truncate": truncate, "limit": limit})
+        return self
+
+    def render(self, template) -> str:
+        """Call template(**slot_text) with each slot packed into what is left of the budget"""
+        fixed = template(**{slot["name"]: "" for slot in self.slots})
+        remaining = self.budget - self.reserve - count_tokens(fixed, self.model)
+        filled = {}
+        for slot in sorted(self.slots, key=lambda s: s["priority"]):
+            kept = []
+            available = remaining if slot["limit"] is None else min(remaining, slot["limit"])
+            for item in slot["items"]:
+                cost = count_tokens(item + slot["joiner"], self.model)
+                if cost <= available:
+                    kept.append(item)
+                    available -= cost
+                    remaining -= cost
+                    continue
+                if slot["truncate"]:
+                    cut = truncate_to_tokens(item, available - count_tokens(slot["joiner"], self.model), self.model)
+                    if cut:
+                        kept.append(cut)
+                        remaining -= count_tokens(cut + slot["joiner"], self.model)
+                break
+            filled[slot["name"]] = slot["joiner"].join(kept)
+            self.report[slot["name"]] = f"{len(kept)}/{len(slot['items'])}"
+        prompt = template(**filled)
+        self.report["prompt_tokens"] = count_tokens(prompt, self.model)
+        return prompt
+
+def _record(call_site, model, prompt_tokens, completion_tokens, seconds, error=None, cached=False):
+    site = LLM_STATS.setdefault(call_site, {"models": {}})
+    cost = completion_cost(model, prompt_tokens, completion_tokens)
+    # Totals for the call site, and for each model it used
+    for stats in (site, site["models"].setdefault(model, {})):
+        for field in ("calls", "errors", "cache_hits", "prompt_tokens", "completion_tokens", "seconds", "cost_usd"):
+            stats.setdefault(field, 0)
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        if error is not None:
+            stats["errors"] += 1
+        elif cached:
+            # Served without a request, so no tokens were spent
+            stats["cache_hits"] += 1
+        else:
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cost_usd"] += cost
+    if error is None and not cached:
+        print(f"LLM {call_site} ({model}): {prompt_tokens} prompt + {completion_tokens} completion tokens "
+              f"in {seconds:.1f}s (${cost:.4f})")
+
+async def chat_completion(client, call_site: str, **kwargs):
+    """
+    client.chat.completions.create(**kwargs), with max_tokens defaulting to
+    the call site's limit and token usage recorded under call_site.
+    Identical requests are answered from llm_cache (see LLM_CACHE_MODE).
+    """
+    model = kwargs["model"]
+    estimated_prompt = count_message_tokens(kwargs["messages"], model)
+    kwargs.setdefault("max_tokens", completion_limit(call_site, model, estimated_prompt))
+    start = time.perf_counter()
+    with span("llm", call_site, model=model) as call:
+        try:
+            key = None
+            if llm_cache.enabled:
+                key, response = await llm_cache.lookup(kwargs)
+                if response is not None:
+                    call.set(cache_hit=True)
+                    _record(call_site, model, 0, 0, time.perf_counter() - start, cached=True)
+                    return response
+            response = await client.chat.completions.create(**kwargs)
+            if key is not None:
+                await llm_cache.store(key, response)
+        except Exception as e:
+            _record(call_site, model, 0, 0, time.perf_counter() - start, error=str(e))
+            raise
+
+        prompt_tokens, completion_tokens = _usage(response, model, estimated_prompt)
+        call.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                 cost_usd=completion_cost(model, prompt_tokens, completion_tokens))
+    _record(call_site, model, prompt_tokens, completion_tokens, time.perf_counter() - start)
+    return response
+
+async def stream_completion(client, call_site: str, **kwargs):
+    """
+    chat_completion as a stream: yields the completion's text piece by
+    piece as the API writes it. A cached completion is yielded whole, and
+    a finished stream is cached like any other completion.
+    """
+    model = kwargs["model"]
+    estimated_prompt = count_message_tokens(kwargs["messages"], model)
+    kwargs.setdefault("max_tokens", completion_limit(call_site, model, estimated_prompt))
+    start = time.perf_counter()
+    with span("llm", call_site, model=model, stream=True) as call:
+        try:
+            key = None
+            if llm_cache.enabled:
+                key, response = await llm_cache.lookup(kwargs)
+                if response is not None:
+                    call.set(cache_hit=True)
+                    _record(call_site, model, 0, 0, time.perf_counter() - start, cached=True)
+                    yield response.choices[0].message.content or ""
+                    return
+            stream = await client.chat.completions.create(**kwargs, stream=True,
+                                                          stream_options={"include_usage": True})
+            parts = []
+            finish_reason = usage = None
+            async for chunk in stream:
+                # With include_usage, the last chunk has the usage and no choices
+                usage = getattr(chunk, "usage", None) or usage
+                for choice in chunk.choices:
+                    finish_reason = choice.finish_reason or finish_reason
+                    if choice.delta.content:
+                        if not parts:
+                            call.set(first_token_seconds=round(time.perf_counter() - start, 3))
+                        parts.append(choice.delta.content)
+                        yield choice.delta.content
+            response = completion_response("".join(parts), finish_reason, usage)
+            if key is not None:
+                await llm_cache.store(key, response)
+        except Exception as e:
+            _record(call_site, model, 0, 0, time.perf_counter() - start, error=str(e))
+            raise
+
+        prompt_tokens, completion_tokens = _usage(response, model, estimated_prompt)
+        call.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                 cost_usd=completion_cost(model, prompt_tokens, completion_tokens))
+    _record(call_site, model, prompt_tokens, completion_tokens, time.perf_counter() - start)
+
+def _usage(response, model: str, estimated_prompt: int):
+    """(prompt tokens, completion tokens) of a response"""
+    # Prefer the API's own counts; estimate locally when it doesn't report usage
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or estimated_prompt
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if completion_tokens is None:
+        completion_tokens = count_tokens(response.choices[0].message.content or "", model)
+    return prompt_tokens, completion_tokens
+
+def llm_stats() -> dict:
+    """Per call site (and per model within it): calls, tokens, seconds, mean latency and spend"""
+    def rounded(stats):
+        requests = stats["calls"] - stats["cache_hits"]
+        return dict(stats, seconds=round(stats["seconds"], 3), cost_usd=round(stats["cost_usd"], 6),
+                    mean_seconds=round(stats["seconds"] / requests, 3) if requests else None)
+    
+    return {
+        call_site: dict(rounded(stats), models={model: rounded(m) for model, m in stats["models"].items()})
+        for call_site, stats in LLM_STATS.items()
+    }
@@ -0,0 +1,273 @@
+# File: lookahead.py
+"""
+Speculative pre-generation of the scenes a player may reach next.
+
+Whenever a player reaches a scene, the scenes one or two choices ahead
+of it (found in the book's scene graph) that haven't been written yet are
+queued, nearest first, and written in the background. By the time a
+choice is made its scene is usually in the script already, instead of
+being written while the player waits.
+
+Each player of a book (told apart by the player ID the client sends) has
+their own position, and queued scenes that are no longer ahead of that
+player are dropped when they come up. Speculation is bounded per book:
+at most LOOKAHEAD_BUDGET speculatively written scenes may go unplayed
+across all of its players. Reaching one gives its share back, and so does
+every player moving out of its reach (down another branch).
+"""
+import asyncio
+import itertools
+import os
+import time
+
+from openai import AsyncOpenAI
+
+from storage import store
+from story_session import story_sessions
+from vn_generator import generate_next_scene, update_scene_graph, enhance_visual_novel
+from telemetry import span, cache_hit
+
+# How many choices ahead of the player to write scenes (0 turns lookahead off)
+LOOKAHEAD_DEPTH = int(os.environ.get("LOOKAHEAD_DEPTH", "2"))
+
+# Speculatively written scenes per book that may go unplayed
+LOOKAHEAD_BUDGET = int(os.environ.get("LOOKAHEAD_BUDGET", "12"))
+
+# Scenes written speculatively at once, across all books
+LOOKAHEAD_CONCURRENCY = int(os.environ.get("LOOKAHEAD_CONCURRENCY", "2"))
+
+# A player who hasn't reached a new scene for this long is forgotten
+LOOKAHEAD_PLAYER_IDLE_SECONDS = float(os.environ.get("LOOKAHEAD_PLAYER_IDLE_SECONDS", "1800"))
+
+# Book ID -> task rebuilding its evicted story session
+_loading_sessions = {}
+
+async def load_session(book_id: str, script: dict):
+    """
+    The book's story session, rebuilt from its stored analysis and script if
+    it was evicted. Concurrent callers share one rebuild, so scene
+    generations under way in the session aren't orphaned by a second one.
+    """
+    session = story_sessions.get(book_id)
+    if session is not None:
+        return session
+    task = _loading_sessions.get(book_id)
+    if task is None:
+        task = asyncio.ensure_future(_rebuild_session(book_id, script))
+        _loading_sessions[book_id] = task
+        task.add_done_callback(lambda _: _loading_sessions.pop(book_id, None))
+    # One caller giving up doesn't cancel the rebuild for the others
+    return await asyncio.shield(task)
+
+async def _rebuild_session(book_id: str, script: dict):
+    book_analysis = await asyncio.to_thread(store.get_analysis, book_id)
+    # The pipeline may have started a session meanwhile
+    session = story_sessions.get(book_id)
+    if session is None and book_analysis is not None:
+        session = story_sessions.create(book_id, book_analysis)
+        update_scene_graph(session, script)
+    return session
+
+async def add_scene_to_script(script_id: str, scene_id: str, scene: dict) -> dict:
+    """
+    Append a generated scene to a stored script, unless it's there already.
+    The script is re-read and saved in one transaction, since the lookahead
+    workers, scene requests and the pipeline all add to it, and concurrent
+    requests for the same scene share one generation that only one should
+    add. Scenes pending in a playable book's script are saved by the pipeline.
+    """
+    def add(script):
+        if (scene_id not in script.get("pending_scenes", [])
+                and not any(s["id"] == scene.get("id", scene_id) for s in script["scenes"])):
+            script["scenes"].append(scene)
+        return script
+    
+    return await asyncio.to_thread(store.update_script, script_id, add)
+
+def frontier(scene_graph: dict, written, start: str, depth: int) -> list:
+    """Unwritten scenes at most depth choices after start, nearest first, as (hops, scene ID)"""
+    seen = {start}
+    layer = [start]
+    found = []
+    for hops in range(1, depth + 1):
+        next_layer = []
+        for scene_id in layer:
+            for edge in scene_graph.get(scene_id, {}).get("outgoing", []):
+                target = edge["target"]
+                if target in seen:
+                    continue
+                seen.add(target)
+                if target in written:
+                    next_layer.append(target)
+                else:
+                    found.append((hops, target))
+        layer = next_layer
+    return found
+
+def within_reach(scene_graph: dict, start: str, depth: int) -> set:
+    """Every scene at most depth choices after start, written or not, and start itself"""
+    reach = {start}
+    layer = [start]
+    for _ in range(depth):
+        layer = [edge["target"] for scene_id in layer for edge in scene_graph.get(scene_id, {}).get("outgoing", [])
+                 if edge["target"] not in reach]
+        reach.update(layer)
+    return reach
+
+class PlayerPosition:
+    """Where a player is in a book, and the scenes queued ahead of them since they got there"""
+
+    def __init__(self, scene_id: str, script_id: str, epoch: int):
+        self.scene_id = scene_id
+        self.script_id = script_id
+        self.epoch = epoch          # Bumped on every move, so older queued scenes go stale
+        self.queued = set()
+        self.last_seen = time.monotonic()
+
+class LookaheadEngine:
+    """
+    A priority queue of scenes to write ahead of players, nearest first,
+    worked through by a few background tasks
+    """
+
+    def __init__(self, depth: int = LOOKAHEAD_DEPTH, budget: int = LOOKAHEAD_BUDGET,
+                 concurrency: int = LOOKAHEAD_CONCURRENCY):
+        self.depth = depth
+        self.budget = budget
+        self.concurrency = concurrency
+        self._queue = None
+        self._workers = []
+        self._loop = None
+        self._order = itertools.count()
+        self._players = {}      # (book ID, player ID) -> PlayerPosition
+        self._unplayed = {}     # Book ID -> scene IDs written speculatively and not reached yet
+        self.stats = {"queued": 0, "written": 0, "hits": 0, "stale": 0, "over_budget": 0, "abandoned": 0,
+                      "failed": 0}
+
+    def _start(self):
+        # Workers belong to the running event loop; start them on first use
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def visit(self, book_id: str, scene_id: str, player_id: str = None) -> int:
+        """
+        Note that a player reached scene_id, and queue the scenes ahead of it.
+        Returns how many were queued. Players without an ID share one position.
+        """
+        if self.depth <= 0:
+            return 0
+        unplayed = self._unplayed.get(book_id, set())
+        if scene_id in unplayed:
+            # Speculation paid off, and its budget is free again
+            unplayed.discard(scene_id)
+            self.stats["hits"] += 1
+            cache_hit("lookahead", "scene")
+
+        book = await asyncio.to_thread(store.get_book, book_id)
+        script_id = book.get("script_id") if book else None
+        script = await asyncio.to_thread(store.get_script, script_id) if script_id else None
+        if script is None or await load_session(book_id, script) is None:
+            return 0
+
+        player = (book_id, player_id or "")
+        previous = self._players.get(player)
+        self._players[player] = PlayerPosition(scene_id, script_id, previous.epoch + 1 if previous else 1)
+        self._forget_idle()
+        self._start()
+        return self._plan(player)
+
+    def _book_players(self, book_id: str) -> list:
+        return [position for (bid, _), position in self._players.items() if bid == book_id]
+
+    def _plan(self, player: tuple) -> int:
+        """Queue the unwritten scenes ahead of a player's position, within the book's budget"""
+        book_id = player[0]
+        session = story_sessions.get(book_id)
+        position = self._players.get(player)
+        if session is None or position is None:
+            return 0
+        players = self._book_players(book_id)
+        unplayed = self._unplayed.get(book_id, set())
+        if unplayed:
+            # Scenes no player can reach anymore won't be played; free their budget
+            reach = set().union(*(within_reach(session.scene_graph, p.scene_id, self.depth) for p in players))
+            self.stats["abandoned"] += len(unplayed - reach)
+            unplayed &= reach
+        # Scenes already queued for anyone count against the budget once
+        queued = set().union(*(p.queued for p in players))
+        room = self.budget - len(unplayed) - len(queued)
+        count = 0
+        for hops, target in frontier(session.scene_graph, session.generated_scenes, position.scene_id, self.depth):
+            if target in queued or target in session.in_progress_scenes or target == "exit":
+                continue
+            if count >= room:
+                self.stats["over_budget"] += 1
+                break
+            position.queued.add(target)
+            self._queue.put_nowait((hops, next(self._order), player, target, position.epoch))
+            self.stats["queued"] += 1
+            count += 1
+        return count
+
+    async def _work(self):
+        while True:
+            _, _, player, scene_id, epoch = await self._queue.get()
+            try:
+                await self._write(player, scene_id, epoch)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Error writing scene {scene_id} ahead for book {player[0]}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def _write(self, player: tuple, scene_id: str, epoch: int):
+        book_id = player[0]
+        position = self._players.get(player)
+        session = story_sessions.get(book_id)
+        if position is None or position.epoch != epoch or session is None:
+            # The player has moved on (or left) since this scene was queued
+            self.stats["stale"] += 1
+            return
+        if scene_id in session.generated_scenes or scene_id in session.in_progress_scenes:
+            position.queued.discard(scene_id)
+            return
+
+        with span("lookahead", "scene"):
+            client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", "your-openai-api-key"))
+            scene = await generate_next_scene(session, scene_id, client)
+            # Played scenes show images, so render them now too
+            await enhance_visual_novel({"scenes": [scene]}, session.book_analysis.get("characters", []), book_id)
+            script = await add_scene_to_script(position.script_id, scene_id, scene)
+            update_scene_graph(session, script)
+
+        position.queued.discard(scene_id)
+        self._unplayed.setdefault(book_id, set()).add(scene_id)
+        self.stats["written"] += 1
+        # Its own choices may lead to scenes still within reach of the player
+        if self._players.get(player) is position and position.epoch == epoch:
+            self._plan(player)
+
+    def _forget_idle(self):
+        cutoff = time.monotonic() - LOOKAHEAD_PLAYER_IDLE_SECONDS
+        for player in [p for p, position in self._players.items() if position.last_seen < cutoff]:
+            del self._players[player]
+
+    def forget(self, book_id: str):
+        """Drop a book's players and speculation budget, e.g. once its story session is evicted"""
+        for player in [p for p in self._players if p[0] == book_id]:
+            del self._players[player]
+        self._unplayed.pop(book_id, None)
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
+
+# Shared engine, so the concurrency limit applies across every book served by this process
+lookahead = LookaheadEngine()
+story_sessions.on_evict.append(lookahead.forget)
@@ -1,5 +1,5 @@
 # File: main.py
-from fastapi import FastAPI, File, Form, UploadFile, BackgroundTasks, HTTPException
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Query, Request
 
 
 from fastapi.middleware.cors import CORSMiddleware
@@ -7,17 +7,31 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import uuid  # Add this import for UUID generation
+import asyncio
+import hashlib
+import time
 
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.exceptions import RequestValidationError, ResponseValidationError
 import sys
 import os
 import traceback
 
 # Import our processing modules
-from pdf_processor import process_pdf
-from book_analyzer import analyze_book
-from vn_generator import generate_visual_novel
+from disk_cache import book_cache
+from storage import store
+from image_store import IMAGE_URL_PATH
+from http_client import close_session, fetch_stats
+from llm_client import llm_stats
+from llm_cache import llm_cache
+from model_router import router
+from telemetry import metrics
+from vn_generator import generate_visual_novel, generate_next_scene, update_scene_graph, enhance_visual_novel
+from lookahead import lookahead, load_session, add_scene_to_script
+from book_events import book_events, progress_snapshot, format_event, FINAL_STATUSES, BOOK_EVENTS_KEEPALIVE_SECONDS, BOOK_EVENTS_POLL_SECONDS
+from job_queue import job_queue
+from worker import enqueue_book, run_worker
+from openai import AsyncOpenAI
 
 # Create the FastAPI app - THIS WAS MISSING
 app = FastAPI(title="PlotTwist API", description="API for converting books to visual novels")
@@ -41,10 +55,16 @@ class Book(BaseModel):
     title: str
     author: str
     file_path: str
-    status: str  # 'uploading', 'processing', 'analyzing', 'generating', 'ready'
+    status: str  # 'uploading', 'queued', 'processing', 'analyzing', 'generating', 'playable', 'ready'
     progress: int  # 0-100
     script_id: Optional[str] = None
     error: Optional[str] = None
+    pages_extracted: Optional[int] = None
+    pages_total: Optional[int] = None
+    scenes_generated: Optional[int] = None
+    scenes_total: Optional[int] = None
+    timings: Optional[Dict[str, Any]] = None        # Time per stage and per kind of operation
+    stage_timings: Optional[Dict[str, Any]] = None  # Critical path of script and image generation
 
 class Character(BaseModel):
     id: str
@@ -65,111 +85,53 @@ class Scene(BaseModel):
     background: str
     characters: List[Character] = []
     dialogue: List[DialogueLine] = []
+    pending_images: Optional[bool] = None  # Placeholder images stand in for renders still running
 
 class VNScript(BaseModel):
     id: str
     book_id: str
     title: Optional[str] = None
     scenes: List[Scene] = []
+    pending_scenes: List[str] = []  # Scenes still being written while the book is playable
+    complete: bool = True
 
-# In-memory storage (replace with database in production)
-books = {}
-scripts = {}
+# Book records and scripts live in the SQLite store (see storage.py);
+# processing runs in workers pulling from the job queue (see worker.py)
+
+# Also run a worker inside the web process, for single-machine deployments
+RUN_WORKER_IN_PROCESS = os.environ.get("RUN_WORKER_IN_PROCESS", "true").lower() in ("1", "true", "yes")
 
 # Create upload directories
 os.makedirs("uploads", exist_ok=True)
 os.makedirs("static", exist_ok=True)
 
-# Background task to process book
-async def process_book_task(book_id: str, file_path: str):
-    try:
-        # Update status to processing
-        books[book_id]["status"] = "processing"
-        books[book_id]["progress"] = 10
-        print(f"Processing book {book_id}: Extracting PDF content")
-        
-        # Extract text from PDF
-        book_content = await process_pdf(file_path)
-        books[book_id]["progress"] = 30
-        print(f"Processing book {book_id}: PDF extraction complete, analyzing content")
-        
-        # Analyze book content
-        books[book_id]["status"] = "analyzing"
-        book_analysis = await analyze_book(book_content)
-        books[book_id]["progress"] = 60
-        print(f"Processing book {book_id}: Analysis complete, generating script")
-        
-        # Generate visual novel script
-        books[book_id]["status"] = "generating"
-        vn_script = await generate_visual_novel(book_analysis)
-        books[book_id]["progress"] = 90
-        print(f"Processing book {book_id}: Script generation complete")
-        
-        # Save the generated script
-        script_id = str(uuid.uuid4())
-        
-        # Format script according to our model structure
-        formatted_script = {
-            "id": script_id,
-            "book_id": book_id,
-            "title": vn_script.get("title", books[book_id]["title"]),
-            "scenes": []
-        }
-        
-        # Ensure scenes have the correct structure
-        for scene in vn_script.get("scenes", []):
-            formatted_scene = {
-                "id": scene["id"],
-                "background": scene["background"],
-                "characters": [],
-                "dialogue": []
-            }
-            
-            # Format characters
-            for char in scene.get("characters", []):
-                formatted_scene["characters"].append({
-                    "id": char["id"],
-                    "image": char["image"]
-                })
-            
-            # Format dialogue
-            for dialogue in scene.get("dialogue", []):
-                formatted_dialogue = {
-                    "speaker": dialogue["speaker"],
-                    "text": dialogue["text"]
-                }
-                
-                # Add optional fields if present
-                if "character" in dialogue:
-                    formatted_dialogue["character"] = dialogue["character"]
-                
-                if "choices" in dialogue:
-                    formatted_dialogue["choices"] = []
-                    for choice in dialogue["choices"]:
-                        formatted_dialogue["choices"].append({
-                            "text": choice["text"],
-                            "nextScene": choice["nextScene"]
-                        })
-                
-                formatted_scene["dialogue"].append(formatted_dialogue)
-            
-            formatted_script["scenes"].append(formatted_scene)
-        
-        scripts[script_id] = formatted_script
-        
-        # Update book status to ready
-        books[book_id]["status"] = "ready"
-        books[book_id]["progress"] = 100
-        books[book_id]["script_id"] = script_id
-        print(f"Processing book {book_id}: Complete! Book is ready")
-        
-    except Exception as e:
-        # Handle errors
-        books[book_id]["status"] = "error"
-        books[book_id]["error"] = str(e)
-        print(f"Error processing book {book_id}: {e}")
-        import traceback
-        traceback.print_exc()
+@app.on_event("startup")
+async def fail_interrupted_books():
+    # Books with a job are picked up again by a worker; any others caught mid-pipeline can never finish
+    open_jobs = job_queue.book_ids_with_open_jobs()
+    for book_id in store.book_ids_with_status(["uploading", "queued", "processing", "analyzing", "generating", "playable"]):
+        if book_id not in open_jobs:
+            store.update_book(book_id, status="error", error="Processing was interrupted by a server restart")
+
+@app.on_event("startup")
+async def start_worker():
+    if RUN_WORKER_IN_PROCESS:
+        app.state.worker_task = asyncio.create_task(run_worker())
+
+@app.on_event("shutdown")
+async def stop_worker():
+    worker_task = getattr(app.state, "worker_task", None)
+    if worker_task is not None:
+        worker_task.cancel()
+        await asyncio.gather(worker_task, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def stop_lookahead():
+    await lookahead.stop()
+
+@app.on_event("shutdown")
+async def close_http_session():
+    await close_session()
 
 @app.get("/")
 async def root():
@@ -178,7 +140,6 @@ async def root():
 # Routes
 @app.post("/api/books/upload", response_model=Book)
 async def upload_book(
-    background_tasks: BackgroundTasks,
     title: str = Form(...),
     author: str = Form(...),
     file: UploadFile = File(...)
@@ -195,6 +156,7 @@ async def upload_book(
         try:
             contents = await file.read()
             print(f"File size: {len(contents)} bytes")
+            file_hash = hashlib.sha256(contents).hexdigest()
             with open(file_path, "wb") as buffer:
                 buffer.write(contents)
             print(f"File saved to {file_path}")
@@ -208,13 +170,14 @@ async def upload_book(
             "title": title,
             "author": author,
             "file_path": file_path,
-            "status": "uploading",
+            "file_hash": file_hash,
+            "status": "queued",
             "progress": 0
         }
-        books[book_id] = book
+        store.create_book(book)
         
-        # Start processing in background
-        background_tasks.add_task(process_book_task, book_id, file_path)
+        # Queue it for a worker; the job survives restarts until it's done
+        enqueue_book(book_id)
         
         return book
     except Exception as e:
@@ -223,37 +186,79 @@ async def upload_book(
 
 
 @app.get("/api/books", response_model=List[Book])
-async def get_books():
-    return list(books.values())
+async def get_books(limit: int = Query(50, ge=1, le=200), after: Optional[str] = None):
+    """List books in upload order; pass the last id of a page as `after` to get the next one"""
+    try:
+        return await asyncio.to_thread(store.list_books, limit=limit, after=after)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown cursor: no book {after}")
 
 @app.get("/api/books/{book_id}", response_model=Book)
 async def get_book(book_id: str):
-    if book_id not in books:
+    book = await asyncio.to_thread(store.get_book, book_id)
+    if book is None:
         raise HTTPException(status_code=404, detail="Book not found")
-    return books[book_id]
+    return book
+
+@app.get("/api/books/{book_id}/events")
+async def book_progress_events(book_id: str, request: Request):
+    """
+    Stream a book's progress as Server-Sent Events. A "progress" event is
+    sent whenever the status or sub-progress (pages extracted, scenes
+    generated) changes; the stream ends once the book is ready or failed.
+    """
+    if await asyncio.to_thread(store.get_book, book_id) is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    async def stream():
+        last_sent = None
+        last_write = time.monotonic()
+        while True:
+            book = await asyncio.to_thread(store.get_book, book_id)
+            if book is None:
+                break
+            snapshot = progress_snapshot(book)
+            if snapshot != last_sent:
+                last_sent = snapshot
+                last_write = time.monotonic()
+                yield format_event("progress", snapshot)
+            elif time.monotonic() - last_write >= BOOK_EVENTS_KEEPALIVE_SECONDS:
+                last_write = time.monotonic()
+                yield ": keep-alive\n\n"
+            if book["status"] in FINAL_STATUSES or await request.is_disconnected():
+                break
+            # Workers in other processes can't notify us, so re-check the store now and then
+            await book_events.wait(book_id, BOOK_EVENTS_POLL_SECONDS)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
 
 @app.get("/api/books/{book_id}/script", response_model=VNScript)
 async def get_script(book_id: str):
-    if book_id not in books:
+    book = await asyncio.to_thread(store.get_book, book_id)
+    if book is None:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    book = books[book_id]
-    if book["status"] != "ready":
+    # Playable books have a partial script, with markers for what's still pending
+    if book["status"] not in ("playable", "ready"):
         raise HTTPException(status_code=400, detail="Script not ready")
     
+    # Get the raw script
     script_id = book.get("script_id")
-    if not script_id or script_id not in scripts:
+    raw_script = await asyncio.to_thread(store.get_script, script_id) if script_id else None
+    if raw_script is None:
         raise HTTPException(status_code=404, detail="Script not found")
     
-    # Get the raw script
-    raw_script = scripts[script_id]
-    
     # Format it according to our model
     formatted_script = {
         "id": raw_script["id"],
         "book_id": book_id,
         "title": raw_script.get("title", book["title"]),
-        "scenes": []
+        "scenes": [],
+        "pending_scenes": raw_script.get("pending_scenes", []),
+        "complete": raw_script.get("complete", True)
     }
     
     # Format each scene to match our Scene model
@@ -264,6 +269,8 @@ async def get_script(book_id: str):
             "characters": [],
             "dialogue": []
         }
+        if scene.get("pending_images"):
+            formatted_scene["pending_images"] = True
         
         # Format characters
         for char in scene.get("characters", []):
@@ -298,6 +305,37 @@ async def get_script(book_id: str):
     return formatted_script
 
 
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    return book_cache.stats()
+
+@app.get("/api/fetch/stats")
+async def get_fetch_stats():
+    return fetch_stats()
+
+@app.get("/api/jobs/stats")
+async def get_job_stats():
+    return job_queue.stats()
+
+@app.get("/api/lookahead/stats")
+async def get_lookahead_stats():
+    return lookahead.stats
+
+@app.get("/api/llm/stats")
+async def get_llm_stats():
+    return {"calls": llm_stats(), "routes": router.stats(), "cache": llm_cache.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics for this process (workers in other processes aren't included)"""
+    for status, count in job_queue.stats().items():
+        metrics.set("plottwist_jobs", count, status=status)
+    cache = book_cache.stats()
+    metrics.set("plottwist_book_cache_entries", cache["entries"])
+    metrics.set("plottwist_book_cache_bytes", cache["bytes"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     error_details = []
@@ -358,43 +396,132 @@ async def get_scene(scene_id: str, book_id: str):
     Dynamically generate a scene if it doesn't already exist.
     Used for runtime scene generation when players reach new scenes.
     """
-    if book_id not in books:
+    book = await asyncio.to_thread(store.get_book, book_id)
+    if book is None:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    book = books[book_id]
-    
     # Check if we have a script for this book
     script_id = book.get("script_id")
-    if not script_id or script_id not in scripts:
+    script = await asyncio.to_thread(store.get_script, script_id) if script_id else None
+    if script is None:
         raise HTTPException(status_code=404, detail="Script not found")
     
-    script = scripts[script_id]
-    
-    # Check if this scene already exists in the script
+    # Check if this scene already exists in the script (often written ahead by the lookahead engine)
     scene = next((s for s in script["scenes"] if s["id"] == scene_id), None)
     if scene:
         return scene
     
+    # Each book continues its own story; rebuild the session if it was evicted
+    session = await load_session(book_id, script)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Book analysis not found")
+    
     # If scene doesn't exist, generate it
     try:
         # Initialize OpenAI client
         client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", "your-openai-api-key"))
         
         # Generate the new scene
-        new_scene = await vn_generator.generate_next_scene(scene_id, client)
+        new_scene = await generate_next_scene(session, scene_id, client)
         
         # Add the scene to the script
-        script["scenes"].append(new_scene)
+        script = await add_scene_to_script(script_id, scene_id, new_scene)
         
-        # Update the scene graph in the generator
-        vn_generator.update_scene_graph(script)
+        # Update the scene graph for this book
+        update_scene_graph(session, script)
         
         return new_scene
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate scene: {str(e)}")
         
-# Serve static files
-app.mount("/", StaticFiles(directory="static", html=True), name="static")
+@app.get("/api/scenes/{scene_id}/stream")
+async def stream_scene(scene_id: str, book_id: str):
+    """
+    /api/scenes/{scene_id} as Server-Sent Events: a "line" event for each
+    dialogue line as soon as it's written, then a "scene" event with the
+    whole scene and its images (or an "error" event). The scene event has
+    the final dialogue, which differs from the streamed lines only if the
+    completion was unusable and a placeholder scene took its place. A
+    scene that already exists is sent the same way, all at once.
+    """
+    book = await asyncio.to_thread(store.get_book, book_id)
+    if book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    script_id = book.get("script_id")
+    script = await asyncio.to_thread(store.get_script, script_id) if script_id else None
+    if script is None:
+        raise HTTPException(status_code=404, detail="Script not found")
+    scene = next((s for s in script["scenes"] if s["id"] == scene_id), None)
+    session = await load_session(book_id, script) if scene is None else None
+    if scene is None and session is None:
+        raise HTTPException(status_code=404, detail="Book analysis not found")
+    
+    lines = asyncio.Queue()
+    
+    async def generate():
+        client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY", "your-openai-api-key"))
+        new_scene = await generate_next_scene(session, scene_id, client, on_line=lines.put_nowait)
+        # The player reads the dialogue while the images render
+        await enhance_visual_novel({"scenes": [new_scene]}, session.book_analysis.get("characters", []), book_id)
+        update_scene_graph(session, await add_scene_to_script(script_id, scene_id, new_scene))
+        return new_scene
+    
+    async def stream():
+        sent = 0
+        if scene is None:
+            # Generation carries on if the player leaves, so the scene is still saved
+            task = asyncio.ensure_future(generate())
+            task.add_done_callback(lambda _: lines.put_nowait(None))
+            while True:
+                line = await lines.get()
+                if line is None:
+                    break
+                yield format_event("line", {"index": sent, "line": line})
+                sent += 1
+            try:
+                new_scene = task.result()
+            except Exception as e:
+                yield format_event("error", {"detail": f"Failed to generate scene: {str(e)}"})
+                return
+        else:
+            new_scene = scene
+        
+        # Lines not streamed (an existing scene, or one another request wrote)
+        for line in new_scene.get("dialogue", [])[sent:]:
+            yield format_event("line", {"index": sent, "line": line})
+            sent += 1
+        yield format_event("scene", new_scene)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.post("/api/scenes/{scene_id}/visit")
+async def visit_scene(scene_id: str, book_id: str, player_id: Optional[str] = None):
+    """
+    Tell the server a player has reached a scene, so the scenes their
+    choices lead to are written ahead of time. player_id tells apart
+    several players of the same book, each with their own lookahead.
+    Fetching a scene doesn't count as reaching it; clients report every
+    scene they show here, once.
+    """
+    if await asyncio.to_thread(store.get_book, book_id) is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return {"queued": await lookahead.visit(book_id, scene_id, player_id)}
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets clients cache content-addressed images forever"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        # Image names are content hashes, so a URL always means the same bytes
+        if scope["path"].startswith(IMAGE_URL_PATH + "/"):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+# Serve static files (including generated images, with ETag / Last-Modified from StaticFiles)
+app.mount("/", CachedStaticFiles(directory="static", html=True), name="static")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,189 @@
+# File: model_router.py
+"""
+Which model each LLM call site uses.
+
+Models are grouped in tiers, cheapest first. Each call site starts at
+its own tier and, when the output fails its schema check (e.g. a scene
+without dialogue or choices), is retried one tier up, as far as its
+ceiling allows:
+
+    outline = await router.complete(client, "outline", parse, valid, messages=[...])
+
+Escalation stops early once a call has run past the call site's latency
+target or spent past its cost target, and the best output so far is
+returned instead. Per call site, router.stats() reports the tier
+outputs were accepted at, escalations, latency and spend against the
+targets; llm_client.llm_stats() has the token counts per model.
+
+Settings per call site, e.g. for scenes:
+    LLM_SCENE_TIER=draft            tier tried first
+    LLM_SCENE_MAX_TIER=premium      highest tier escalated to
+    LLM_SCENE_LATENCY_TARGET=20     seconds per call, across its attempts
+    LLM_SCENE_COST_TARGET=0.05      USD per call, across its attempts
+"""
+import os
+import time
+
+from llm_client import (chat_completion, stream_completion, completion_cost, count_tokens,
+                        count_message_tokens)
+from telemetry import metrics
+
+# Models by tier, cheapest first (override e.g. with LLM_TIER_DRAFT=gpt-3.5-turbo)
+MODEL_TIERS = {
+    "draft": os.environ.get("LLM_TIER_DRAFT", "gpt-4o-mini"),
+    "standard": os.environ.get("LLM_TIER_STANDARD", "gpt-4o"),
+    "premium": os.environ.get("LLM_TIER_PREMIUM", "gpt-4-turbo"),
+}
+TIER_ORDER = list(MODEL_TIERS)
+
+# Tier each call site starts at. Runtime continuation scenes (written while a
+# player waits, or speculatively ahead of them) start cheap and escalate.
+DEFAULT_TIERS = {
+    "analysis": "premium",
+    "analysis_chunk": "premium",
+    "analysis_summary": "premium",
+    "outline": "premium",
+    "scene": "premium",
+    "scene_batch": "premium",
+    "continuation": "draft",
+}
+
+metrics.describe("plottwist_llm_escalations_total", "counter", "LLM calls retried a tier up after failing their schema check")
+
+def _setting(call_site: str, name: str, default):
+    return os.environ.get(f"LLM_{call_site.upper()}_{name}", default)
+
+def _target(call_site: str, name: str):
+    value = _setting(call_site, name, "")
+    return float(value) if value else None
+
+class Route:
+    """A call site's starting tier, escalation ceiling and targets"""
+
+    def __init__(self, call_site: str):
+        self.call_site = call_site
+        self.tier = _setting(call_site, "TIER", DEFAULT_TIERS.get(call_site, "premium"))
+        self.max_tier = _setting(call_site, "MAX_TIER", "premium")
+        self.latency_target = _target(call_site, "LATENCY_TARGET")
+        self.cost_target = _target(call_site, "COST_TARGET")
+        if self.tier not in MODEL_TIERS or self.max_tier not in MODEL_TIERS:
+            raise ValueError(f"Unknown model tier for {call_site}: {self.tier} / {self.max_tier} "
+                             f"(tiers are {', '.join(TIER_ORDER)})")
+
+    def tiers(self) -> list:
+        """The tiers to try, in order"""
+        first = TIER_ORDER.index(self.tier)
+        return TIER_ORDER[first:max(first, TIER_ORDER.index(self.max_tier)) + 1]
+
+class ModelRouter:
+    def __init__(self):
+        self.routes = {}
+        self._stats = {}
+
+    def route(self, call_site: str) -> Route:
+        if call_site not in self.routes:
+            self.routes[call_site] = Route(call_site)
+        return self.routes[call_site]
+
+    def model(self, call_site: str) -> str:
+        """The model a call site tries first (also what its prompts are counted against)"""
+        return MODEL_TIERS[self.route(call_site).tier]
+
+    async def complete(self, client, call_site: str, parse, valid, on_text=None, **kwargs):
+        """
+        A completion for call_site, parsed with parse(text) and accepted once
+        valid(value) holds, escalating a tier at a time until it does. Returns
+        the accepted value, or failing that the last one parse didn't return
+        None for (or None). kwargs are passed to chat_completion, except the
+        model. With on_text, each attempt is streamed and on_text(chunk)
+        called with its text as it arrives.
+        API errors escalate too, and are raised from the last tier.
+        """
+        route = self.route(call_site)
+        tiers = route.tiers()
+        start = time.perf_counter()
+        spent = 0.0
+        best = None
+        for attempt, tier in enumerate(tiers):
+            model = MODEL_TIERS[tier]
+            last = attempt == len(tiers) - 1
+            try:
+                if on_text is None:
+                    response = await chat_completion(client, call_site, model=model, **kwargs)
+                    text = response.choices[0].message.content or ""
+                else:
+                    parts = []
+                    async for chunk in stream_completion(client, call_site, model=model, **kwargs):
+                        parts.append(chunk)
+                        on_text(chunk)
+                    text = "".join(parts)
+            except Exception as e:
+                if last:
+                    self._record(route, tier, start, spent, accepted=False)
+                    raise
+                print(f"LLM {call_site} failed on {model} ({str(e)}), trying the next tier")
+                metrics.inc("plottwist_llm_escalations_total", call_site=call_site, tier=tier)
+                continue
+
+            # Estimated locally, as the response's usage isn't at hand for streams
+            spent += completion_cost(model, count_message_tokens(kwargs["messages"], model), count_tokens(text, model))
+            value = parse(text)
+            if value is not None:
+                best = value
+            if valid(value):
+                self._record(route, tier, start, spent, accepted=True)
+                return value
+
+            elapsed = time.perf_counter() - start
+            if last:
+                break
+            if route.latency_target is not None and elapsed > route.latency_target:
+                print(f"LLM {call_site}: {model} output failed validation, past the latency target; keeping it")
+                break
+            if route.cost_target is not None and spent > route.cost_target:
+                print(f"LLM {call_site}: {model} output failed validation, past the cost target; keeping it")
+                break
+            print(f"LLM {call_site}: {model} output failed validation, escalating to {MODEL_TIERS[tiers[attempt + 1]]}")
+            metrics.inc("plottwist_llm_escalations_total", call_site=call_site, tier=tier)
+        self._record(route, tier, start, spent, accepted=False)
+        return best
+
+    def _record(self, route: Route, tier: str, start: float, spent: float, accepted: bool):
+        seconds = time.perf_counter() - start
+        stats = self._stats.setdefault(route.call_site, {
+            "calls": 0, "accepted": {}, "escalated": 0, "rejected": 0, "seconds": 0.0, "max_seconds": 0.0,
+            "cost_usd": 0.0, "over_latency_target": 0, "over_cost_target": 0
+        })
+        stats["calls"] += 1
+        if accepted:
+            stats["accepted"][tier] = stats["accepted"].get(tier, 0) + 1
+        else:
+            stats["rejected"] += 1
+        stats["escalated"] += tier != route.tier
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["cost_usd"] += spent
+        stats["over_latency_target"] += route.latency_target is not None and seconds > route.latency_target
+        stats["over_cost_target"] += route.cost_target is not None and spent > route.cost_target
+
+    def stats(self) -> dict:
+        """
+        Per call site: its route, the tiers outputs were accepted at, calls
+        that escalated or ended without valid output, mean and max seconds
+        and mean (estimated) spend per call, and calls over the targets
+        """
+        report = {}
+        for call_site, stats in self._stats.items():
+            route = self.route(call_site)
+            report[call_site] = dict(
+                stats,
+                tier=route.tier, max_tier=route.max_tier,
+                latency_target=route.latency_target, cost_target=route.cost_target,
+                seconds=round(stats["seconds"], 3), max_seconds=round(stats["max_seconds"], 3),
+                cost_usd=round(stats["cost_usd"], 6),
+                mean_seconds=round(stats["seconds"] / stats["calls"], 3),
+                mean_cost_usd=round(stats["cost_usd"] / stats["calls"], 6)
+            )
+        return report
+
+router = ModelRouter()
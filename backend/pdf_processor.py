@@ -1,69 +1,320 @@
 # File: pdf_processor.py
 import asyncio
+import os
+import queue
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader
-import io
 
-async def process_pdf(file_path: str) -> dict:
+# Bump whenever the extraction output changes, so cached extractions are not reused
+EXTRACTION_VERSION = "2"
+
+# Number of worker processes used for page extraction (1 = extract in a single thread)
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", "1"))
+
+# Short books are not worth the cost of handing pages to other processes
+PARALLEL_MIN_PAGES = 40
+
+# Pages extracted ahead of the consumer when streaming
+PAGE_BUFFER = 16
+
+# Upper bound on pages per process pool task when streaming
+PAGES_PER_TASK = 25
+
+# Lines that open a part or chapter, used when the PDF has no outline.
+# Group 1 matches divisions above chapter level.
+HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:(part|book)|chapter|prologue|epilogue)\b[^\n]{0,60}$", re.IGNORECASE | re.MULTILINE
+)
+
+# Sentinel marking the end of a page stream
+_DONE = object()
+
+# Shared process pools by worker count, each created on first use
+_process_pools = {}
+
+def _page_record(index, text):
+    """Build the content record for a single page"""
+    if text:
+        return {
+            "page": index + 1,
+            "content": text
+        }
+    return {
+        "page": index + 1,
+        "content": f"[Page {index+1} has no extractable text]"
+    }
+
+def extract_page_range(file_path: str, start: int, end: int) -> list:
     """
-    Extract text and structure from a PDF file
-    Returns dictionary with raw text and metadata
+    Extract the text of pages [start, end) from a PDF file
+    Runs inside a worker process, so it opens its own PdfReader
+    """
+    with open(file_path, "rb") as file:
+        pdf = PdfReader(file)
+        return [_page_record(i, pdf.pages[i].extract_text()) for i in range(start, end)]
+
+def read_metadata(pdf) -> dict:
+    """Read title, author and page count from an open PdfReader"""
+    if pdf.metadata:
+        return {
+            "title": pdf.metadata.get("/Title", ""),
+            "author": pdf.metadata.get("/Author", ""),
+            "pages": len(pdf.pages)
+        }
+    return {
+        "title": "",
+        "author": "",
+        "pages": len(pdf.pages)
+    }
+
+def read_outline(pdf) -> list:
+    """Flatten the PDF outline (bookmarks) into {"title", "level", "page"} entries in page order"""
+    entries = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):
+                # A nested list holds the children of the previous entry
+                walk(item, level + 1)
+                continue
+            try:
+                page = pdf.get_destination_page_number(item)
+            except Exception:
+                continue
+            if page is not None and page >= 0:
+                entries.append({"title": str(item.title).strip(), "level": level, "page": page + 1})
+
+    try:
+        walk(pdf.outline, 0)
+    except Exception as e:
+        print(f"Error reading PDF outline: {str(e)}")
+    return sorted(entries, key=lambda entry: entry["page"])
+
+def find_headings(text: str) -> list:
+    """(offset, title, level) of every heading line in a page's text"""
+    return [
+        (match.start(), match.group(0).strip(), 0 if match.group(1) else 1)
+        for match in HEADING_PATTERN.finditer(text)
+    ]
+
+class StructureIndex:
+    """
+    Chapter and section index of a book, built page by page as it is extracted.
+    Sections come from the PDF outline when there is one, otherwise from
+    heading lines. Character offsets are into the book text with pages
+    joined by a blank line ("\n\n"), as the analyzers read it.
+    """
+
+    def __init__(self, outline: list = None):
+        self.outline = outline or []
+        self.page_offsets = []   # Character offset at which each page starts
+        self.headings = []
+        self.total_chars = 0
+
+    def add(self, page: dict):
+        text = page["content"]
+        self.page_offsets.append(self.total_chars)
+        if not self.outline:
+            for offset, title, level in find_headings(text):
+                # Running headers repeat the chapter title on every page
+                if self.headings and self.headings[-1]["title"] == title:
+                    continue
+                self.headings.append({"title": title, "level": level, "page": page["page"],
+                                      "char_start": self.total_chars + offset})
+        self.total_chars += len(text) + 2
+
+    def sections(self) -> list:
+        if self.outline:
+            entries = [
+                dict(entry, char_start=self.page_offsets[entry["page"] - 1])
+                for entry in self.outline if entry["page"] <= len(self.page_offsets)
+            ]
+        else:
+            entries = [dict(heading) for heading in self.headings]
+
+        # A section runs until the next one at the same or a higher level
+        for i, entry in enumerate(entries):
+            following = next((other for other in entries[i + 1:] if other["level"] <= entry["level"]), None)
+            entry["char_end"] = following["char_start"] if following else self.total_chars
+            # Last page with text of this section (shared with the next one if it starts mid-page)
+            entry["page_end"] = following["page"] if following else len(self.page_offsets)
+        return entries
+
+    def to_dict(self) -> dict:
+        source = "outline" if self.outline else ("headings" if self.headings else "none")
+        return {"source": source, "sections": self.sections(), "total_chars": self.total_chars}
+
+def section_start_pages(structure: dict) -> list:
+    """0-based indexes of the pages where top-level sections start"""
+    sections = (structure or {}).get("sections") or []
+    if not sections:
+        return []
+    top = min(section["level"] for section in sections)
+    return sorted({section["page"] - 1 for section in sections if section["level"] == top})
+
+def split_page_range(page_count: int, chunks: int) -> list:
+    """Split page indexes into contiguous (start, end) ranges of near-equal size"""
+    chunks = max(1, min(chunks, page_count))
+    size, extra = divmod(page_count, chunks)
+    ranges = []
+    start = 0
+    for i in range(chunks):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def _get_process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Return the shared extraction pool with this many workers. Pools are
+    never resized or shut down, since extractions may still be using them.
+    """
+    pool = _process_pools.get(workers)
+    if pool is None:
+        pool = _process_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return pool
+
+def _finish(metadata, text_content, structure=None):
+    """Wrap extracted pages in the result shape used by the rest of the pipeline"""
+    # If no text was extracted at all, add a placeholder
+    if not text_content:
+        text_content.append({
+            "page": 1,
+            "content": "This document appears to have no extractable text content."
+        })
+    return {
+        "metadata": metadata,
+        "content": text_content,
+        "structure": structure or {"source": "none", "sections": [], "total_chars": 0}
+    }
+
+def _error_result(e):
+    print(f"Error extracting PDF content: {str(e)}")
+    # Return minimal content to avoid breaking the pipeline
+    return {
+        "metadata": {"title": "", "author": "", "pages": 0},
+        "content": [{"page": 1, "content": "Error extracting content from PDF."}],
+        "structure": {"source": "none", "sections": [], "total_chars": 0}
+    }
+
+async def read_pdf_metadata(file_path: str) -> dict:
+    """Read the PDF metadata (title, author, page count) without extracting any text"""
+    def read():
+        with open(file_path, "rb") as file:
+            return read_metadata(PdfReader(file))
+
+    return await asyncio.to_thread(read)
+
+async def read_pdf_outline(file_path: str) -> list:
+    """Read the PDF outline (bookmarks) as flat {"title", "level", "page"} entries"""
+    def read():
+        with open(file_path, "rb") as file:
+            return read_outline(PdfReader(file))
+
+    return await asyncio.to_thread(read)
+
+async def iter_pdf_pages(file_path: str, workers: int = None, page_count: int = None):
+    """
+    Yield {"page", "content"} records in page order as they are extracted
+
+    At most PAGE_BUFFER pages (or `workers` in-flight page ranges in parallel
+    mode) are held at once, so memory stays flat however long the book is.
     """
-    # Run PDF processing in a separate thread to avoid blocking
-    def extract_text():
+    workers = workers or PDF_EXTRACT_WORKERS
+    if page_count is None and workers > 1:
+        page_count = (await read_pdf_metadata(file_path))["pages"]
+
+    if workers > 1 and page_count >= PARALLEL_MIN_PAGES:
+        async for record in _iter_pages_parallel(file_path, workers, page_count):
+            yield record
+        return
+
+    # Serial mode: a thread extracts pages and hands them over through a bounded queue
+    pages = queue.Queue(maxsize=PAGE_BUFFER)
+    stop = threading.Event()
+
+    def hand_over(item):
+        # Block while the consumer is behind, but give up if it went away
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
         try:
-            text_content = []
-            metadata = {}
-            
-            # Open and read the PDF file
             with open(file_path, "rb") as file:
                 pdf = PdfReader(file)
-                
-                # Extract metadata
-                if pdf.metadata:
-                    metadata = {
-                        "title": pdf.metadata.get("/Title", ""),
-                        "author": pdf.metadata.get("/Author", ""),
-                        "pages": len(pdf.pages)
-                    }
-                else:
-                    metadata = {
-                        "title": "",
-                        "author": "",
-                        "pages": len(pdf.pages)
-                    }
-                
-                # Extract text from each page
                 for i, page in enumerate(pdf.pages):
-                    text = page.extract_text()
-                    if text:
-                        text_content.append({
-                            "page": i + 1,
-                            "content": text
-                        })
-                    else:
-                        text_content.append({
-                            "page": i + 1,
-                            "content": f"[Page {i+1} has no extractable text]"
-                        })
-                
-                # If no text was extracted at all, add a placeholder
-                if not text_content:
-                    text_content.append({
-                        "page": 1,
-                        "content": "This document appears to have no extractable text content."
-                    })
-                
-            return {
-                "metadata": metadata,
-                "content": text_content
-            }
+                    if not hand_over(_page_record(i, page.extract_text())):
+                        return
+            hand_over(_DONE)
         except Exception as e:
-            print(f"Error extracting PDF content: {str(e)}")
-            # Return minimal content to avoid breaking the pipeline
-            return {
-                "metadata": {"title": "", "author": "", "pages": 0},
-                "content": [{"page": 1, "content": "Error extracting content from PDF."}]
-            }
-    
-    # Run in thread pool to avoid blocking the event loop
-    return await asyncio.to_thread(extract_text)
\ No newline at end of file
+            hand_over(e)
+
+    def take():
+        # Poll, so the executor thread is freed once the consumer went away
+        while not stop.is_set():
+            try:
+                return pages.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            record = await asyncio.to_thread(take)
+            if record is _DONE:
+                break
+            if isinstance(record, Exception):
+                raise record
+            yield record
+    finally:
+        stop.set()
+
+async def _iter_pages_parallel(file_path, workers, page_count):
+    """Stream page ranges from the process pool, keeping `workers` ranges in flight"""
+    loop = asyncio.get_running_loop()
+    pool = _get_process_pool(workers)
+    chunks = max(workers * 4, -(-page_count // PAGES_PER_TASK))
+    ranges = deque(split_page_range(page_count, chunks))
+    in_flight = deque()
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < workers:
+                start, end = ranges.popleft()
+                in_flight.append(loop.run_in_executor(pool, extract_page_range, file_path, start, end))
+            for record in await in_flight.popleft():
+                yield record
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+async def process_pdf(file_path: str, workers: int = None, on_page=None) -> dict:
+    """
+    Extract text and structure from a PDF file
+    Returns dictionary with raw text, metadata and a chapter/section index
+
+    With workers > 1 the page range is split across a process pool, each
+    worker opening its own PdfReader; pages are merged back in page order.
+    on_page(pages_done, page_count) is called as pages come in.
+    """
+    try:
+        metadata = await read_pdf_metadata(file_path)
+        index = StructureIndex(await read_pdf_outline(file_path))
+        text_content = []
+        async for page in iter_pdf_pages(file_path, workers, metadata["pages"]):
+            text_content.append(page)
+            index.add(page)
+            if on_page:
+                on_page(len(text_content), metadata["pages"])
+        return _finish(metadata, text_content, index.to_dict())
+    except Exception as e:
+        return _error_result(e)
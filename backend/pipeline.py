@@ -0,0 +1,269 @@
+# File: pipeline.py
+import asyncio
+import os
+import uuid
+
+from pdf_processor import (process_pdf, read_pdf_metadata, read_pdf_outline, iter_pdf_pages,
+                           section_start_pages, EXTRACTION_VERSION)
+from book_analyzer import analyze_book, analyze_book_stream, analysis_cache_tag, ANALYSIS_MODE
+from chunked_analysis import analyze_book_chunked, iter_book_pages
+from disk_cache import book_cache, sha256_file
+from storage import store
+from vn_generator import generate_visual_novel, load_checkpoint, save_checkpoint
+from book_events import book_events, FINAL_STATUSES
+from telemetry import span, cache_hit, book_timings, current_book
+
+# Stream pages straight into analysis instead of extracting the whole book first
+STREAM_PDF_PAGES = os.environ.get("STREAM_PDF_PAGES", "").lower() in ("1", "true", "yes")
+
+def update_book(book_id: str, **fields) -> dict:
+    """
+    Update a book record and wake any progress streams watching it.
+    While the book is being processed here, its timing breakdown so far
+    is saved along with every update.
+    """
+    timings = current_book.get()
+    if timings is not None and timings.book_id == book_id:
+        if fields.get("status") and fields["status"] != timings.stage:
+            timings.enter_stage(None if fields["status"] in FINAL_STATUSES else fields["status"])
+        fields["timings"] = timings.summary()
+    book = store.update_book(book_id, **fields)
+    book_events.notify(book_id)
+    return book
+
+def page_progress(book_id: str, start: int, end: int):
+    """
+    on_page callback recording extraction progress, mapped onto the
+    start..end range of the overall progress bar. Writes about every 5%.
+    """
+    last_reported = 0
+    
+    def on_page(pages_done: int, pages_total: int):
+        nonlocal last_reported
+        if pages_done < pages_total and pages_done - last_reported < max(1, pages_total // 20):
+            return
+        last_reported = pages_done
+        update_book(book_id, pages_extracted=pages_done, pages_total=pages_total,
+                    progress=start + (end - start) * pages_done // max(pages_total, 1))
+    
+    return on_page
+
+async def count_pages(pages, on_page, pages_total: int):
+    """Pass pages through, reporting each one to on_page"""
+    pages_done = 0
+    async for page in pages:
+        pages_done += 1
+        on_page(pages_done, pages_total)
+        yield page
+
+async def extract_book(file_hash: str, file_path: str, on_page=None) -> dict:
+    """process_pdf, served from the book cache when this exact file was extracted before"""
+    cache_key = f"extract:{file_hash}:{EXTRACTION_VERSION}"
+    book_content = await asyncio.to_thread(book_cache.get, cache_key)
+    if book_content is not None:
+        print(f"Using cached extraction for {file_hash[:12]}")
+        cache_hit("extract", "pdf")
+        if on_page:
+            pages = book_content["metadata"]["pages"]
+            on_page(pages, pages)
+        return book_content
+    
+    with span("extract", "pdf") as extraction:
+        book_content = await process_pdf(file_path, on_page=on_page)
+        extraction.set(pages=book_content["metadata"].get("pages", 0))
+        if not book_content["metadata"].get("pages"):
+            extraction.fail("no pages extracted")
+    # Don't cache the placeholder returned when extraction fails
+    if book_content["metadata"].get("pages"):
+        await asyncio.to_thread(book_cache.set, cache_key, book_content)
+    return book_content
+
+def format_scene(scene: dict) -> dict:
+    """A generated scene in the structure of the Scene model"""
+    formatted_scene = {
+        "id": scene["id"],
+        "background": scene["background"],
+        "characters": [],
+        "dialogue": []
+    }
+    if scene.get("pending_images"):
+        formatted_scene["pending_images"] = True
+    
+    # Format characters
+    for char in scene.get("characters", []):
+        formatted_scene["characters"].append({
+            "id": char["id"],
+            "image": char["image"]
+        })
+    
+    # Format dialogue
+    for dialogue in scene.get("dialogue", []):
+        formatted_dialogue = {
+            "speaker": dialogue["speaker"],
+            "text": dialogue["text"]
+        }
+        
+        # Add optional fields if present
+        if "character" in dialogue:
+            formatted_dialogue["character"] = dialogue["character"]
+        
+        if "choices" in dialogue:
+            formatted_dialogue["choices"] = []
+            for choice in dialogue["choices"]:
+                formatted_dialogue["choices"].append({
+                    "text": choice["text"],
+                    "nextScene": choice["nextScene"]
+                })
+        
+        formatted_scene["dialogue"].append(formatted_dialogue)
+    
+    return formatted_scene
+
+def save_script(script_id: str, book_id: str, vn_script: dict, pending_scenes=None):
+    """
+    Save a script, whole or partial (with the IDs of the scenes still being
+    written in pending_scenes). Scenes already saved under script_id that it
+    lacks, such as ones generated on demand while the book was playable,
+    are kept.
+    """
+    formatted_script = {
+        "id": script_id,
+        "book_id": book_id,
+        "title": vn_script.get("title"),
+        "scenes": [format_scene(scene) for scene in vn_script.get("scenes", [])],
+        "pending_scenes": list(pending_scenes or []),
+        "complete": not pending_scenes
+    }
+    
+    def merge(saved):
+        if saved:
+            scene_ids = {scene["id"] for scene in formatted_script["scenes"]}
+            formatted_script["scenes"] += [scene for scene in saved.get("scenes", []) if scene["id"] not in scene_ids]
+        return formatted_script
+    
+    # Merged in one transaction, so a scene added meanwhile isn't lost
+    return store.update_script(script_id, merge)
+
+async def process_book(book_id: str, file_path: str, checkpoints=None):
+    """
+    Run the whole pipeline for a book: extract, analyze, write the script
+    and its images, then save it and mark the book ready. Raises on failure.
+    The book is playable (with a partial script) as soon as its entry scene
+    and that scene's background are done.
+    With checkpoints, each finished stage is saved and skipped on a rerun.
+    Where the time went is kept on the book record as "timings".
+    """
+    with book_timings(book_id):
+        await _process_book(book_id, file_path, checkpoints)
+
+async def _process_book(book_id: str, file_path: str, checkpoints=None):
+    # Update status to processing
+    book = update_book(book_id, status="processing", progress=10, error=None)
+    print(f"Processing book {book_id}: Extracting PDF content")
+    
+    # Resume after the analysis if an earlier attempt got that far
+    book_analysis = await load_checkpoint(checkpoints, "analyzed")
+    analysis_resumed = book_analysis is not None
+    
+    # Re-uploads of the same file reuse the earlier analysis
+    file_hash = book.get("file_hash") or await asyncio.to_thread(sha256_file, file_path)
+    analysis_key = f"analysis:{file_hash}:{analysis_cache_tag()}"
+    if book_analysis is None:
+        book_analysis = await asyncio.to_thread(book_cache.get, analysis_key)
+    analysis_cached = book_analysis is not None
+    
+    if analysis_resumed:
+        print(f"Processing book {book_id}: Resuming from saved analysis")
+    elif analysis_cached:
+        print(f"Processing book {book_id}: Using cached analysis, skipping extraction")
+    elif STREAM_PDF_PAGES:
+        # Extraction and analysis sampling run together, page by page
+        metadata = await read_pdf_metadata(file_path)
+        # Only the outline is known before the pages are read
+        chapter_pages = section_start_pages({"sections": await read_pdf_outline(file_path)})
+        update_book(book_id, status="analyzing")
+        pages = count_pages(iter_pdf_pages(file_path, page_count=metadata["pages"]),
+                            page_progress(book_id, 10, 55), metadata["pages"])
+        if ANALYSIS_MODE == "map_reduce":
+            book_analysis = await analyze_book_chunked(metadata, pages, chapter_pages=chapter_pages)
+        else:
+            book_analysis = await analyze_book_stream(metadata, pages, anchors=chapter_pages)
+    else:
+        # Extract text from PDF
+        book_content = await load_checkpoint(checkpoints, "extracted")
+        if book_content is None:
+            book_content = await extract_book(file_hash, file_path, page_progress(book_id, 10, 30))
+            await save_checkpoint(checkpoints, "extracted", book_content)
+        update_book(book_id, progress=30)
+        print(f"Processing book {book_id}: PDF extraction complete, analyzing content")
+        
+        # Analyze book content
+        update_book(book_id, status="analyzing")
+        if ANALYSIS_MODE == "map_reduce":
+            book_analysis = await analyze_book_chunked(book_content["metadata"], iter_book_pages(book_content),
+                                                       chapter_pages=section_start_pages(book_content.get("structure")))
+        else:
+            book_analysis = await analyze_book(book_content)
+    
+    if not analysis_cached and not book_analysis.get("placeholder"):
+        await asyncio.to_thread(book_cache.set, analysis_key, book_analysis)
+    await save_checkpoint(checkpoints, "analyzed", book_analysis)
+    # Kept with the book so its story session can be rebuilt later
+    await asyncio.to_thread(store.save_analysis, book_id, book_analysis)
+    update_book(book_id, progress=60)
+    print(f"Processing book {book_id}: Analysis complete, generating script")
+    
+    # Generate visual novel script
+    update_book(book_id, status="generating")
+    
+    def on_scene(scenes_done, scenes_total):
+        update_book(book_id, scenes_generated=scenes_done, scenes_total=scenes_total,
+                    progress=60 + 25 * scenes_done // max(scenes_total, 1))
+    
+    # Partial scripts are saved under the same ID as the finished one
+    script_id = book.get("script_id") or str(uuid.uuid4())
+    playable = False
+    latest = None    # Newest snapshot not saved yet
+    saver = None     # Task saving snapshots, off the event loop
+    
+    async def save_partials():
+        nonlocal latest, playable
+        # Snapshots that came in during a save are coalesced into the newest
+        while latest is not None:
+            snapshot, latest = latest, None
+            try:
+                await asyncio.to_thread(save_script, script_id, book_id, snapshot, snapshot["pending_scenes"])
+            except Exception as e:
+                print(f"Processing book {book_id}: Could not save the partial script: {str(e)}")
+                continue
+            if not playable:
+                # The entry scene can be played while the rest fills in
+                playable = True
+                update_book(book_id, status="playable", script_id=script_id)
+                print(f"Processing book {book_id}: Entry scene ready, book is playable")
+    
+    def on_partial(snapshot):
+        nonlocal latest, saver
+        if not snapshot["playable"]:
+            return
+        latest = snapshot
+        if saver is None or saver.done():
+            saver = asyncio.ensure_future(save_partials())
+    
+    try:
+        vn_script = await generate_visual_novel(book_analysis, book_id, on_scene, checkpoints, on_partial)
+    finally:
+        # A partial save still running lands before the final script (or the book's error status)
+        if saver is not None:
+            await asyncio.gather(saver, return_exceptions=True)
+    # Stage timings and critical path of script and image generation
+    update_book(book_id, progress=90, stage_timings=vn_script.get("timings"))
+    print(f"Processing book {book_id}: Script generation complete")
+    
+    # Save the generated script
+    await asyncio.to_thread(save_script, script_id, book_id, dict(vn_script, title=vn_script.get("title", book["title"])))
+    
+    # Update book status to ready
+    update_book(book_id, status="ready", progress=100, script_id=script_id)
+    print(f"Processing book {book_id}: Complete! Book is ready")
+
@@ -0,0 +1,75 @@
+# File: stage_graph.py
+import asyncio
+import time
+
+class StageGraph:
+    """
+    Runs named async stages as soon as the stages they depend on finish.
+    A stage is called with its dependencies' results, in order. Stages can
+    be added while others run, so work discovered along the way (e.g. one
+    background per written scene) joins the same graph.
+
+    Start and end times are recorded for every stage to report the
+    critical path: the chain of dependent stages that set the total time.
+    """
+
+    def __init__(self, name: str = "pipeline"):
+        self.name = name
+        self.started = time.perf_counter()
+        self.tasks = {}
+        self.deps = {}
+        self.timings = {}  # Stage name -> (start, end) relative to graph start
+
+    def add(self, name: str, stage, *deps) -> asyncio.Task:
+        """Schedule stage(*dep_results) to run once every stage in deps is done"""
+        if name in self.tasks:
+            return self.tasks[name]
+        dep_tasks = [self.tasks[dep] for dep in deps]
+
+        async def run():
+            results = [await task for task in dep_tasks]
+            start = time.perf_counter() - self.started
+            try:
+                return await stage(*results)
+            finally:
+                self.timings[name] = (start, time.perf_counter() - self.started)
+
+        self.deps[name] = deps
+        self.tasks[name] = asyncio.create_task(run())
+        return self.tasks[name]
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    def critical_path(self) -> list:
+        """The chain of stages, first to last, that finished last at each step"""
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = []
+        while name is not None:
+            path.append(name)
+            finished = [dep for dep in self.deps.get(name, ()) if dep in self.timings]
+            name = max(finished, key=lambda n: self.timings[n][1]) if finished else None
+        return path[::-1]
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        path = self.critical_path()
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "stage_seconds": round(sum(end - start for start, end in self.timings.values()), 3),
+            "critical_path": [
+                {"stage": name, "start": round(self.timings[name][0], 3),
+                 "seconds": round(self.timings[name][1] - self.timings[name][0], 3)}
+                for name in path
+            ]
+        }
+
+    def print_report(self):
+        report = self.report()
+        chain = " -> ".join(f"{step['stage']} ({step['seconds']:.1f}s)" for step in report["critical_path"])
+        print(f"{self.name}: {report['elapsed_seconds']:.1f}s elapsed, "
+              f"{report['stage_seconds']:.1f}s of stage work; critical path: {chain}")
+        return report
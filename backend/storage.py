@@ -0,0 +1,195 @@
+# File: storage.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_books_status ON books(status);
+
+CREATE TABLE IF NOT EXISTS scripts (
+    id TEXT PRIMARY KEY,
+    book_id TEXT NOT NULL,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scripts_book_id ON scripts(book_id);
+
+CREATE TABLE IF NOT EXISTS analyses (
+    book_id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+def compress_json(value) -> bytes:
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"), 6)
+
+def decompress_json(blob: bytes):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+class BookStore:
+    """
+    SQLite-backed storage for book records and generated scripts.
+    Book records are small JSON documents; scripts are stored as
+    zlib-compressed JSON blobs since they can grow large.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    # Books
+
+    def create_book(self, book: dict) -> dict:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO books (id, status, data, updated_at) VALUES (?, ?, ?, ?)",
+                (book["id"], book["status"], json.dumps(book), time.time())
+            )
+        return book
+
+    def get_book(self, book_id: str):
+        """Return the book record, or None if it doesn't exist"""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM books WHERE id = ?", (book_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_book(self, book_id: str, **fields) -> dict:
+        """
+        Merge fields into a book record and return the updated record. Read
+        and write happen in one transaction, so workers in other processes
+        updating the same book can't drop each other's fields.
+        """
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock before the read
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM books WHERE id = ?", (book_id,)).fetchone()
+                if row is None:
+                    raise KeyError(book_id)
+                book = json.loads(row[0])
+                book.update(fields)
+                self._conn.execute(
+                    "UPDATE books SET status = ?, data = ?, updated_at = ? WHERE id = ?",
+                    (book["status"], json.dumps(book), time.time(), book_id)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return book
+
+    def list_books(self, limit: int = 50, after: str = None, status: str = None) -> list:
+        """
+        Return up to `limit` books in upload order, starting after the book
+        with id `after`. Uses the rowid as a cursor, so each page costs
+        O(limit) no matter how many books there are. Raises KeyError if
+        there is no book `after`, rather than starting over from the first.
+        """
+        query = "SELECT data FROM books WHERE 1 = 1"
+        params = []
+        if after:
+            query += " AND seq > ?"
+            params.append(self._book_seq(after))
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY seq LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _book_seq(self, book_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM books WHERE id = ?", (book_id,)).fetchone()
+        if row is None:
+            raise KeyError(book_id)
+        return row[0]
+
+    def book_ids_with_status(self, statuses) -> list:
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id FROM books WHERE status IN ({placeholders})", list(statuses)).fetchall()
+        return [row[0] for row in rows]
+
+    # Scripts
+
+    def save_script(self, script: dict):
+        blob = compress_json(script)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scripts (id, book_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                (script["id"], script["book_id"], blob, time.time())
+            )
+
+    def update_script(self, script_id: str, update) -> dict:
+        """
+        Read, change and save a script in one transaction, so concurrent
+        updates (from this process or another) can't drop each other's
+        changes. update(script) gets the saved script, or None if there is
+        none yet, and returns the script to save.
+        """
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock before the read
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT data FROM scripts WHERE id = ?", (script_id,)).fetchone()
+                script = update(decompress_json(row[0]) if row else None)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO scripts (id, book_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (script["id"], script["book_id"], compress_json(script), time.time())
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return script
+
+    def get_script(self, script_id: str):
+        """Return the script, or None if it doesn't exist"""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM scripts WHERE id = ?", (script_id,)).fetchone()
+        return decompress_json(row[0]) if row else None
+
+    # Analyses, kept so story sessions can be rebuilt after a restart
+
+    def save_analysis(self, book_id: str, analysis: dict):
+        blob = compress_json(analysis)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analyses (book_id, data, updated_at) VALUES (?, ?, ?)",
+                (book_id, blob, time.time())
+            )
+
+    def get_analysis(self, book_id: str):
+        """Return the book's analysis, or None if it doesn't exist"""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM analyses WHERE book_id = ?", (book_id,)).fetchone()
+        return decompress_json(row[0]) if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Location of the database; ":memory:" keeps everything in-process
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "data/plottwist.db")
+
+store = BookStore(DATABASE_PATH)
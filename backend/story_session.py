@@ -0,0 +1,74 @@
+# File: story_session.py
+import os
+import time
+from collections import OrderedDict
+
+# Bounds on how many books' story state a worker keeps in memory
+STORY_SESSION_MAX = int(os.environ.get("STORY_SESSION_MAX", "100"))
+STORY_SESSION_IDLE_SECONDS = float(os.environ.get("STORY_SESSION_IDLE_SECONDS", "1800"))
+
+class StorySession:
+    """Story continuation state for a single book"""
+
+    def __init__(self, book_id: str, book_analysis: dict):
+        self.book_id = book_id
+        self.book_analysis = book_analysis    # Book analysis for reference
+        self.generated_scenes = {}            # All generated scenes by ID
+        self.scene_graph = {}                 # Connections between scenes
+        self.in_progress_scenes = {}          # Scene ID -> future of a generation under way
+        self.last_used = time.monotonic()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+class StorySessionRegistry:
+    """
+    Holds story sessions by book ID. Sessions idle for longer than
+    idle_seconds are dropped, and the least recently used ones go first
+    once there are more than max_sessions. A dropped session can be
+    rebuilt from the stored analysis and script.
+    """
+
+    def __init__(self, max_sessions: int = STORY_SESSION_MAX, idle_seconds: float = STORY_SESSION_IDLE_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        self.on_evict = []    # Callbacks taking the book ID of each dropped session
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, book_id: str):
+        """Return the session for a book, or None if it isn't loaded"""
+        self.evict_idle()
+        session = self._sessions.get(book_id)
+        if session is not None:
+            session.touch()
+            self._sessions.move_to_end(book_id)
+        return session
+
+    def create(self, book_id: str, book_analysis: dict) -> StorySession:
+        """Start a fresh session for a book, replacing any existing one"""
+        session = StorySession(book_id, book_analysis)
+        self._sessions[book_id] = session
+        self._sessions.move_to_end(book_id)
+        self.evict_idle()
+        while len(self._sessions) > self.max_sessions:
+            evicted_id, _ = self._sessions.popitem(last=False)
+            print(f"Evicting story session for book {evicted_id}")
+            self._evicted(evicted_id)
+        return session
+
+    def _evicted(self, book_id: str):
+        for callback in self.on_evict:
+            callback(book_id)
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        for book_id in [bid for bid, s in self._sessions.items() if s.last_used < cutoff]:
+            # Sessions with scenes still being written are kept alive
+            if not self._sessions[book_id].in_progress_scenes:
+                del self._sessions[book_id]
+                self._evicted(book_id)
+
+story_sessions = StorySessionRegistry()
@@ -0,0 +1,238 @@
+# File: telemetry.py
+"""
+Spans around the slow parts of book processing (PDF extraction, LLM calls,
+image generation and downloads, scene validation) and the metrics built
+from them.
+
+    with span("llm", call_site) as s:
+        response = ...
+        s.set(prompt_tokens=..., completion_tokens=...)
+
+Every span feeds the process-wide metrics served on /metrics in the
+Prometheus text format, and the timing breakdown of the book being
+processed (set with book_timings, inherited by the tasks and threads it
+starts). Workers running in other processes keep their own metrics;
+per-book breakdowns are saved on the book record, so they show up
+wherever the book is read.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram buckets for span durations, in seconds
+SPAN_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Span attributes that are added up (into counters and the per-book breakdown)
+SUMMED_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "cost_usd", "bytes", "pages", "retries")
+
+# Book whose breakdown spans are added to
+current_book = contextvars.ContextVar("current_book", default=None)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())) + "}"
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}      # Metric name -> (type, help text)
+        self._values = {}    # (name, labels tuple) -> value, for counters and gauges
+        self._histograms = {}  # (name, labels tuple) -> [bucket counts, sum, count]
+
+    def describe(self, metric: str, kind: str, help_text: str):
+        self._help[metric] = (kind, help_text)
+
+    def inc(self, metric: str, value: float = 1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, metric: str, value: float, **labels):
+        with self._lock:
+            self._values[(metric, tuple(sorted(labels.items())))] = value
+
+    def observe(self, metric: str, value: float, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(SPAN_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(SPAN_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted(self._histograms.items())
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in values:
+            header(name)
+            lines.append(f"{name}{_labels(dict(labels))} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name)
+            for bound, bucket_count in zip(SPAN_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{_labels(dict(labels, le=bound))} {bucket_count}")
+            lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {count}")
+            lines.append(f"{name}_sum{_labels(dict(labels))} {round(total, 6)}")
+            lines.append(f"{name}_count{_labels(dict(labels))} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("plottwist_span_seconds", "histogram", "Duration of pipeline operations")
+metrics.describe("plottwist_span_failures_total", "counter", "Pipeline operations that failed")
+metrics.describe("plottwist_cache_hits_total", "counter", "Operations answered from a cache")
+metrics.describe("plottwist_llm_tokens_total", "counter", "LLM tokens by call site and type")
+metrics.describe("plottwist_llm_cost_usd_total", "counter", "LLM spend at list price by call site and model")
+metrics.describe("plottwist_llm_first_token_seconds", "histogram", "Time to the first token of streamed completions")
+metrics.describe("plottwist_bytes_total", "counter", "Bytes downloaded or processed")
+metrics.describe("plottwist_pages_total", "counter", "PDF pages extracted")
+metrics.describe("plottwist_jobs", "gauge", "Jobs in the queue by status")
+metrics.describe("plottwist_book_cache_entries", "gauge", "Entries in the book cache")
+metrics.describe("plottwist_book_cache_bytes", "gauge", "Size of the book cache")
+
+class BookTimings:
+    """
+    Per-book totals of each kind of span, and the wall time spent in each
+    stage of the pipeline (the book's statuses: processing, analyzing, ...)
+    """
+
+    def __init__(self, book_id: str):
+        self.book_id = book_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.stage = None
+        self.stage_started = None
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def enter_stage(self, stage: str):
+        """Close the current stage and start timing the next one"""
+        with self._lock:
+            now = time.perf_counter()
+            if self.stage is not None:
+                self.stages[self.stage] = round(self.stages.get(self.stage, 0) + now - self.stage_started, 3)
+            self.stage, self.stage_started = stage, now
+
+    def add(self, kind: str, name: str, seconds: float, attrs: dict, failed: bool):
+        with self._lock:
+            key = f"{kind}:{name}" if name else kind
+            entry = self.operations.setdefault(key, {"count": 0, "seconds": 0.0, "failures": 0, "cache_hits": 0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["failures"] += failed
+            entry["cache_hits"] += bool(attrs.get("cache_hit"))
+            for attribute in SUMMED_ATTRIBUTES:
+                if attrs.get(attribute):
+                    entry[attribute] = entry.get(attribute, 0) + attrs[attribute]
+
+    def summary(self) -> dict:
+        """
+        Wall time of each stage, and per kind of operation its count and
+        summed seconds (operations overlap, so these can exceed the total)
+        """
+        with self._lock:
+            now = time.perf_counter()
+            stages = dict(self.stages)
+            if self.stage is not None:
+                # The stage still running, so far
+                stages[self.stage] = round(stages.get(self.stage, 0) + now - self.stage_started, 3)
+            return {
+                "total_seconds": round(now - self.started, 3),
+                "stages": stages,
+                "operations": {key: dict(entry, seconds=round(entry["seconds"], 3),
+                                         **({"cost_usd": round(entry["cost_usd"], 6)} if "cost_usd" in entry else {}))
+                               for key, entry in sorted(self.operations.items())}
+            }
+
+@contextmanager
+def book_timings(book_id: str):
+    """Collect the spans of everything run inside this block into one book's breakdown"""
+    timings = BookTimings(book_id)
+    token = current_book.set(timings)
+    try:
+        yield timings
+    finally:
+        current_book.reset(token)
+
+class Span:
+    def __init__(self, kind: str, name: str = "", **attrs):
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        self.failed = False
+        self.start = None
+        self.seconds = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def fail(self, error=None):
+        """Mark the span failed without raising (e.g. a call that returned None)"""
+        self.failed = True
+        if error is not None:
+            self.attrs["error"] = str(error)
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        # Cancellation (or a consumer closing a stream early) isn't a failure of the operation itself
+        if exc_type is not None and not issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            self.fail(exc)
+        record(self)
+        return False
+
+def span(kind: str, name: str = "", **attrs) -> Span:
+    return Span(kind, name, **attrs)
+
+def record(finished: Span):
+    labels = {"span": finished.kind, "name": finished.name}
+    metrics.observe("plottwist_span_seconds", finished.seconds, **labels)
+    if finished.failed:
+        metrics.inc("plottwist_span_failures_total", **labels)
+    if finished.attrs.get("cache_hit"):
+        metrics.inc("plottwist_cache_hits_total", **labels)
+    for token_type in ("prompt", "completion"):
+        tokens = finished.attrs.get(f"{token_type}_tokens")
+        if tokens:
+            metrics.inc("plottwist_llm_tokens_total", tokens, call_site=finished.name, type=token_type)
+    if finished.attrs.get("cost_usd"):
+        metrics.inc("plottwist_llm_cost_usd_total", finished.attrs["cost_usd"],
+                    call_site=finished.name, model=finished.attrs.get("model", ""))
+    if finished.attrs.get("first_token_seconds") is not None:
+        metrics.observe("plottwist_llm_first_token_seconds", finished.attrs["first_token_seconds"], call_site=finished.name)
+    if finished.attrs.get("bytes"):
+        metrics.inc("plottwist_bytes_total", finished.attrs["bytes"], **labels)
+    if finished.attrs.get("pages"):
+        metrics.inc("plottwist_pages_total", finished.attrs["pages"])
+
+    timings = current_book.get()
+    if timings is not None:
+        timings.add(finished.kind, finished.name, finished.seconds, finished.attrs, finished.failed)
+
+def cache_hit(kind: str, name: str = ""):
+    """Count an operation skipped because its result was cached"""
+    with span(kind, name, cache_hit=True):
+        pass
@@ -2,79 +2,157 @@
 import asyncio
 import json
 import random
-import re
 import os
 from typing import Dict, List, Any
 from openai import AsyncOpenAI  # You'll need to pip install openai
 
 import os
 import tempfile
-import replicate
-import base64
-import requests
-from io import BytesIO
-from PIL import Image
 
-# Add this to the global variables section
-# Cache for generated images to avoid regenerating them
-IMAGE_CACHE = {
-    "characters": {},
-    "backgrounds": {}
-}
+from image_store import store_image_from_url, is_image_reference
+from image_jobs import image_scheduler
+from image_cache import (image_cache, background_namespace, character_namespace,
+                         normalize_prompt, prompt_shingles, similarity, IMAGE_SIMILARITY_THRESHOLD)
+from story_session import story_sessions
+from stage_graph import StageGraph
+from llm_client import count_tokens, PromptBuilder, INPUT_BUDGETS, OUTPUT_LIMITS
+from model_router import router
+from json_stream import JSONItemStream, json_parser
+from telemetry import span, cache_hit
 
+# Scenes of the initial script written per request: 1 writes each one on its
+# own, in parallel; more share a request (and its character descriptions),
+# as many as fit the scene_batch token limits; "auto" for no other cap
+SCENE_BATCH = os.environ.get("SCENE_BATCH", "1")
 
-# Global cache for story continuation
-STORY_CACHE = {
-    "book_analysis": None,      # Store book analysis for reference
-    "generated_scenes": {},     # Cache of all generated scenes
-    "scene_graph": {},          # Map showing connections between scenes
-    "in_progress_scenes": set() # Set of scenes currently being generated
-}
+# Completion tokens expected per dialogue line, and per scene besides its
+# lines, when sizing batches to the scene_batch completion limit
+SCENE_LINE_TOKENS = 80
+SCENE_OVERHEAD_TOKENS = 150
 
-async def generate_visual_novel(book_analysis: dict) -> dict:
+# Portraits rendered straight after analysis, before any scene is written,
+# for this many of the main characters
+PORTRAIT_HEAD_START = 7
+
+# Character importance, most important first, for ranking prompt context
+IMPORTANCE_RANK = {"high": 0, "medium": 1, "low": 2}
+
+def rank_characters(characters: list) -> list:
+    """Most important characters first, then those seen most often in the book"""
+    return sorted(characters, key=lambda c: (IMPORTANCE_RANK.get(str(c.get("importance", "")).lower(), 1),
+                                             -(c.get("mentions") or 0)))
+
+async def load_checkpoint(checkpoints, stage: str):
+    return await asyncio.to_thread(checkpoints.get, stage) if checkpoints else None
+
+async def save_checkpoint(checkpoints, stage: str, value):
+    if checkpoints:
+        await asyncio.to_thread(checkpoints.save, stage, value)
+
+def script_title(book_analysis: dict) -> str:
+    return book_analysis['metadata'].get('title', 'Untitled') + ": Interactive Edition"
+
+async def generate_visual_novel(book_analysis: dict, book_id: str = None, on_scene=None, checkpoints=None,
+                                on_partial=None) -> dict:
     """
     Generate a visual novel script with branching paths from the book analysis
     Returns a structured visual novel script
+    on_scene(scenes_done, scenes_total) is called as scenes are written.
+    on_partial(snapshot) gets the script so far (see script_snapshot) each
+    time a scene or its background is done, before the remaining images.
+    With checkpoints (see job_queue.JobCheckpoints), the outline, scenes and
+    images stages are saved as they finish and skipped when resuming.
+    
+    The work runs as a stage graph: portraits start right after analysis,
+    and each background starts as soon as its scene is written. The graph's
+    timings and critical path are returned under "timings".
     """
+    graph = None
     try:
-        # Store book analysis in global cache for future reference
-        STORY_CACHE["book_analysis"] = book_analysis
-        STORY_CACHE["generated_scenes"] = {}
-        STORY_CACHE["scene_graph"] = {}
-        STORY_CACHE["in_progress_scenes"] = set()
+        # Start a fresh story session for this book, kept for runtime scene generation
+        session = story_sessions.create(book_id or f"book_{random.randint(1000, 9999)}", book_analysis)
         
         # Initialize OpenAI client
         api_key = os.environ.get("OPENAI_API_KEY", "your-openai-api-key")
         client = AsyncOpenAI(api_key=api_key)
         
-        # Use the optimized approach
-        script_data = await generate_initial_script(book_analysis, client)
-        
-        # Enhance with visual elements
-        script_data = await enhance_visual_novel(script_data, book_analysis.get("characters", []))
+        timings = None
+        script_data = await load_checkpoint(checkpoints, "images")
+        if script_data is None:
+            characters = book_analysis.get("characters", [])
+            images = SceneImages(replicate_enabled(), book_id)
+            graph = StageGraph(f"Book {session.book_id}")
+            
+            # Portraits only need the analysis, so they render while the script is written
+            descriptions = list(character_descriptions(rank_characters(characters)).items())[:PORTRAIT_HEAD_START]
+            
+            async def portraits_stage():
+                return await asyncio.gather(*[images.portrait(char_id, desc) for char_id, desc in descriptions])
+            
+            graph.add("portraits", portraits_stage)
+            
+            written = {}  # Scene ID -> scene, as each one is written
+            
+            def publish():
+                if on_partial:
+                    scene_ids = [name.split(":", 1)[1] for name in graph.tasks if name.startswith("background:")]
+                    on_partial(script_snapshot(script_title(book_analysis), scene_ids, written, images, characters))
+            
+            async def background_stage(scene, scene_id=None):
+                if scene:
+                    written[str(scene.get("id") if scene_id is None else scene_id)] = scene
+                    publish()
+                background_desc = scene.get("background", "") if scene else ""
+                if isinstance(background_desc, str) and not is_image_reference(background_desc):
+                    url = await images.background(background_desc)
+                    publish()
+                    return url
+            
+            # Use the optimized approach
+            scenes_script = await load_checkpoint(checkpoints, "scenes")
+            if scenes_script is None:
+                scenes_script = await generate_initial_script(book_analysis, client, session, on_scene, checkpoints,
+                                                              graph, background_stage)
+                await save_checkpoint(checkpoints, "scenes", scenes_script)
+            else:
+                for scene in scenes_script["scenes"]:
+                    graph.add(f"background:{scene['id']}", lambda scene=scene: background_stage(scene, scene["id"]))
+            
+            # Enhance with visual elements once every render is in
+            async def images_stage(*_):
+                return await enhance_visual_novel(scenes_script, characters, book_id, images)
+            
+            script_data = await graph.add("images", images_stage, *graph.tasks)
+            await save_checkpoint(checkpoints, "images", script_data)
+            timings = graph.print_report()
         
         # Validate scene connections
-        script_data = validate_and_fix_scene_connections(script_data)
+        with span("validate", "scenes"):
+            script_data = validate_and_fix_scene_connections(script_data)
         
         # Update the scene graph
-        update_scene_graph(script_data)
+        update_scene_graph(session, script_data)
         
+        if timings:
+            script_data = dict(script_data, timings=timings)
         return script_data
         
     except Exception as e:
         print(f"Error generating script: {str(e)}")
+        if graph is not None:
+            graph.cancel()
         return await generate_placeholder_script(book_analysis)
 
-def update_scene_graph(script_data):
-    """Update global scene graph with the latest scene connections"""
-    scene_graph = STORY_CACHE["scene_graph"]
+def update_scene_graph(session, script_data):
+    """Update the session's scene graph with the latest scene connections"""
+    scene_graph = session.scene_graph
     
     # Map all scenes
     for scene in script_data["scenes"]:
         scene_id = scene["id"]
         
         # Save to generated scenes cache
-        STORY_CACHE["generated_scenes"][scene_id] = scene
+        session.generated_scenes[scene_id] = scene
         
         # Create entry in scene graph if not exists
         if scene_id not in scene_graph:
@@ -108,22 +186,30 @@ def update_scene_graph(script_data):
                                 "source": scene_id,
                                 "text": choice["text"]
                             })
-    
-    # Update the global cache
-    STORY_CACHE["scene_graph"] = scene_graph
 
-async def generate_initial_script(book_analysis: dict, client) -> dict:
+async def generate_initial_script(book_analysis: dict, client, session, on_scene=None, checkpoints=None,
+                                  graph=None, background_stage=None) -> dict:
     """
     Generate the initial visual novel script with the first set of scenes
+    The outline and each scene run as stages of graph; background_stage(scene,
+    scene_id), if given, is added after each scene so its image starts right away.
     """
     print("Generating initial script skeleton...")
+    graph = graph or StageGraph()
     
     # Create an outline for the first 5 scenes
-    outline = await generate_script_outline(book_analysis, client, scene_limit=5)
+    async def outline_stage():
+        outline = await load_checkpoint(checkpoints, "outlined")
+        if outline is None:
+            outline = await generate_script_outline(book_analysis, client, scene_limit=5)
+            await save_checkpoint(checkpoints, "outlined", outline)
+        return outline
+    
+    outline = await graph.add("outline", outline_stage)
     
     # Initialize the visual novel script
     vn_script = {
-        "title": book_analysis['metadata'].get('title', 'Untitled') + ": Interactive Edition",
+        "title": script_title(book_analysis),
         "scenes": []
     }
     
@@ -131,9 +217,51 @@ async def generate_initial_script(book_analysis: dict, client) -> dict:
     initial_scenes = []
     
     # Process all planned scenes in parallel
+    scene_outlines = outline.get("scenes", [])[:5]
+    scenes_done = 0
+    if on_scene:
+        on_scene(scenes_done, len(scene_outlines))
+    
+    async def generate_and_report(scene_outline):
+        nonlocal scenes_done
+        scene = await generate_scene_from_outline(scene_outline, book_analysis, client, session)
+        scenes_done += 1
+        if on_scene:
+            on_scene(scenes_done, len(scene_outlines))
+        return scene
+    
+    async def generate_batch_and_report(batch):
+        nonlocal scenes_done
+        scenes = await generate_scenes_from_outlines(batch, book_analysis, client, session)
+        scenes_done += len(scenes)
+        if on_scene:
+            on_scene(scenes_done, len(scene_outlines))
+        return scenes
+    
+    async def pick(scenes, index):
+        return scenes[index]
+    
+    # Scenes written together share a stage; each scene still gets its own, for its background
+    max_batch = len(scene_outlines) if SCENE_BATCH == "auto" else int(SCENE_BATCH)
+    batch_stages = {}
+    for batch in plan_scene_batches(scene_outlines, book_analysis, max_batch):
+        if len(batch) > 1:
+            stage = f"scenes:{batch[0]['id']}-{batch[-1]['id']}"
+            graph.add(stage, lambda _, batch=batch: generate_batch_and_report(batch), "outline")
+            for index, scene_outline in enumerate(batch):
+                batch_stages[id(scene_outline)] = (stage, index)
+    
     tasks = []
-    for scene_outline in outline.get("scenes", [])[:5]:
-        tasks.append(generate_scene_from_outline(scene_outline, book_analysis, client))
+    for i, scene_outline in enumerate(scene_outlines):
+        stage = f"scene:{scene_outline.get('id', i)}"
+        if id(scene_outline) in batch_stages:
+            batch_stage, index = batch_stages[id(scene_outline)]
+            tasks.append(graph.add(stage, lambda scenes, index=index: pick(scenes, index), batch_stage))
+        else:
+            tasks.append(graph.add(stage, lambda _, scene_outline=scene_outline: generate_and_report(scene_outline), "outline"))
+        if background_stage:
+            graph.add(f"background:{scene_outline.get('id', i)}",
+                      lambda scene, scene_id=scene_outline.get('id', i): background_stage(scene, scene_id), stage)
     
     # Wait for all scenes to complete
     initial_scenes = await asyncio.gather(*tasks)
@@ -150,23 +278,23 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
     """Generate an outline for the script with planned scenes"""
     
     # Extract key elements from the book analysis
-    characters = book_analysis.get("characters", [])
-    character_info = ""
+    characters = rank_characters(book_analysis.get("characters", []))
+    character_blocks = []
     
     # Create detailed character information for more authentic portrayal
-    for char in characters[:7]:  # Limit to 7 important characters
+    for char in characters:
         personality = char.get("personality", "")
         speech = char.get("speech_patterns", "")
         motivations = char.get("motivations", "")
         
-        character_info += f"""
+        character_blocks.append(f"""
         - {char.get('name', 'Unknown')}: {char.get('role', 'A character')}
           * Description: {char.get('description', 'No description')}
           * Personality: {personality}
           * Speech patterns: {speech}
           * Motivations: {motivations}
           * Relationships: {char.get('relationships', 'Unknown')}
-        """
+        """)
     
     # Extract plot information
     plot_summary = book_analysis.get("plot", {}).get("summary", "A story with characters and challenges.")
@@ -175,16 +303,17 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
     branching_points = book_analysis.get("plot", {}).get("branching_points", [])
     
     # Create branching point information
-    branching_info = ""
-    for i, bp in enumerate(branching_points[:5]):  # Limit to 5 branching points
+    branching_blocks = []
+    for i, bp in enumerate(branching_points):
         options = ", ".join([f'"{opt}"' for opt in bp.get("options", [])])
-        branching_info += f"""
+        branching_blocks.append(f"""
         - Choice point {i+1}: {bp.get('description', 'A decision')}
           * Options: {options}
-        """
+        """)
     
     # Create a prompt that emphasizes slower story development and rich detail
-    prompt = f"""
+    def render(plot_summary, character_info, key_points, branching_info):
+        return f"""
     Create a detailed outline for an interactive visual novel adaptation of this book:
     
     TITLE: {book_analysis['metadata'].get('title', 'Untitled')}
@@ -199,7 +328,7 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
     {central_conflict}
     
     KEY PLOT POINTS:
-    {', '.join(key_points[:8])}
+    {key_points}
     
     POTENTIAL BRANCHING POINTS:
     {branching_info}
@@ -241,22 +370,30 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
     }}
     """
     
+    # Fill the prompt with as much context as the budget allows, most valuable first:
+    # the summary, then characters by importance, plot points and choice points
+    builder = PromptBuilder(router.model("outline"), INPUT_BUDGETS["outline"])
+    builder.slot("plot_summary", [plot_summary], priority=0, truncate=True, limit=INPUT_BUDGETS["outline"] // 4)
+    builder.slot("character_info", character_blocks, priority=1)
+    builder.slot("key_points", [str(point) for point in key_points], priority=2, joiner=", ")
+    builder.slot("branching_info", branching_blocks, priority=3)
+    prompt = builder.render(render)
+    print(f"Outline prompt: {builder.report}")
+    
     try:
-        # Generate the outline
-        response = await client.chat.completions.create(
-            model="gpt-4-turbo",
+        # Generate the outline, keeping every complete scene of a cut-off one
+        outline_data = await router.complete(
+            client, "outline", json_parser("outline"), outline_is_valid,
             response_format={"type": "json_object"},
             messages=[
                 {"role": "system", "content": "You are an expert narrative designer specializing in adapting literary works into interactive visual novels."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
-            max_tokens=2500
+            temperature=0.7
         )
         
-        # Parse the response
-        outline_text = response.choices[0].message.content
-        outline_data = json.loads(outline_text)
+        if not isinstance(outline_data, dict) or not outline_data.get("scenes"):
+            raise ValueError("no scenes in the outline")
         
         print(f"Generated script outline with {len(outline_data.get('scenes', []))} planned scenes")
         return outline_data
@@ -287,44 +424,71 @@ async def generate_script_outline(book_analysis: dict, client, scene_limit=10) -
             ]
         }
 
-async def generate_scene_from_outline(scene_outline, book_analysis, client):
-    """Generate a full scene from its outline description"""
+async def generate_scene_from_outline(scene_outline, book_analysis, client, session, on_line=None,
+                                      call_site="scene"):
+    """
+    Generate a full scene from its outline description.
+    Concurrent requests for the same scene share one generation: the first
+    caller writes the scene and everyone else awaits its result. If the
+    writer is cancelled (its player left), a waiter writes the scene instead.
+    on_line and call_site are passed to write_scene, for the caller that writes the scene.
+    """
     scene_id = scene_outline.get("id", f"scene_{random.randint(1000, 9999)}")
     
-    # Prevent duplicate generation
-    if scene_id in STORY_CACHE["generated_scenes"]:
-        print(f"Scene {scene_id} already exists in cache, using cached version")
-        return STORY_CACHE["generated_scenes"][scene_id]
+    while True:
+        # Prevent duplicate generation
+        if scene_id in session.generated_scenes:
+            print(f"Scene {scene_id} already exists in cache, using cached version")
+            return session.generated_scenes[scene_id]
         
-    # Check if already being generated
-    if scene_id in STORY_CACHE["in_progress_scenes"]:
+        # Check if already being generated
+        pending = session.in_progress_scenes.get(scene_id)
+        if pending is None:
+            break
         print(f"Scene {scene_id} is already being generated, waiting...")
-        # Wait for it to appear in cache (with timeout)
-        for _ in range(30):  # 30 second timeout
-            await asyncio.sleep(1)
-            if scene_id in STORY_CACHE["generated_scenes"]:
-                return STORY_CACHE["generated_scenes"][scene_id]
-        
-        print(f"Timed out waiting for scene {scene_id}, will generate now")
+        try:
+            # Shielded so a waiter giving up doesn't cancel the shared generation
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise  # This waiter was cancelled, not the writer
+            print(f"Generation of scene {scene_id} was cancelled, taking it over")
     
     # Mark as in progress
-    STORY_CACHE["in_progress_scenes"].add(scene_id)
-    
+    future = asyncio.get_running_loop().create_future()
+    session.in_progress_scenes[scene_id] = future
     try:
-        # Get detailed information about characters in this scene
-        characters = []
-        for char_id in scene_outline.get("characters", []):
-            # Find the character in book analysis
-            char_data = next((c for c in book_analysis.get("characters", []) if c.get("id") == char_id or c.get("name").lower() == char_id.lower()), None)
-            if char_data:
-                characters.append(char_data)
-        
-        # Create character information for the prompt
-        character_info = ""
-        for char in characters:
-            personality = char.get("personality", "")
-            speech = char.get("speech_patterns", "")
-            character_info += f"""
+        scene_data = await write_scene(scene_id, scene_outline, book_analysis, client, on_line, call_site)
+    except BaseException as e:
+        # Hand the failure to every waiter (when cancelled, one of them takes over)
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            future.exception()  # Retrieved here, so it isn't logged when nobody waited
+        raise
+    finally:
+        session.in_progress_scenes.pop(scene_id, None)
+    
+    session.generated_scenes[scene_id] = scene_data
+    future.set_result(scene_data)
+    return scene_data
+
+def scene_characters(scene_outline, book_analysis) -> list:
+    """The analysis entries of the characters in a scene's outline, most important first"""
+    characters = []
+    for char_id in scene_outline.get("characters", []):
+        # Find the character in book analysis
+        char_data = next((c for c in book_analysis.get("characters", []) if c.get("id") == char_id or c.get("name").lower() == char_id.lower()), None)
+        if char_data and char_data not in characters:
+            characters.append(char_data)
+    return rank_characters(characters)
+
+def character_block(char: dict) -> str:
+    """A character's entry in a scene prompt"""
+    personality = char.get("personality", "")
+    speech = char.get("speech_patterns", "")
+    return f"""
             - {char.get('name', 'Unknown')}:
               * Role: {char.get('role', 'A character in the story')}
               * Description: {char.get('description', 'No description')}
@@ -332,10 +496,62 @@ async def generate_scene_from_outline(scene_outline, book_analysis, client):
               * Speech patterns: {speech}
               * Motivations: {char.get('motivations', 'Unknown')}
             """
+
+async def generate_scenes_from_outlines(scene_outlines, book_analysis, client, session) -> list:
+    """
+    generate_scene_from_outline for several scenes (which need IDs), written
+    together in one request. Scenes already written or being written are
+    shared as usual, and any the request didn't return are written singly.
+    """
+    # Claim the scenes nobody else is writing, so they aren't written twice
+    claimed = {}
+    loop = asyncio.get_running_loop()
+    for scene_outline in scene_outlines:
+        scene_id = scene_outline["id"]
+        if scene_id not in session.generated_scenes and scene_id not in session.in_progress_scenes:
+            claimed[scene_id] = session.in_progress_scenes[scene_id] = loop.create_future()
+    
+    try:
+        written = {}
+        if len(claimed) > 1:
+            written = await write_scene_batch([o for o in scene_outlines if o["id"] in claimed], book_analysis, client)
+        for scene_id, future in claimed.items():
+            session.in_progress_scenes.pop(scene_id, None)
+            if scene_id in written:
+                session.generated_scenes[scene_id] = written[scene_id]
+                future.set_result(written[scene_id])
+        
+        # Whatever is left, with anyone waiting on a missed scene handed its single generation
+        scenes = await asyncio.gather(*[generate_scene_from_outline(o, book_analysis, client, session)
+                                        for o in scene_outlines])
+    except BaseException:
+        for scene_id, future in claimed.items():
+            if session.in_progress_scenes.get(scene_id) is future:
+                session.in_progress_scenes.pop(scene_id)
+            if not future.done():
+                future.cancel()
+        raise
+    for scene_outline, scene in zip(scene_outlines, scenes):
+        future = claimed.get(scene_outline["id"])
+        if future is not None and not future.done():
+            future.set_result(scene)
+    return scenes
+
+async def write_scene(scene_id, scene_outline, book_analysis, client, on_line=None, call_site="scene"):
+    """
+    Write a scene with the LLM, falling back to a placeholder on failure.
+    With on_line, the completion is streamed and on_line(line) is called
+    with each dialogue line as soon as it is complete.
+    call_site picks the model (see model_router): "scene" for the initial
+    script, "continuation" for scenes written while the book is played.
+    """
+    try:
+        # Create character information for the prompt
+        character_blocks = [character_block(char) for char in scene_characters(scene_outline, book_analysis)]
             
         # If no characters were found, add a note
-        if not character_info:
-            character_info = "No specific characters identified for this scene."
+        if not character_blocks:
+            character_blocks = ["No specific characters identified for this scene."]
         
         # Get connections to other scenes
         connections = scene_outline.get("connects_to", [])
@@ -345,7 +561,8 @@ async def generate_scene_from_outline(scene_outline, book_analysis, client):
         dialogue_count = scene_outline.get("dialogue_count", random.randint(6, 10))
         
         # Create a prompt for generating this specific scene
-        prompt = f"""
+        def render(character_info):
+            return f"""
         Generate a detailed scene for a visual novel with rich dialogue and atmosphere.
         
         SCENE INFORMATION:
@@ -401,64 +618,51 @@ async def generate_scene_from_outline(scene_outline, book_analysis, client):
         FOCUS ON QUALITY: Create dialogue that is engaging, natural, and reflects the character's voice.
         """
         
-        # Generate the scene
-        response = await client.chat.completions.create(
-            model="gpt-4-turbo",  # Using the most capable model for creative content
+        # Characters present are the only variable context; keep as many as fit
+        prompt = PromptBuilder(router.model(call_site), INPUT_BUDGETS[call_site]).slot("character_info", character_blocks).render(render)
+        
+        # Generate the scene; the model comes from the call site's route
+        request = dict(
             response_format={"type": "json_object"},
             messages=[
                 {"role": "system", "content": "You are a master writer of interactive fiction, specializing in creating immersive, literary-quality scenes with authentic dialogue."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.8,  # Higher temperature for more creative, varied output
-            max_tokens=3500,  # Increased limit for richer content
             timeout=90  # Extended timeout
         )
-        
-        # Parse the response
-        scene_text = response.choices[0].message.content
-        
-        try:
-            scene_data = json.loads(scene_text)
-            print(f"Successfully generated scene {scene_id} with {len(scene_data.get('dialogue', []))} dialogue lines")
-            
-            # Save to cache
-            STORY_CACHE["generated_scenes"][scene_id] = scene_data
-            
-            # Remove from in-progress set
-            STORY_CACHE["in_progress_scenes"].remove(scene_id)
-            
-            return scene_data
-            
-        except json.JSONDecodeError as e:
-            print(f"Error parsing scene JSON: {e}")
-            
-            # Try to fix the JSON
-            try:
-                fixed_text = attempt_json_repair(scene_text)
-                if fixed_text != scene_text:
-                    scene_data = json.loads(fixed_text)
-                    print(f"Fixed JSON for scene {scene_id}")
-                    
-                    # Save to cache
-                    STORY_CACHE["generated_scenes"][scene_id] = scene_data
-                    
-                    # Remove from in-progress set
-                    STORY_CACHE["in_progress_scenes"].remove(scene_id)
-                    
-                    return scene_data
-            except:
-                print(f"Failed to fix JSON for scene {scene_id}")
-            
-            # Create a placeholder scene as fallback
-            placeholder_scene = create_placeholder_scene(scene_id, scene_outline, book_analysis)
+        # Parse the response, keeping the complete dialogue lines of a cut-off or malformed one
+        parse = json_parser(call_site)
+        if on_line is None:
+            scene_value = await router.complete(client, call_site, parse, scene_is_valid, **request)
+        else:
+            # Hand over each dialogue line as soon as it has been written
+            lines = JSONItemStream(("dialogue",))
+            streamed = 0
             
-            # Save to cache
-            STORY_CACHE["generated_scenes"][scene_id] = placeholder_scene
+            def on_text(chunk):
+                for line in lines.feed(chunk):
+                    on_line(line)
             
-            # Remove from in-progress set
-            STORY_CACHE["in_progress_scenes"].remove(scene_id)
+            def parse_attempt(text):
+                # A retry on a better model streams from the start
+                nonlocal lines, streamed
+                streamed += lines.count
+                lines = JSONItemStream(("dialogue",))
+                return parse(text)
             
-            return placeholder_scene
+            # Lines the player has already seen aren't rewritten by a better model
+            scene_value = await router.complete(client, call_site, parse_attempt,
+                                                lambda value: scene_is_valid(value) or streamed > 0,
+                                                on_text=on_text, **request)
+        
+        scene_data = salvage_scene(scene_value, scene_id, scene_outline, book_analysis)
+        if scene_data is None:
+            print(f"Nothing could be salvaged for scene {scene_id}, using a placeholder")
+            return create_placeholder_scene(scene_id, scene_outline, book_analysis)
+        
+        print(f"Successfully generated scene {scene_id} with {len(scene_data['dialogue'])} dialogue lines")
+        return scene_data
             
     except Exception as e:
         print(f"Error generating scene {scene_id}: {str(e)}")
@@ -466,14 +670,226 @@ async def generate_scene_from_outline(scene_outline, book_analysis, client):
         # Create a placeholder scene
         placeholder_scene = create_placeholder_scene(scene_id, scene_outline, book_analysis)
         
-        # Save to cache
-        STORY_CACHE["generated_scenes"][scene_id] = placeholder_scene
+        return placeholder_scene
+
+def expected_scene_tokens(scene_outline) -> int:
+    """Completion tokens a scene is expected to take, for sizing batches"""
+    return scene_outline.get("dialogue_count", 10) * SCENE_LINE_TOKENS + SCENE_OVERHEAD_TOKENS
+
+def render_scene_batch(scene_outlines, book_analysis, character_info: str) -> str:
+    """The prompt asking for several scenes at once, sharing one character block"""
+    briefs = []
+    for n, scene_outline in enumerate(scene_outlines, 1):
+        connections = scene_outline.get("connects_to", [])
+        names = [char.get("name", "Unknown") for char in scene_characters(scene_outline, book_analysis)]
+        briefs.append(f"""
+        SCENE {n}:
+        - ID: {scene_outline['id']}
+        - Description: {scene_outline.get('description', 'A scene in the story')}
+        - Setting: {scene_outline.get('setting', 'An important location')}
+        - Atmosphere: {scene_outline.get('atmosphere', 'Creates a specific mood')}
+        - Characters present: {", ".join(names) or "None specified"}
+        - Dialogue exchanges: {scene_outline.get('dialogue_count', random.randint(6, 10))}
+        - This scene should connect to these scenes: {", ".join(connections) if connections else "None specified"}
+        """)
+    return f"""
+        Write each of these {len(scene_outlines)} scenes for a visual novel, with rich dialogue and atmosphere.
         
-        # Remove from in-progress set
-        if scene_id in STORY_CACHE["in_progress_scenes"]:
-            STORY_CACHE["in_progress_scenes"].remove(scene_id)
+        CHARACTERS (for every scene):
+        {character_info}
+        {"".join(briefs)}
+        IMPORTANT REQUIREMENTS:
+        1. CREATE EXACTLY THE GIVEN NUMBER OF DIALOGUE EXCHANGES (not just lines) in each scene, for a slow, immersive pace
+        2. WRITE RICH, ENGAGING TEXT with detailed descriptions and natural dialogue
+        3. MAINTAIN CHARACTER VOICE - each character should speak in their distinctive pattern
+        4. INCLUDE DESCRIPTIVE NARRATION between dialogue to establish mood and setting
+        5. END EACH SCENE WITH MEANINGFUL CHOICES that connect to its specified scenes
+        6. IF A CRITICAL PLOT ELEMENT (like a weapon, creature, or revelation) appears, PROPERLY FORESHADOW it
         
-        return placeholder_scene
+        FORMAT:
+        Return a JSON object with the scenes in the order given, each following this exact structure:
+        {{
+          "scenes": [
+            {{
+              "id": "scene ID",
+              "background": "Detailed description of the setting and visuals",
+              "characters": [
+                {{ "id": "character_id", "image": "Detailed character appearance" }}
+              ],
+              "dialogue": [
+                {{
+                  "speaker": "Character Name or Narrator",
+                  "text": "Rich, detailed dialogue or narration",
+                  "character": "character_id" (optional)
+                }},
+                ...
+                {{
+                  "speaker": "Character Name",
+                  "text": "Final choice prompt with depth and consequence",
+                  "choices": [
+                    {{ "text": "Meaningful choice with clear implication", "nextScene": "target_scene_id" }}
+                  ]
+                }}
+              ]
+            }}
+          ]
+        }}
+        
+        FOCUS ON QUALITY: Create dialogue that is engaging, natural, and reflects the character's voice.
+        """
+
+def plan_scene_batches(scene_outlines, book_analysis, max_batch: int) -> list:
+    """
+    Group scenes, in outline order, into batches written one request each:
+    as few batches as the scene_batch completion limit and prompt budget
+    allow with at most max_batch scenes in each, evened out so no batch
+    takes much longer than the rest. The entry scene is written on its own,
+    so the book is playable as soon as possible.
+    """
+    def fits(batch):
+        if len(batch) == 1:
+            return True
+        if len(batch) > max_batch or not all("id" in o for o in batch):
+            return False
+        characters = {c.get("name"): c for o in batch for c in scene_characters(o, book_analysis)}
+        prompt = render_scene_batch(batch, book_analysis, "".join(character_block(c) for c in characters.values()))
+        return (sum(expected_scene_tokens(o) for o in batch) <= OUTPUT_LIMITS["scene_batch"]
+                and count_tokens(prompt, router.model("scene_batch")) <= INPUT_BUDGETS["scene_batch"])
+    
+    entry, rest = scene_outlines[:1], scene_outlines[1:]
+    greedy = []
+    for scene_outline in rest:
+        if greedy and fits(greedy[-1] + [scene_outline]):
+            greedy[-1].append(scene_outline)
+        else:
+            greedy.append([scene_outline])
+    
+    # The same number of batches, sized within one scene of each other
+    count = len(greedy)
+    even = [rest[len(rest) * i // count:len(rest) * (i + 1) // count] for i in range(count)]
+    batches = even if all(fits(batch) for batch in even) else greedy
+    return ([entry] if entry else []) + batches
+
+def batch_scenes(batch) -> list:
+    """The scenes list of a scene_batch response, or [] if it has none"""
+    scenes = batch.get("scenes") if isinstance(batch, dict) else None
+    return scenes if isinstance(scenes, list) else []
+
+async def write_scene_batch(scene_outlines, book_analysis, client) -> dict:
+    """
+    Write several scenes in one request, with the characters of all of them
+    described once. Returns scene ID -> scene for the scenes that came back
+    usable; the caller writes any others on their own.
+    """
+    scene_ids = [scene_outline["id"] for scene_outline in scene_outlines]
+    try:
+        characters = {}
+        for scene_outline in scene_outlines:
+            for char in scene_characters(scene_outline, book_analysis):
+                characters.setdefault(char.get("name"), char)
+        character_blocks = [character_block(char) for char in rank_characters(list(characters.values()))]
+        if not character_blocks:
+            character_blocks = ["No specific characters identified for these scenes."]
+        
+        # The shared character block is the only variable context; keep as many as fit
+        prompt = PromptBuilder(router.model("scene_batch"), INPUT_BUDGETS["scene_batch"]).slot("character_info", character_blocks).render(
+            lambda character_info: render_scene_batch(scene_outlines, book_analysis, character_info))
+        
+        # Escalated unless at least one of the scenes came back whole
+        batch = await router.complete(
+            client, "scene_batch", json_parser("scene_batch"),
+            lambda value: any(scene_is_valid(scene) for scene in batch_scenes(value)),
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": "You are a master writer of interactive fiction, specializing in creating immersive, literary-quality scenes with authentic dialogue."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.8,
+            timeout=180  # Several scenes take longer to write than one
+        )
+    except Exception as e:
+        print(f"Error generating scenes {', '.join(scene_ids)}: {str(e)}")
+        return {}
+    
+    # A cut-off response still yields the scenes completed before the cut
+    returned = batch_scenes(batch)
+    written = {}
+    for i, scene_data in enumerate(returned):
+        if not isinstance(scene_data, dict):
+            continue
+        # Matched by ID, or by position when the ID came back changed
+        scene_id = scene_data.get("id") if scene_data.get("id") in scene_ids else (scene_ids[i] if i < len(scene_ids) else None)
+        if scene_id is None or scene_id in written:
+            continue
+        scene_data["id"] = scene_id
+        scene_data = salvage_scene(scene_data, scene_id, scene_outlines[scene_ids.index(scene_id)], book_analysis)
+        if scene_data is not None:
+            written[scene_id] = scene_data
+    
+    missing = [scene_id for scene_id in scene_ids if scene_id not in written]
+    print(f"Generated {len(written)} of {len(scene_ids)} scenes in one request"
+          + (f"; writing {', '.join(missing)} separately" if missing else ""))
+    return written
+
+def outline_is_valid(outline_data) -> bool:
+    """An outline needs scenes, each with an ID and its connections (escalated otherwise)"""
+    scenes = outline_data.get("scenes") if isinstance(outline_data, dict) else None
+    return (isinstance(scenes, list) and len(scenes) > 0
+            and all(isinstance(scene, dict) and scene.get("id") and isinstance(scene.get("connects_to", []), list)
+                    for scene in scenes))
+
+def scene_is_valid(scene_data) -> bool:
+    """
+    A scene as asked for: a background, dialogue lines with a speaker and
+    text, and choices leading on. Anything less is escalated to a better
+    model (see model_router), and salvaged if it is the best there is.
+    """
+    if not isinstance(scene_data, dict) or not isinstance(scene_data.get("background"), str):
+        return False
+    dialogue = scene_data.get("dialogue")
+    if not isinstance(dialogue, list) or not dialogue:
+        return False
+    if not all(isinstance(line, dict) and isinstance(line.get("speaker"), str) and isinstance(line.get("text"), str)
+               for line in dialogue):
+        return False
+    choices = [choice for line in dialogue for choice in line.get("choices") or []]
+    return bool(choices) and all(isinstance(choice, dict) and choice.get("text") and choice.get("nextScene")
+                                 for choice in choices)
+
+def salvage_scene(scene_data, scene_id, scene_outline, book_analysis):
+    """
+    A parsed scene made playable: dialogue lines without text are dropped,
+    missing fields are filled in, and if its closing choices were lost
+    (e.g. the response was cut off) the outline's connections are offered.
+    None if no dialogue survived.
+    """
+    if not isinstance(scene_data, dict):
+        return None
+    dialogue = [line for line in scene_data.get("dialogue") or []
+                if isinstance(line, dict) and isinstance(line.get("text"), str)]
+    if not dialogue:
+        return None
+    
+    for line in dialogue:
+        line.setdefault("speaker", "Narrator")
+        if "choices" in line:
+            line["choices"] = [choice for choice in line["choices"] or []
+                               if isinstance(choice, dict) and choice.get("text") and choice.get("nextScene")]
+            if not line["choices"]:
+                del line["choices"]
+    if not any("choices" in line for line in dialogue):
+        placeholder = create_placeholder_scene(scene_id, scene_outline, book_analysis)
+        dialogue.append(placeholder["dialogue"][-1])
+    
+    scene_data["dialogue"] = dialogue
+    scene_data.setdefault("id", scene_id)
+    if not isinstance(scene_data.get("background"), str):
+        scene_data["background"] = scene_outline.get("setting", "An important location")
+    scene_data["characters"] = [char for char in scene_data.get("characters") or []
+                                if isinstance(char, dict) and char.get("id")]
+    for char in scene_data["characters"]:
+        char.setdefault("image", f"A character representing {char['id']}")
+    return scene_data
 
 def create_placeholder_scene(scene_id, scene_outline, book_analysis):
     """Create a placeholder scene when generation fails"""
@@ -555,109 +971,252 @@ def create_placeholder_scene(scene_id, scene_outline, book_analysis):
     
     return placeholder_scene
 
-async def enhance_visual_novel(script_data, characters):
-    """Add visual elements to the script using AI-generated images"""
+# Default SVG backgrounds for scenes without a rendered image
+DEFAULT_BACKGROUNDS = [
+    "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23243b55'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
+    "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%232c3e50'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
+    "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%231a1a2e'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%230f0f1a'/></svg>",
+    "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23e0e0e0'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23c0c0c0'/></svg>",
+    "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23234010'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23132010'/></svg>"
+]
+
+# Colours of the default SVG character silhouettes
+PORTRAIT_COLORS = ["f9d5e5", "b06ab3", "6a0572", "d1d1e0", "800000", "333333", "e6ccb2", "7b7554", "c0d6df", "4a6fa5"]
+
+def placeholder_background(index: int) -> str:
+    return DEFAULT_BACKGROUNDS[index % len(DEFAULT_BACKGROUNDS)]
+
+def placeholder_portrait(char_id: str) -> str:
+    color_idx = hash(char_id) % len(PORTRAIT_COLORS)
+    return f"data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 250'><rect x='35' y='20' width='30' height='30' rx='15' fill='%23{PORTRAIT_COLORS[color_idx]}'/><rect x='30' y='50' width='40' height='60' fill='%23{PORTRAIT_COLORS[(color_idx+1) % len(PORTRAIT_COLORS)]}'/><rect x='25' y='110' width='50' height='50' fill='%23{PORTRAIT_COLORS[(color_idx+2) % len(PORTRAIT_COLORS)]}'/><rect x='25' y='110' width='20' height='70' rx='5' fill='%23{PORTRAIT_COLORS[(color_idx+2) % len(PORTRAIT_COLORS)]}'/><rect x='55' y='110' width='20' height='70' rx='5' fill='%23{PORTRAIT_COLORS[(color_idx+2) % len(PORTRAIT_COLORS)]}'/></svg>"
+
+def replicate_enabled() -> bool:
+    """AI images are used when a Replicate API token is configured"""
+    return os.environ.get("REPLICATE_API_TOKEN") is not None
+
+def character_descriptions(characters) -> dict:
+    """Map character IDs to the descriptions their portraits are drawn from"""
+    descriptions = {}
+    for char in characters:
+        char_id = char.get("id", "")
+        # Combine name, description, and any physical attributes for better image generation
+        description = f"{char.get('name', 'Character')}: {char.get('description', '')}"
+        if 'personality' in char:
+            description += f". Personality: {char['personality']}"
+        descriptions[char_id] = description
+    return descriptions
+
+class SceneImages:
+    """
+    The background and portrait renders for one script. A render starts as
+    soon as its description is known and runs once: later requests for the
+    same (or, for backgrounds, a near-identical) description share its task.
+    """
+
+    def __init__(self, use_ai_images: bool, book_id: str = None):
+        self.use_ai_images = use_ai_images
+        self.background_namespace = background_namespace(book_id)
+        self.character_namespace = character_namespace(book_id)
+        self.backgrounds = {}         # Background description -> task resolving to an image URL or None
+        self.portraits = {}           # Character description -> task resolving to an image URL or None
+        self._background_shingles = {}  # Descriptions actually being rendered -> shingles
+
+    def background(self, background_desc: str) -> asyncio.Future:
+        task = self.backgrounds.get(background_desc)
+        if task is None:
+            # Near-identical descriptions within this script share a single render
+            shingles = prompt_shingles(normalize_prompt(background_desc))
+            leader = next((desc for desc, other in self._background_shingles.items()
+                           if similarity(shingles, other) >= IMAGE_SIMILARITY_THRESHOLD), None)
+            if leader is None:
+                self._background_shingles[background_desc] = shingles
+                task = asyncio.ensure_future(self._render_background(background_desc))
+            else:
+                task = asyncio.ensure_future(self._share_background(background_desc, self.backgrounds[leader]))
+            self.backgrounds[background_desc] = task
+        return task
+
+    def portrait(self, char_id: str, description: str) -> asyncio.Future:
+        task = self.portraits.get(description)
+        if task is None:
+            task = asyncio.ensure_future(self._render_portrait(char_id, description))
+            self.portraits[description] = task
+        return task
+
+    def finished(self, task):
+        """(image URL or None, whether the render is over), without waiting"""
+        if not self.use_ai_images:
+            return None, True
+        if task is None or not task.done():
+            return None, False
+        if task.cancelled() or task.exception() is not None:
+            return None, True
+        return task.result(), True
+
+    async def _render_background(self, background_desc):
+        # Skip empty or very short descriptions
+        if not self.use_ai_images or len(background_desc) < 10:
+            return None
+        
+        # Reuse cached images, including ones rendered for near-identical descriptions
+        # (a SQLite read and a similarity scan, so off the event loop)
+        cached_url = await asyncio.to_thread(image_cache.get, self.background_namespace, "background", background_desc)
+        if cached_url:
+            print(f"Using cached background for: {background_desc[:30]}...")
+            cache_hit("image", "background")
+            return cached_url
+        
+        try:
+            # Generate an AI image for this background
+            prompt = f"A detailed atmospheric scene: {background_desc}. Suitable as a visual novel background, high quality, detailed."
+            
+            print(f"Generating background for: {background_desc[:30]}...")
+            image_url = await generate_image_with_replicate(prompt)
+            if image_url:
+                # Store the image as a static file and reference it by URL
+                asset_url = await store_image_from_url(image_url)
+                if asset_url:
+                    await asyncio.to_thread(image_cache.put, self.background_namespace, "background",
+                                            background_desc, asset_url)
+                    return asset_url
+        except Exception as e:
+            print(f"Error generating background image: {str(e)}")
+        return None
+
+    async def _share_background(self, background_desc, leader_task):
+        asset_url = await leader_task
+        if asset_url:
+            await asyncio.to_thread(image_cache.put, self.background_namespace, "background", background_desc, asset_url)
+        return asset_url
+
+    async def _render_portrait(self, char_id, description):
+        if not self.use_ai_images:
+            return None
+        
+        # Portraits are only reused for exactly the same character description
+        cached_url = await asyncio.to_thread(image_cache.get, self.character_namespace, "character", description,
+                                             fuzzy=False)
+        if cached_url:
+            print(f"Using cached character image for {char_id}")
+            cache_hit("image", "portrait")
+            return cached_url
+        
+        try:
+            print(f"Generating character image for {char_id}: {description[:30]}...")
+            # Enhance prompt for better character images
+            prompt = f"Portrait of {description}. Full-body portrait, high-quality, detailed, visual novel style, well-lit, clear features, expressive pose."
+            
+            image_url = await generate_image_with_replicate(prompt)
+            if image_url:
+                # Store the image as a static file and reference it by URL
+                asset_url = await store_image_from_url(image_url)
+                if asset_url:
+                    await asyncio.to_thread(image_cache.put, self.character_namespace, "character", description,
+                                            asset_url)
+                    return asset_url
+        except Exception as e:
+            print(f"Error generating character image: {str(e)}")
+        return None
+
+def script_snapshot(title: str, scene_ids: list, written: dict, images: SceneImages, characters: list) -> dict:
+    """
+    The script as far as it has got, without waiting on anything: the
+    written scenes in outline order, with the images rendered so far and
+    placeholders (and "pending_images") where renders are still running.
+    It is playable once the entry scene and its background are done.
+    """
+    descriptions = character_descriptions(characters)
+    scenes = []
+    for i, scene_id in enumerate(scene_ids):
+        if scene_id not in written:
+            continue
+        scene = json.loads(json.dumps(written[scene_id]))
+        pending = False
+        background_desc = scene.get("background", "")
+        if not is_image_reference(background_desc):
+            url, done = images.finished(images.backgrounds.get(background_desc))
+            scene["background"] = url or placeholder_background(i)
+            pending = pending or not done
+        for char in scene.get("characters", []):
+            char_id = char.get("id", "")
+            url, done = images.finished(images.portraits.get(descriptions.get(char_id, f"Character {char_id}")))
+            char["image"] = url or placeholder_portrait(char_id)
+            pending = pending or not done
+        if pending:
+            scene["pending_images"] = True
+        scenes.append(scene)
+    
+    entry_id = scene_ids[0] if scene_ids else None
+    entry = written.get(entry_id)
+    entry_background = entry.get("background", "") if entry else ""
+    return {
+        "title": title,
+        "scenes": scenes,
+        "pending_scenes": [scene_id for scene_id in scene_ids if scene_id not in written],
+        "playable": entry is not None and (is_image_reference(entry_background)
+                                           or images.finished(images.backgrounds.get(entry_background))[1])
+    }
+
+async def enhance_visual_novel(script_data, characters, book_id=None, images=None):
+    """
+    Add visual elements to the script using AI-generated images
+    Renders already started on images (a SceneImages) are reused.
+    """
     print("Enhancing visual novel with AI-generated images...")
     
     # Check if Replicate API token is available
-    replicate_api_token = os.environ.get("REPLICATE_API_TOKEN")
-    use_ai_images = replicate_api_token is not None
+    images = images or SceneImages(replicate_enabled(), book_id)
     
-    if use_ai_images:
+    if images.use_ai_images:
         print("Using Replicate for AI image generation")
     else:
         print("REPLICATE_API_TOKEN not found, using SVG placeholders instead")
     
-    # Generate backgrounds for different settings if needed
-    await generate_backgrounds(script_data, use_ai_images)
-    
-    # Generate character images
-    await generate_character_images(script_data, characters, use_ai_images)
+    # Generate backgrounds and character images; the image scheduler caps how many run at once
+    await asyncio.gather(
+        generate_backgrounds(script_data, images.use_ai_images, book_id, images),
+        generate_character_images(script_data, characters, images.use_ai_images, book_id, images)
+    )
     
     print("Visual enhancement complete")
     return script_data
 
-async def generate_backgrounds(script_data, use_ai_images):
+async def generate_backgrounds(script_data, use_ai_images, book_id=None, images=None):
     """Generate background images for scenes"""
-    # Default SVG backgrounds for fallback
-    default_backgrounds = {
-        "main": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23243b55'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
-        "secondary": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%232c3e50'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23141e30'/></svg>",
-        "dark": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%231a1a2e'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%230f0f1a'/></svg>",
-        "light": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23e0e0e0'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23c0c0c0'/></svg>",
-        "forest": "data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 800 600'><rect width='800' height='600' fill='%23234010'/><path d='M0 450 Q 400 400 800 450 L 800 600 L 0 600 Z' fill='%23132010'/></svg>"
-    }
-    
-    scene_types = list(default_backgrounds.keys())
     unique_backgrounds = set()
     
     # First pass: collect all unique background descriptions
     for scene in script_data["scenes"]:
         # Extract background description if available, otherwise use scene ID
         background_desc = scene.get("background", "")
-        if isinstance(background_desc, str) and not background_desc.startswith("data:"):
+        if isinstance(background_desc, str) and not is_image_reference(background_desc):
             unique_backgrounds.add(background_desc)
     
     # Generate AI backgrounds for unique descriptions
-    if use_ai_images and unique_backgrounds:
-        print(f"Generating {len(unique_backgrounds)} unique AI backgrounds")
-        
-        for background_desc in unique_backgrounds:
-            # Skip if already in cache
-            if background_desc in IMAGE_CACHE["backgrounds"]:
-                continue
-                
-            # Skip if it's an empty or very short description
-            if len(background_desc) < 10:
-                continue
-            
-            try:
-                # Generate an AI image for this background
-                prompt = f"A detailed atmospheric scene: {background_desc}. Suitable as a visual novel background, high quality, detailed."
-                
-                # Try to get from cache first
-                if background_desc in IMAGE_CACHE["backgrounds"]:
-                    print(f"Using cached background for: {background_desc[:30]}...")
-                else:
-                    print(f"Generating background for: {background_desc[:30]}...")
-                    image_url = await generate_image_with_replicate(prompt)
-                    if image_url:
-                        # Convert to data URI for embedding
-                        data_uri = await url_to_data_uri(image_url)
-                        IMAGE_CACHE["backgrounds"][background_desc] = data_uri
-            except Exception as e:
-                print(f"Error generating background image: {str(e)}")
+    images = images or SceneImages(use_ai_images, book_id)
+    candidates = sorted(unique_backgrounds)
+    urls = await asyncio.gather(*[images.background(desc) for desc in candidates])
+    rendered = {desc: url for desc, url in zip(candidates, urls) if url}  # Background description -> image URL
     
     # Second pass: assign backgrounds to scenes
     for i, scene in enumerate(script_data["scenes"]):
         background_desc = scene.get("background", "")
         
-        # If it's already a data URI, keep it
-        if isinstance(background_desc, str) and background_desc.startswith("data:"):
+        # If it's already an image, keep it
+        if is_image_reference(background_desc):
             continue
             
         # Use AI-generated background if available
-        if use_ai_images and background_desc in IMAGE_CACHE["backgrounds"]:
-            scene["background"] = IMAGE_CACHE["backgrounds"][background_desc]
+        if use_ai_images and background_desc in rendered:
+            scene["background"] = rendered[background_desc]
         else:
             # Fall back to SVG placeholder
-            scene_type = scene_types[i % len(scene_types)]
-            scene["background"] = default_backgrounds[scene_type]
+            scene["background"] = placeholder_background(i)
 
-async def generate_character_images(script_data, characters, use_ai_images):
+async def generate_character_images(script_data, characters, use_ai_images, book_id=None, images=None):
     """Generate character images based on descriptions"""
-    # Default SVG character template
-    colors = ["f9d5e5", "b06ab3", "6a0572", "d1d1e0", "800000", "333333", "e6ccb2", "7b7554", "c0d6df", "4a6fa5"]
-    
     # Create a map of character IDs to descriptions
-    character_descriptions = {}
-    for char in characters:
-        char_id = char.get("id", "")
-        # Combine name, description, and any physical attributes for better image generation
-        description = f"{char.get('name', 'Character')}: {char.get('description', '')}"
-        if 'personality' in char:
-            description += f". Personality: {char['personality']}"
-        character_descriptions[char_id] = description
+    descriptions = character_descriptions(characters)
     
     # Get unique character IDs from all scenes
     unique_characters = set()
@@ -666,33 +1225,12 @@ async def generate_character_images(script_data, characters, use_ai_images):
             unique_characters.add(char.get("id", ""))
     
     # Generate AI character images
-    if use_ai_images:
-        print(f"Generating {len(unique_characters)} unique AI character images")
-        
-        for char_id in unique_characters:
-            # Skip if already in cache
-            if char_id in IMAGE_CACHE["characters"]:
-                continue
-            
-            # Get description from the character info
-            description = character_descriptions.get(char_id, f"Character {char_id}")
-            
-            try:
-                # Try to get from cache first
-                if char_id in IMAGE_CACHE["characters"]:
-                    print(f"Using cached character image for {char_id}")
-                else:
-                    print(f"Generating character image for {char_id}: {description[:30]}...")
-                    # Enhance prompt for better character images
-                    prompt = f"Portrait of {description}. Full-body portrait, high-quality, detailed, visual novel style, well-lit, clear features, expressive pose."
-                    
-                    image_url = await generate_image_with_replicate(prompt)
-                    if image_url:
-                        # Convert to data URI for embedding
-                        data_uri = await url_to_data_uri(image_url)
-                        IMAGE_CACHE["characters"][char_id] = data_uri
-            except Exception as e:
-                print(f"Error generating character image: {str(e)}")
+    images = images or SceneImages(use_ai_images, book_id)
+    char_ids = sorted(unique_characters)
+    urls = await asyncio.gather(*[
+        images.portrait(char_id, descriptions.get(char_id, f"Character {char_id}")) for char_id in char_ids
+    ])
+    portraits = {char_id: url for char_id, url in zip(char_ids, urls) if url}  # Character ID -> image URL
     
     # Now update all character references in all scenes
     for scene in script_data["scenes"]:
@@ -700,67 +1238,16 @@ async def generate_character_images(script_data, characters, use_ai_images):
             char_id = char.get("id", "")
             
             # If we have an AI-generated image, use it
-            if use_ai_images and char_id in IMAGE_CACHE["characters"]:
-                char["image"] = IMAGE_CACHE["characters"][char_id]
+            if use_ai_images and char_id in portraits:
+                char["image"] = portraits[char_id]
             else:
                 # Fall back to SVG placeholder
-                color_idx = hash(char_id) % len(colors)
-                char["image"] = f"data:image/svg+xml;utf8,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 250'><rect x='35' y='20' width='30' height='30' rx='15' fill='%23{colors[color_idx]}'/><rect x='30' y='50' width='40' height='60' fill='%23{colors[(color_idx+1) % len(colors)]}'/><rect x='25' y='110' width='50' height='50' fill='%23{colors[(color_idx+2) % len(colors)]}'/><rect x='25' y='110' width='20' height='70' rx='5' fill='%23{colors[(color_idx+2) % len(colors)]}'/><rect x='55' y='110' width='20' height='70' rx='5' fill='%23{colors[(color_idx+2) % len(colors)]}'/></svg>"
+                char["image"] = placeholder_portrait(char_id)
 
 async def generate_image_with_replicate(prompt):
-    """Generate an image using Replicate API"""
-    try:
-        # Run the SDXL Lightning model with the provided prompt
-        output = replicate.run(
-            "bytedance/sdxl-lightning-4step:5599ed30703defd1d160a25a63321b4dec97101d98b4674bcc56e41f62f35637",
-            input={
-                "width": 1024,
-                "height": 1024,
-                "prompt": prompt,
-                "scheduler": "K_EULER",
-                "num_outputs": 1,
-                "guidance_scale": 0,
-                "negative_prompt": "worst quality, low quality, blurry, distorted features",
-                "num_inference_steps": 4
-            }
-        )
-        
-        # The output is a list of URLs
-        if output and len(output) > 0:
-            return output[0]  # Return the first image URL
-        
-        return None
-    except Exception as e:
-        print(f"Error generating image with Replicate: {str(e)}")
-        return None
+    """Generate an image using Replicate API, through the shared rate-limited scheduler"""
+    return await image_scheduler.generate(prompt)
 
-async def url_to_data_uri(url):
-    """Convert an image URL to a data URI for embedding in HTML"""
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            # Get the image and convert it to base64
-            image_content = response.content
-            image = Image.open(BytesIO(image_content))
-            
-            # Resize for reasonable file size
-            max_size = (800, 800)
-            image.thumbnail(max_size)
-            
-            # Convert to JPEG with reasonable quality
-            buffer = BytesIO()
-            image.save(buffer, format="JPEG", quality=85)
-            base64_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            # Create the data URI
-            return f"data:image/jpeg;base64,{base64_image}"
-        else:
-            print(f"Failed to download image: {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"Error converting image to data URI: {str(e)}")
-        return None
-        
 def validate_and_fix_scene_connections(script_data):
     """
     Validate and fix scene connections to ensure all nextScene references
@@ -854,26 +1341,6 @@ def validate_and_fix_scene_connections(script_data):
     
     return script_data
 
-# Helper function to attempt to repair broken JSON
-def attempt_json_repair(json_text):
-    """Attempt to fix common JSON errors"""
-    # Try to fix unclosed quotes
-    json_text = re.sub(r'([^\\])"([^"]*)$', r'\1"\2"', json_text)
-    
-    # Try to fix missing closing braces
-    open_braces = json_text.count('{')
-    close_braces = json_text.count('}')
-    if open_braces > close_braces:
-        json_text += '}' * (open_braces - close_braces)
-    
-    # Try to fix missing closing brackets
-    open_brackets = json_text.count('[')
-    close_brackets = json_text.count(']')
-    if open_brackets > close_brackets:
-        json_text += ']' * (open_brackets - close_brackets)
-    
-    return json_text
-
 # Placeholder script generator for when AI fails
 async def generate_placeholder_script(book_analysis: dict) -> dict:
     """Fallback script generator"""
@@ -1095,17 +1562,18 @@ async def generate_placeholder_script(book_analysis: dict) -> dict:
     return vn_script
 
 # New function for runtime scene generation
-async def generate_next_scene(next_scene_id, client):
+async def generate_next_scene(session, next_scene_id, client, on_line=None):
     """
     Generate a new scene at runtime if it doesn't exist yet
     This is called by the frontend when a scene is needed but not yet generated
+    on_line(line), if given, gets each dialogue line as it is written (see write_scene).
     """
     # Check if we already have this scene in cache
-    if next_scene_id in STORY_CACHE["generated_scenes"]:
-        return STORY_CACHE["generated_scenes"][next_scene_id]
+    if next_scene_id in session.generated_scenes:
+        return session.generated_scenes[next_scene_id]
     
     # Check if this scene is referenced in the scene graph
-    scene_graph = STORY_CACHE["scene_graph"]
+    scene_graph = session.scene_graph
     if next_scene_id in scene_graph:
         # Get info about incoming connections to help generate context
         incoming = scene_graph[next_scene_id]["incoming"]
@@ -1122,20 +1590,21 @@ async def generate_next_scene(next_scene_id, client):
         }
         
         # Get the book analysis from cache
-        book_analysis = STORY_CACHE["book_analysis"]
+        book_analysis = session.book_analysis
         
         # Try to determine characters based on incoming scenes
         for conn in incoming:
             source_id = conn["source"]
-            if source_id in STORY_CACHE["generated_scenes"]:
-                source_scene = STORY_CACHE["generated_scenes"][source_id]
+            if source_id in session.generated_scenes:
+                source_scene = session.generated_scenes[source_id]
                 for char in source_scene.get("characters", []):
                     char_id = char.get("id")
                     if char_id and char_id not in scene_outline["characters"]:
                         scene_outline["characters"].append(char_id)
         
-        # Generate the scene
-        return await generate_scene_from_outline(scene_outline, book_analysis, client)
+        # Generate the scene (on the continuation route, as a player may be waiting on it)
+        return await generate_scene_from_outline(scene_outline, book_analysis, client, session, on_line,
+                                                 call_site="continuation")
     
     # If we don't have any info about this scene, create a generic one
     print(f"No context available for scene {next_scene_id}, creating generic scene")
@@ -1152,5 +1621,6 @@ async def generate_next_scene(next_scene_id, client):
     }
     
     # Generate the scene using available book analysis
-    book_analysis = STORY_CACHE["book_analysis"]
-    return await generate_scene_from_outline(scene_outline, book_analysis, client)
\ No newline at end of file
+    book_analysis = session.book_analysis
+    return await generate_scene_from_outline(scene_outline, book_analysis, client, session, on_line,
+                                             call_site="continuation")
\ No newline at end of file
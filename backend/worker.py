@@ -0,0 +1,117 @@
+# File: worker.py
+"""
+Book processing worker. Pulls jobs from the shared job queue and runs the
+pipeline for each one; start as many as needed (on any machine that shares
+the database, cache and uploads directories):
+
+    python worker.py --concurrency 2
+
+The web server also runs one in-process unless RUN_WORKER_IN_PROCESS=false.
+"""
+import argparse
+import asyncio
+import os
+import traceback
+
+from job_queue import job_queue, JobCheckpoints, new_worker_id
+from pipeline import process_book, update_book
+from storage import store
+from http_client import close_session
+
+# Books processed at the same time by one worker
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "2"))
+
+# How often an idle worker checks the queue for new jobs
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "1.0"))
+
+# Set by enqueue_book so a worker in this process starts right away
+_job_available = asyncio.Event()
+
+def enqueue_book(book_id: str) -> str:
+    job_id = job_queue.enqueue(book_id)
+    _job_available.set()
+    return job_id
+
+async def keep_lease(job: dict, job_task: asyncio.Task):
+    """Renew the job's lease while it runs; cancel it if another worker took over"""
+    while True:
+        await asyncio.sleep(job_queue.lease_seconds / 3)
+        renewed = await asyncio.to_thread(job_queue.renew, job["id"], job["worker_id"])
+        if not renewed:
+            print(f"Lost the lease on job {job['id']}, stopping it")
+            job_task.cancel()
+            return
+
+async def run_job(job: dict):
+    book_id = job["book_id"]
+    book = store.get_book(book_id)
+    if book is None:
+        print(f"Job {job['id']} refers to missing book {book_id}, dropping it")
+        job_queue.complete(job["id"])
+        return
+
+    print(f"Worker {job['worker_id']} running job {job['id']} for book {book_id} (attempt {job['attempts']})")
+    checkpoints = JobCheckpoints(job_queue, job["id"])
+    job_task = asyncio.create_task(process_book(book_id, book["file_path"], checkpoints))
+    lease_task = asyncio.create_task(keep_lease(job, job_task))
+    try:
+        await job_task
+        await asyncio.to_thread(job_queue.complete, job["id"])
+    except asyncio.CancelledError:
+        # Either shutting down or the lease was lost; the job stays claimable
+        if not job_task.done():
+            job_task.cancel()
+        raise
+    except Exception as e:
+        print(f"Error processing book {book_id}: {e}")
+        traceback.print_exc()
+        retry = await asyncio.to_thread(job_queue.fail, job["id"], str(e))
+        if retry:
+            update_book(book_id, status="queued", error=None)
+        else:
+            update_book(book_id, status="error", error=str(e))
+    finally:
+        lease_task.cancel()
+
+async def run_worker(concurrency: int = WORKER_CONCURRENCY, worker_id: str = None):
+    """Claim and run jobs forever, at most `concurrency` at a time"""
+    worker_id = worker_id or new_worker_id()
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    print(f"Worker {worker_id} started with concurrency {concurrency}")
+    try:
+        while True:
+            await slots.acquire()
+            for book_id in await asyncio.to_thread(job_queue.reap):
+                print(f"Book {book_id} failed: its worker stopped responding on the last attempt")
+                update_book(book_id, status="error", error="Processing stopped responding too many times")
+            job = await asyncio.to_thread(job_queue.claim, worker_id)
+            if job is None:
+                slots.release()
+                _job_available.clear()
+                try:
+                    await asyncio.wait_for(_job_available.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(run_job(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        for task in list(running):
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+async def main(concurrency: int):
+    try:
+        await run_worker(concurrency)
+    finally:
+        await close_session()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))
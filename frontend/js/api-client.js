@@ -8,10 +8,31 @@ class PlotTwistAPI {
         
         console.log(`API Client initialized with backend URL: ${this.baseUrl}`);
         
+        // Identifies this player to the server, so scenes are written ahead of each player separately
+        this.playerId = this.loadPlayerId();
+        
         // Add a validation check for the URL
         this.validateBackendConnection();
     }
 
+    /**
+     * This tab's player ID, kept for the browser session
+     * @returns {string} - The player ID
+     */
+    loadPlayerId() {
+        try {
+            let playerId = sessionStorage.getItem('plottwistPlayerId');
+            if (!playerId) {
+                playerId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+                sessionStorage.setItem('plottwistPlayerId', playerId);
+            }
+            return playerId;
+        } catch (error) {
+            // Storage unavailable (e.g. private mode): a fresh ID per page load
+            return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        }
+    }
+
     /**
      * Validate the backend connection is working
      * @returns {Promise<boolean>} - True if connection is successful
@@ -86,6 +107,19 @@ class PlotTwistAPI {
         });
     }
 
+    /**
+     * Resolve an image reference from a script to a loadable URL
+     * Generated images are served by the backend under root-relative paths
+     * @param {string} url - Image URL, root-relative path or data URI
+     * @returns {string} - URL usable from the frontend origin
+     */
+    resolveAssetUrl(url) {
+        if (url && url.startsWith('/')) {
+            return `${this.baseUrl}${url}`;
+        }
+        return url;
+    }
+
     // Rest of your API methods remain unchanged...
 
     async uploadBook(formData) {
@@ -106,9 +140,19 @@ class PlotTwistAPI {
         }
     }
 
-    async getBooks() {
+    /**
+     * Get a page of books
+     * @param {number} limit - Maximum number of books to return
+     * @param {string} after - ID of the last book of the previous page
+     * @returns {Promise<Array>} - Book objects in upload order
+     */
+    async getBooks(limit = 50, after = null) {
         try {
-            const response = await fetch(`${this.baseUrl}/api/books`);
+            const params = new URLSearchParams({ limit });
+            if (after) {
+                params.set('after', after);
+            }
+            const response = await fetch(`${this.baseUrl}/api/books?${params}`);
             
             if (!response.ok) {
                 throw new Error(`Failed to fetch books: ${response.statusText}`);
@@ -162,12 +206,62 @@ class PlotTwistAPI {
     }
 
     /**
-     * Poll for book processing status until ready
+     * Follow book processing status until ready (or playable, with a partial script).
+     * Listens to the server's progress event stream, falling back to
+     * polling every 2 seconds if the stream can't be used.
      * @param {string} bookId - The ID of the book
-     * @param {Function} onProgress - Callback function for progress updates
-     * @returns {Promise<Object>} - Final book object when ready
+     * @param {Function} onProgress - Callback (status, progress, details) for progress updates
+     * @returns {Promise<Object>} - Book object once ready or playable
      */
     async pollBookStatus(bookId, onProgress) {
+        if (typeof EventSource === 'undefined') {
+            return this.pollBookStatusWithRequests(bookId, onProgress);
+        }
+        
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(`${this.baseUrl}/api/books/${bookId}/events`);
+            let finished = false;
+            
+            source.addEventListener('progress', (event) => {
+                const book = JSON.parse(event.data);
+                
+                // Call progress callback
+                if (onProgress) {
+                    onProgress(book.status, book.progress, book);
+                }
+                
+                if (book.status === 'ready' || book.status === 'playable') {
+                    finished = true;
+                    source.close();
+                    // The stream only carries progress fields, so fetch the full record
+                    this.getBook(bookId).then(resolve, reject);
+                } else if (book.status === 'error') {
+                    finished = true;
+                    source.close();
+                    reject(new Error(book.error || 'An error occurred during processing'));
+                }
+            });
+            
+            source.onerror = () => {
+                if (finished) {
+                    return;
+                }
+                // Stream unavailable or dropped: fall back to polling
+                console.warn(`Progress stream for book ${bookId} failed, polling instead`);
+                finished = true;
+                source.close();
+                this.pollBookStatusWithRequests(bookId, onProgress).then(resolve, reject);
+            };
+        });
+    }
+
+    /**
+     * Poll for book processing status until ready or playable
+     * @param {string} bookId - The ID of the book
+     * @param {Function} onProgress - Callback (status, progress, details) for progress updates
+     * @returns {Promise<Object>} - Book object once ready or playable
+     */
+    async pollBookStatusWithRequests(bookId, onProgress) {
         return new Promise((resolve, reject) => {
             const checkStatus = async () => {
                 try {
@@ -175,10 +269,10 @@ class PlotTwistAPI {
                     
                     // Call progress callback
                     if (onProgress) {
-                        onProgress(book.status, book.progress);
+                        onProgress(book.status, book.progress, book);
                     }
                     
-                    if (book.status === 'ready') {
+                    if (book.status === 'ready' || book.status === 'playable') {
                         resolve(book);
                         return;
                     } else if (book.status === 'error') {
@@ -221,6 +315,68 @@ async getScene(sceneId, bookId) {
     }
 }
 
+/**
+ * Load a scene as a stream: onLine(line) is called with each dialogue line
+ * as soon as the server has written it. Falls back to getScene where
+ * EventSource isn't available or the stream fails before any line arrived.
+ * @param {string} sceneId - The ID of the scene to load
+ * @param {string} bookId - The ID of the current book
+ * @param {Function} onLine - Callback for each dialogue line, in order
+ * @returns {Promise<Object>} - The whole scene, once it's done
+ */
+async streamScene(sceneId, bookId, onLine) {
+    if (typeof EventSource === 'undefined') {
+        return this.getScene(sceneId, bookId);
+    }
+    
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`${this.baseUrl}/api/scenes/${sceneId}/stream?book_id=${bookId}`);
+        let lines = 0;
+        let finished = false;
+        
+        source.addEventListener('line', (event) => {
+            lines++;
+            onLine(JSON.parse(event.data).line);
+        });
+        
+        source.addEventListener('scene', (event) => {
+            finished = true;
+            source.close();
+            resolve(JSON.parse(event.data));
+        });
+        
+        source.addEventListener('error', (event) => {
+            if (finished) {
+                return;
+            }
+            finished = true;
+            source.close();
+            if (event.data) {
+                reject(new Error(JSON.parse(event.data).detail));
+            } else if (lines === 0) {
+                // Stream unavailable: load the scene in one request instead
+                this.getScene(sceneId, bookId).then(resolve, reject);
+            } else {
+                reject(new Error(`Stream for scene ${sceneId} ended early`));
+            }
+        });
+    });
+}
+
+/**
+ * Tell the server a player reached a scene, so the scenes after it are written ahead.
+ * Best effort: failures are only logged.
+ * @param {string} sceneId - The ID of the scene reached
+ * @param {string} bookId - The ID of the current book
+ */
+async visitScene(sceneId, bookId) {
+    try {
+        await fetch(`${this.baseUrl}/api/scenes/${sceneId}/visit?book_id=${bookId}&player_id=${this.playerId}`, { method: 'POST' });
+    } catch (error) {
+        console.warn(`Could not report scene ${sceneId}:`, error);
+    }
+}
+
 // Add this to app.js (in the makeChoice method)
 
 /**
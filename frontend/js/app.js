@@ -356,7 +356,7 @@ class PlotTwistApp {
             const book = await apiClient.uploadBook(formData);
             
             // Poll for status updates
-            await apiClient.pollBookStatus(book.id, (status, progress) => {
+            await apiClient.pollBookStatus(book.id, (status, progress, details = {}) => {
                 // Update progress bar
                 this.progressBar.style.width = `${progress}%`;
                 
@@ -365,12 +365,18 @@ class PlotTwistApp {
                 switch (status) {
                     case 'processing':
                         statusText = 'Extracting text from book...';
+                        if (details.pages_total) {
+                            statusText += ` (${details.pages_extracted}/${details.pages_total} pages)`;
+                        }
                         break;
                     case 'analyzing':
                         statusText = 'Analyzing characters and plot...';
                         break;
                     case 'generating':
                         statusText = 'Creating interactive story branches...';
+                        if (details.scenes_total) {
+                            statusText += ` (${details.scenes_generated}/${details.scenes_total} scenes)`;
+                        }
                         break;
                     default:
                         statusText = 'Processing your book...';
@@ -407,7 +413,8 @@ class PlotTwistApp {
         this.processingScreen.classList.add('hidden');
         
         // Show loading in the processing screen if needed
-        if (book.status !== 'ready' && !book.id.startsWith('sample')) {
+        // Playable books start on the entry scene while the rest is still being written
+        if (book.status !== 'ready' && book.status !== 'playable' && !book.id.startsWith('sample')) {
             this.processingScreen.classList.remove('hidden');
             this.processingStatus.textContent = 'Loading your adventure...';
             
@@ -471,7 +478,7 @@ class PlotTwistApp {
         }
         
         // Set the background
-        this.vnBackground.style.backgroundImage = `url('${this.currentScene.background}')`;
+        this.vnBackground.style.backgroundImage = `url('${apiClient.resolveAssetUrl(this.currentScene.background)}')`;
         
         // Clear characters
         this.characterContainer.innerHTML = '';
@@ -482,11 +489,16 @@ class PlotTwistApp {
                 const characterElement = document.createElement('div');
                 characterElement.className = 'vn-character';
                 characterElement.id = `character-${character.id}`;
-                characterElement.style.backgroundImage = `url('${character.image}')`;
+                characterElement.style.backgroundImage = `url('${apiClient.resolveAssetUrl(character.image)}')`;
                 this.characterContainer.appendChild(characterElement);
             });
         }
         
+        // Let the server write the scenes this one leads to (once a streamed scene has its choices)
+        if (this.currentBook && !this.currentBook.id.startsWith('sample') && !this.currentScene.streaming) {
+            apiClient.visitScene(this.currentScene.id, this.currentBook.id);
+        }
+        
         // Display the first dialogue line
         this.displayDialogue();
     }
@@ -545,6 +557,12 @@ class PlotTwistApp {
      * Advance to the next dialogue line with proper scene transitions
      */
     advanceDialogue() {
+        // The next line of a streaming scene is still being written; it's shown once it arrives
+        if (this.currentScene.streaming && this.dialogueIndex + 1 >= this.currentScene.dialogue.length) {
+            this.awaitingLine = true;
+            return;
+        }
+        
         this.dialogueIndex++;
         
         if (this.dialogueIndex < this.currentScene.dialogue.length) {
@@ -654,21 +672,112 @@ class PlotTwistApp {
             this.currentScene = nextScene;
             this.dialogueIndex = 0;
             this.setupScene();
+        } else if ((this.vnScript.pending_scenes || []).includes(choice.nextScene)) {
+            // Still being written: wait for the script to catch up
+            this.loadPendingScene(choice.nextScene);
+        } else if (this.currentBook && !this.currentBook.id.startsWith('sample')) {
+            // Not in our copy of the script: written since, or to be written now
+            this.loadScene(choice.nextScene);
         } else {
-            console.error(`Scene ${choice.nextScene} not found`);
-            
-            // Try to find a scene with a similar ID pattern
-            const similarScenes = this.vnScript.scenes.filter(scene => 
-                scene.id.includes(choice.nextScene) || choice.nextScene.includes(scene.id)
-            );
+            this.useSimilarScene(choice.nextScene);
+        }
+    }
+    
+    /**
+     * Fetch a scene missing from the script (the server writes it if needed)
+     * @param {string} sceneId - The ID of the scene
+     */
+    async loadScene(sceneId) {
+        // Play the dialogue as it streams in, in the current setting until the scene's own arrives
+        const scene = {
+            id: sceneId,
+            background: this.currentScene.background,
+            characters: [],
+            dialogue: [],
+            streaming: true
+        };
+        
+        try {
+            const finished = await apiClient.streamScene(sceneId, this.currentBook.id, (line) => {
+                scene.dialogue.push(line);
+                if (scene.dialogue.length === 1) {
+                    this.currentScene = scene;
+                    this.dialogueIndex = 0;
+                    this.setupScene();
+                } else if (this.currentScene === scene && this.awaitingLine) {
+                    this.awaitingLine = false;
+                    this.advanceDialogue();
+                }
+            });
             
-            if (similarScenes.length > 0) {
-                // Use the first similar scene found
-                console.log(`Using similar scene ${similarScenes[0].id} instead`);
-                this.currentScene = similarScenes[0];
+            const started = this.currentScene === scene;
+            Object.assign(scene, finished, { streaming: false });
+            this.vnScript.scenes.push(scene);
+            if (!started) {
+                this.currentScene = scene;
                 this.dialogueIndex = 0;
                 this.setupScene();
+            } else {
+                // Show the scene's own background and characters
+                this.setupScene();
+                if (this.awaitingLine) {
+                    this.awaitingLine = false;
+                    this.advanceDialogue();
+                }
+            }
+        } catch (error) {
+            console.error(`Error loading scene ${sceneId}:`, error);
+            if (this.currentScene !== scene) {
+                this.useSimilarScene(sceneId);
+            }
+        }
+    }
+    
+    /**
+     * Fall back to a scene whose ID looks like the one that's missing
+     * @param {string} sceneId - The ID of the missing scene
+     */
+    useSimilarScene(sceneId) {
+        console.error(`Scene ${sceneId} not found`);
+        
+        // Try to find a scene with a similar ID pattern
+        const similarScenes = this.vnScript.scenes.filter(scene => 
+            scene.id.includes(sceneId) || sceneId.includes(scene.id)
+        );
+        
+        if (similarScenes.length > 0) {
+            // Use the first similar scene found
+            console.log(`Using similar scene ${similarScenes[0].id} instead`);
+            this.currentScene = similarScenes[0];
+            this.dialogueIndex = 0;
+            this.setupScene();
+        }
+    }
+    
+    /**
+     * Re-fetch the script of a playable book until a pending scene is in it
+     * @param {string} sceneId - The ID of the scene being written
+     */
+    async loadPendingScene(sceneId) {
+        this.vnText.textContent = 'The next scene is still being written...';
+        try {
+            while (true) {
+                this.vnScript = await apiClient.getScript(this.currentBook.id);
+                const scene = this.vnScript.scenes.find(scene => scene.id === sceneId);
+                if (scene) {
+                    this.currentScene = scene;
+                    this.dialogueIndex = 0;
+                    this.setupScene();
+                    return;
+                }
+                if (!(this.vnScript.pending_scenes || []).includes(sceneId)) {
+                    console.error(`Scene ${sceneId} not found`);
+                    return;
+                }
+                await new Promise(resolve => setTimeout(resolve, 2000));
             }
+        } catch (error) {
+            console.error(`Error loading scene ${sceneId}:`, error);
         }
     }
     